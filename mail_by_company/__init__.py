@@ -18,4 +18,5 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 ##############################################################################
-from . import  models
\ No newline at end of file
+from . import  models
+from . import controllers
\ No newline at end of file
@@ -2,7 +2,7 @@
 
 {
     'name' : 'Mail By Company',
-    'version' : '14.0.0.1',
+    'version' : '14.0.0.4',
     'author': 'Morhon',
     'company': 'Morhon.com',
     'category': 'sales',
@@ -12,9 +12,11 @@
     'depends' : ['base','sale_management','fetchmail','crm','project','mail','account','hr_recruitment'],
     'data' : [
         'security/ir.model.access.csv',
+        'data/ir_cron_data.xml',
         'views/mail_server_view.xml',
         'views/alias_mail_view.xml',
-        'views/res_company_views.xml'
+        'views/res_company_views.xml',
+        'views/fetchmail_server_views.xml',
     ],
     'qweb': [],
     "license": "AGPL-3",
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+import hmac
+
+from odoo import http
+from odoo.http import request
+
+
+class MailMetricsController(http.Controller):
+
+    @http.route('/mail_by_company/metrics', type='http', auth='public', methods=['GET'], csrf=False)
+    def mail_metrics(self, token=None, **kwargs):
+        """ Scrape endpoint for the routing and SMTP metrics of all the
+        workers of the server. Protected by ``mail_by_company.metrics_token``. """
+        expected = request.env['ir.config_parameter'].sudo().get_param('mail_by_company.metrics_token')
+        if not expected or not token or not hmac.compare_digest(expected, token):
+            return request.not_found()
+        body = request.env['ir.mail_server'].sudo().get_mail_metrics()
+        return request.make_response(body, headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """ Report the aliases sharing the same name on the same domain: the
+    ``UNIQUE(alias_domain, alias_name)`` constraint cannot be created while
+    they exist, and only the first one of each group is reachable by email. """
+    if not version:
+        return
+    cr.execute("""
+        SELECT alias_domain, alias_name, array_agg(id ORDER BY id)
+          FROM mail_alias
+         WHERE alias_name IS NOT NULL
+      GROUP BY alias_domain, alias_name
+        HAVING count(*) > 1
+    """)
+    duplicates = cr.fetchall()
+    for alias_domain, alias_name, alias_ids in duplicates:
+        _logger.warning(
+            "Duplicate e-mail alias %s@%s (mail.alias ids %s): rename or remove all but one of them "
+            "to enable the alias uniqueness constraint.",
+            alias_name, alias_domain or '<no domain>', alias_ids)
+    if duplicates:
+        _logger.warning("%d duplicate e-mail aliases found, the alias_unique constraint will not be created.",
+                        len(duplicates))
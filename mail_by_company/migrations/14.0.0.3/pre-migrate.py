@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """ Link the existing aliases to the company owning their domain before
+    the ``alias_company_id`` column is created, so that it is not filled with
+    the default company. Aliases whose domain matches no company keep no
+    company and no longer follow a domain change. """
+    if not version:
+        return
+    cr.execute("ALTER TABLE mail_alias ADD COLUMN IF NOT EXISTS alias_company_id INTEGER")
+    cr.execute("""
+        UPDATE mail_alias alias
+           SET alias_company_id = company.id
+          FROM (SELECT DISTINCT ON (lower(company_domain)) id, lower(company_domain) AS domain
+                  FROM res_company
+                 WHERE company_domain IS NOT NULL
+              ORDER BY lower(company_domain), id) company
+         WHERE alias.alias_company_id IS NULL
+           AND lower(alias.alias_domain) = company.domain
+    """)
+    _logger.info("Linked %d e-mail aliases to the company of their domain", cr.rowcount)
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+
+def migrate(cr, version):
+    """ A company can now have several outgoing servers: drop the former
+    one-server-per-company constraint, which the ORM does not remove. """
+    if not version:
+        return
+    cr.execute("ALTER TABLE ir_mail_server DROP CONSTRAINT IF EXISTS ir_mail_server_smtp_company_uniq")
+    cr.execute("""
+        DELETE FROM ir_model_constraint
+         WHERE name = 'ir_mail_server_smtp_company_uniq'
+           AND module = (SELECT id FROM ir_module_module WHERE name = 'mail_by_company')
+    """)
@@ -21,3 +21,7 @@
 from . import res_company
 from . import alias_mail
 from . import mail_server
+from . import mail_message
+from . import ir_attachment
+from . import fetchmail
+from . import mail_deferred
@@ -5,17 +5,26 @@ import ast
 import logging
 
 import re
-import socket
 
 from email.message import EmailMessage
 
 
 from odoo import _, api, fields, models, tools
+from odoo.exceptions import UserError
 from odoo.tools import remove_accents
 
+from .mail_metrics import stage
+
 
 _logger = logging.getLogger(__name__)
 
+# mail.alias fields the routing index is built from
+ROUTING_FIELDS = {'alias_name', 'alias_domain', 'alias_model_id'}
+
+# VERP bounce address of any company: alias+<mail id>-<model>-<res id>@domain
+#   group(1) = the bounce alias; group(2) = the mail ID; group(3) = the model (if any);
+#   group(4) = the record ID; group(5) = the domain
+BOUNCE_RE = re.compile(r"([\w.-]+)\+(\d+)-?([\w.]+)?-?(\d+)?@([\w.-]+)", re.UNICODE)
 
 
 class MailThreadInherit(models.AbstractModel):
@@ -25,21 +34,21 @@ class MailThreadInherit(models.AbstractModel):
     def message_route(self, message, message_dict, model=None, thread_id=None, custom_values=None):
         if not isinstance(message, EmailMessage):
             raise TypeError('message must be an email.message.EmailMessage at this point')
-        catchall_alias = self.env['ir.config_parameter'].sudo().get_param("mail.catchall.alias")
-        bounce_alias = self.env['ir.config_parameter'].sudo().get_param("mail.bounce.alias")
+        Alias = self.env['mail.alias']
+        routing_index = Alias._get_routing_index()
+        catchall_alias = routing_index['catchall_alias']
+        bounce_alias = routing_index['bounce_alias']
         fallback_model = model
 
         # get email.message.Message variables for future processing
-        local_hostname = socket.gethostname()
         message_id = message_dict['message_id']
 
         # compute references to find if message is a reply to an existing thread
         thread_references = message_dict['references'] or message_dict['in_reply_to']
         msg_references = [ref for ref in tools.mail_header_msgid_re.findall(thread_references) if 'reply_to' not in ref]
-        mail_messages = self.env['mail.message'].sudo().search([('message_id', 'in', msg_references)], limit=1,
-                                                               order='id desc, message_id')
-        is_a_reply = bool(mail_messages)
-        reply_model, reply_thread_id = mail_messages.model, mail_messages.res_id
+        reply = self._message_route_find_reply(msg_references)
+        is_a_reply = reply is not None
+        reply_model, reply_thread_id = reply or (False, False)
 
         # author and recipients
         email_from = message_dict['email_from']
@@ -57,11 +66,11 @@ class MailThreadInherit(models.AbstractModel):
         ]
         rcpt_tos_valid_localparts = [to for to in rcpt_tos_localparts]
 
-        email_to_alias_domain_list = [
-            e.split('@')[1].lower()
+        # (domain, localpart) pairs of the recipients, used to probe the routing index
+        rcpt_tos_domain_localparts = [
+            (e.split('@')[1].lower(), e.split('@')[0].lower())
             for e in tools.email_split(message_dict['recipients'])
         ]
-        #         email_to_alias_domain = email_to_localpart_after.split('>')[0]
 
         # 0. Handle bounce: verify whether this is a bounced email and use it to collect bounce data and update notifications for customers
         #    Bounce regex: typical form of bounce is bounce_alias+128-crm.lead-34@domain
@@ -71,12 +80,13 @@ class MailThreadInherit(models.AbstractModel):
         #        As all MTA does not respect this RFC (googlemail is one of them),
         #       we also need to verify if the message come from "mailer-daemon"
         #    If not a bounce: reset bounce information
-        if bounce_alias and any(email.startswith(bounce_alias) for email in email_to_localparts):
-            bounce_re = re.compile("%s\+(\d+)-?([\w.]+)?-?(\d+)?" % re.escape(bounce_alias), re.UNICODE)
-            bounce_match = bounce_re.search(email_to)
-            if bounce_match:
-                self._routing_handle_bounce(message, message_dict)
-                return []
+        #    Each company can use its own bounce alias on its domain, the global one matches any domain
+        if any('+' in email for email in email_to_localparts):
+            for bounce_match in BOUNCE_RE.finditer(email_to):
+                alias_localpart, alias_domain = bounce_match.group(1).lower(), bounce_match.group(5).lower()
+                if alias_localpart == bounce_alias or (alias_localpart, alias_domain) in routing_index['bounce_aliases']:
+                    self._routing_handle_bounce(message, message_dict)
+                    return []
         if message.get_content_type() == 'multipart/report' or email_from_localpart == 'mailer-daemon':
             self._routing_handle_bounce(message, message_dict)
             return []
@@ -86,22 +96,22 @@ class MailThreadInherit(models.AbstractModel):
         #    if destination = alias with different model -> consider it is a forward and not a reply
         #    if destination = alias with same model -> check contact settings as they still apply
         if reply_model and reply_thread_id:
-            other_model_aliases = self.env['mail.alias'].search([
-                '&', '&',
-                ('alias_name', '!=', False),
-                ('alias_name', 'in', email_to_localparts),
-                ('alias_model_id.model', '!=', reply_model),
-            ])
-            if other_model_aliases:
+            other_model_alias_names = {
+                localpart for localpart in email_to_localparts
+                for alias_id, alias_model in Alias._get_route_aliases_by_name(localpart)
+                if alias_model != reply_model
+            }
+            if other_model_alias_names:
                 is_a_reply = False
                 rcpt_tos_valid_localparts = [to for to in rcpt_tos_valid_localparts if
-                                             to in other_model_aliases.mapped('alias_name')]
+                                             to in other_model_alias_names]
 
         if is_a_reply:
-            dest_aliases = self.env['mail.alias'].search([
-                ('alias_name', 'in', rcpt_tos_localparts),
-                ('alias_model_id.model', '=', reply_model)
-            ], limit=1)
+            dest_aliases = Alias.browse([
+                alias_id for localpart in rcpt_tos_localparts
+                for alias_id, alias_model in Alias._get_route_aliases_by_name(localpart)
+                if alias_model == reply_model
+            ][:1])
 
             user_id = self._mail_find_user_for_gateway(email_from, alias=dest_aliases).id or self._uid
             route = self._routing_check_route(
@@ -132,15 +142,15 @@ class MailThreadInherit(models.AbstractModel):
                                                   reply_to=self.env.company.email)
                 return []
 
-            company_domains = []
-            company_ids = self.env['res.company'].search([('company_domain', 'in', email_to_alias_domain_list)])
-            for record in company_ids:
-                company_domains.append(record.company_domain)
-
-            dest_aliases = False
-            if company_domains:
-                dest_aliases = self.env['mail.alias'].search(
-                    [('alias_domain', 'in', company_domains), ('alias_name', 'in', rcpt_tos_valid_localparts)])
+            # only recipients on a company domain can reach an alias, each one
+            # is a lookup of (alias_domain, alias_name) in the cached routing index
+            with stage(self.env, 'route_alias_lookup'):
+                dest_alias_ids = [
+                    alias_id for domain, localpart in rcpt_tos_domain_localparts
+                    if domain in routing_index['companies'] and localpart in rcpt_tos_valid_localparts
+                    for alias_id in Alias._get_route_alias_ids(domain, localpart)
+                ]
+                dest_aliases = Alias.browse(list(tools.unique(dest_alias_ids)))
 
             if dest_aliases:
                 routes = []
@@ -180,50 +190,227 @@ class MailThreadInherit(models.AbstractModel):
             (email_from, email_to, message_id)
         )
 
+    @api.model
+    def _routing_handle_bounce(self, email_message, message_dict):
+        """ When processing a batch, the bounce is buffered so that the
+        records, notifications and blacklist of all the bounces of the batch
+        are updated at once by ``_routing_handle_bounce_batch``. The overrides
+        of this method still run, without the standard per-record updates. """
+        prefetch = self.env.context.get('mail_route_prefetch')
+        if prefetch is None:
+            return super(MailThreadInherit, self)._routing_handle_bounce(email_message, message_dict)
+        prefetch['bounces'].append(message_dict)
+        # the standard updates apply to the bounced email, partner and message:
+        # without them, the base method only logs the bounce
+        return super(MailThreadInherit, self)._routing_handle_bounce(email_message, dict(
+            message_dict, bounced_email=False, bounced_partner=self.env['res.partner'].sudo(),
+            bounced_message=self.env['mail.message'].sudo()))
+
+    @api.model
+    def _message_route_find_reply(self, msg_references):
+        """ Return the ``(model, res_id)`` of the most recent message among
+        ``msg_references``, or None if the email is not a reply. """
+        with stage(self.env, 'route_reference_lookup'):
+            prefetch = self.env.context.get('mail_route_prefetch')
+            if prefetch is not None:
+                replies = [prefetch['replies'][ref] for ref in msg_references if ref in prefetch['replies']]
+                return max(replies)[1:] if replies else None
+            return self.env['mail.message.reference'].sudo()._find_reply(msg_references)
+
+    @api.model
+    def _mail_find_user_for_gateway(self, email, alias=None):
+        # batched gateway: alias addresses and users matching the senders are
+        # prefetched, unless the alias followers have to be looked at first;
+        # the other senders get the standard lookup and its fallbacks
+        with stage(self.env, 'route_find_user'):
+            prefetch = self.env.context.get('mail_route_prefetch')
+            if prefetch is not None:
+                normalized_email = tools.email_normalize(email)
+                if normalized_email in prefetch['alias_emails']:
+                    return self.env['res.users']
+                if normalized_email in prefetch['users'] and not (
+                        alias and alias.alias_parent_model_id and alias.alias_parent_thread_id):
+                    return self.env['res.users'].browse(prefetch['users'][normalized_email])
+            return super(MailThreadInherit, self)._mail_find_user_for_gateway(email, alias=alias)
+
+    def _notify_get_reply_to(self, default=None, records=None, company=None, doc_names=None):
+        # reply-to addresses use the catchall domain of the company owning the records
+        reply_company = company or self.env['res.company']
+        if not reply_company:
+            target = records if records is not None else self
+            if 'company_id' in target._fields:
+                reply_company = target.sudo().mapped('company_id')
+        if len(reply_company) == 1 and reply_company.company_domain:
+            self = self.with_context(mail_catchall_domain=reply_company.company_domain)
+        return super(MailThreadInherit, self)._notify_get_reply_to(
+            default=default, records=records, company=company, doc_names=doc_names)
+
 class Alias(models.Model):
     _inherit = "mail.alias"
 
     alias_domain = fields.Char('Alias domain', compute=False, default=lambda self: self.env.company.company_domain)
+    # the company whose domain the alias follows, see ``res.company.write``
+    alias_company_id = fields.Many2one(
+        'res.company', string='Alias Company', index=True, ondelete='set null',
+        default=lambda self: self.env.company)
+
+    # lookups by name only, e.g. the alias addresses excluded from the users
+    # of the gateway
+    alias_name = fields.Char(index=True)
 
+    # aliases are unique per domain
     _sql_constraints = [
-        ('alias_unique', 'Check(1=1)', 'Unfortunately this email alias is already used, please choose a unique one')
+        ('alias_unique', 'UNIQUE(alias_domain, alias_name)',
+         'Unfortunately this email alias is already used, please choose a unique one')
     ]
 
     @api.model
     def create(self, vals):
+        company = self._get_alias_company(vals.get('alias_company_id'))
+        vals['alias_company_id'] = company.id
+        if not vals.get('alias_domain'):
+            vals['alias_domain'] = self._return_alias_domain(company)
         if vals.get('alias_name'):
-            vals['alias_name'] = self._clean_and_check_unique(vals.get('alias_name'))
-            #vals['alias_domain'] = self._return_alias_domain(vals.get('alias_domain'))
-            vals['alias_domain'] = self._return_alias_domain()
-        return super(Alias, self).create(vals)
+            vals['alias_name'] = self._clean_and_check_unique(vals.get('alias_name'), company, vals['alias_domain'])
+        alias = super(Alias, self).create(vals)
+        self.clear_caches()
+        return alias
 
 
     def write(self, vals):
         """"Raises UserError if given alias name is already assigned"""
-        #f vals.get('alias_name') and self.ids and vals.get('alias_domain'):
-        if vals.get('alias_name') and self.ids:
-            vals['alias_name'] = self._clean_and_check_unique(vals.get('alias_name'))
-            vals['alias_domain'] = self._return_alias_domain()
-        return super(Alias, self).write(vals)
+        if (vals.get('alias_name') or vals.get('alias_company_id')) and self.ids:
+            company = self._get_alias_company(vals.get('alias_company_id'))
+            if 'alias_domain' not in vals:
+                vals['alias_domain'] = self._return_alias_domain(company)
+            if vals.get('alias_name'):
+                vals['alias_name'] = self._clean_and_check_unique(vals.get('alias_name'), company, vals['alias_domain'])
+        res = super(Alias, self).write(vals)
+        if ROUTING_FIELDS.intersection(vals):
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super(Alias, self).unlink()
+        self.clear_caches()
+        return res
+
+    @api.model
+    @tools.ormcache()
+    def _get_routing_index(self):
+        """ Routing index used by ``message_route``, shared by the whole registry.
+
+        Companies are keyed on their lowercased domain, aliases on their
+        lowercased ``(alias_domain, alias_name)`` and on their name alone, so
+        that routing a message never queries the aliases. The index is
+        cleared together with the registry caches (alias or company domain
+        changes, ``ir.config_parameter`` updates), which other workers pick up
+        through the registry signaling. Being built once for all the
+        addresses, its size only depends on the aliases, not on the traffic.
+
+        The returned dict is shared between callers and must not be modified.
+        """
+        # global values, not the ones of the company building the index
+        ICP = self.env['ir.config_parameter'].sudo()
+        bounce_alias = ICP._get_param('mail.bounce.alias')
+        companies, bounce_aliases = {}, set()
+        for company in self.env['res.company'].sudo().search_read(
+                [('company_domain', '!=', False)], ['company_domain', 'bounce_alias']):
+            domain = company['company_domain'].strip().lower()
+            companies.setdefault(domain, []).append(company['id'])
+            if company['bounce_alias']:
+                bounce_aliases.add((company['bounce_alias'].strip().lower(), domain))
+
+        aliases, names = {}, {}
+        self.flush(list(ROUTING_FIELDS))
+        self.env.cr.execute("""
+            SELECT alias.id, LOWER(TRIM(alias.alias_domain)), alias.alias_name, model.model
+              FROM mail_alias alias
+              JOIN ir_model model ON model.id = alias.alias_model_id
+             WHERE alias.alias_name IS NOT NULL
+          ORDER BY alias.id
+        """)
+        for alias_id, domain, name, model in self.env.cr.fetchall():
+            if domain:
+                aliases.setdefault((domain, name), []).append(alias_id)
+            names.setdefault(name, []).append((alias_id, model))
+
+        return {
+            'catchall_alias': ICP.get_param('mail.catchall.alias'),
+            'bounce_alias': bounce_alias and bounce_alias.lower(),
+            'bounce_aliases': frozenset(bounce_aliases),
+            'companies': {domain: tuple(ids) for domain, ids in companies.items()},
+            'aliases': {key: tuple(ids) for key, ids in aliases.items()},
+            'names': {name: tuple(values) for name, values in names.items()},
+        }
+
+    @api.model
+    def _get_route_alias_ids(self, domain, localpart):
+        """ Return the ids of the aliases of ``localpart@domain`` (lowercased
+        values), as an exact match on ``(alias_domain, alias_name)``. """
+        return self._get_routing_index()['aliases'].get((domain, localpart), ())
+
+    @api.model
+    def _get_route_aliases_by_name(self, localpart):
+        """ Return the ``(alias id, model)`` of the aliases named ``localpart``
+        on any domain, used to tell replies from forwards. """
+        return self._get_routing_index()['names'].get(localpart, ())
 
-    def _clean_and_check_unique(self, name):
+    def _clean_and_check_unique(self, name, company=None, domain=None):
         sanitized_name = remove_accents(name).lower().split('@')[0]
         sanitized_name = re.sub(r'[^\w+.]+', '-', sanitized_name)
+        if domain is None:
+            domain = self._return_alias_domain(company)
+        if domain and self.search_count([
+                ('alias_domain', '=', domain), ('alias_name', '=', sanitized_name), ('id', 'not in', self.ids)]):
+            raise UserError(_('The e-mail alias %s@%s is already used, please choose a unique one.')
+                            % (sanitized_name, domain))
         return sanitized_name
 
-    def _return_alias_domain(self):
-        sanitized_name = self.env.company.company_domain
-        return sanitized_name
+    def _return_alias_domain(self, company=None):
+        return (company or self.env.company).company_domain
+
+    def _get_alias_company(self, company_id=None):
+        """ Company of the aliases being written: the given one, else their
+        own company when they share one, else the current company. """
+        if company_id:
+            return self.env['res.company'].sudo().browse(company_id)
+        if len(self.alias_company_id) == 1:
+            return self.alias_company_id.sudo()
+        return self.env.company
+
 
 
+class IrConfigParameter(models.Model):
+    _inherit = 'ir.config_parameter'
+
+    @api.model
+    def get_param(self, key, default=False):
+        # the catchall domain and bounce alias are resolved per company instead
+        # of being rewritten globally for every message
+        if key == 'mail.catchall.domain':
+            catchall_domain = self.env.context.get('mail_catchall_domain') or self._get_mail_company().company_domain
+            if catchall_domain:
+                return catchall_domain
+        elif key == 'mail.bounce.alias':
+            bounce_alias = self._get_mail_company().bounce_alias
+            if bounce_alias:
+                return bounce_alias
+        return super(IrConfigParameter, self).get_param(key, default=default)
+
+    @api.model
+    def _get_mail_company(self):
+        """ Company whose emails are processed: the one of the mail.mail batch
+        being sent, if any, else the current company. """
+        company_id = self.env.context.get('mail_company_id')
+        return self.env['res.company'].sudo().browse(company_id) if company_id else self.env.company
+
 
 class ResConfigSettings(models.TransientModel):
     _inherit = 'res.config.settings'
 
     def _default_alias_domain(self):
-        company_domain = self.env.company.company_domain
-        self.env['ir.config_parameter'].set_param("mail.catchall.domain", company_domain or '')
-        return company_domain
+        return self.env.company.company_domain
 
 
     alias_domain = fields.Char('Alias Domain',
@@ -245,31 +432,37 @@ class ResConfigSettings(models.TransientModel):
 class Team(models.Model):
     _inherit = "crm.team"
 
-    def _default_alias_domain(self):
-        company_domain = self.env.company.company_domain
-        return company_domain
-
     no_alias_domain = fields.Char('No Domain', default="The current company does not have a matching domain name, please set it in res.company!")
-    alias_domain = fields.Char('Alias domain', default=_default_alias_domain,compute='_compute_alias_domain')
+    alias_domain = fields.Char('Alias domain', related='alias_id.alias_domain', readonly=True, store=True)
+
+class AliasMixin(models.AbstractModel):
+    _inherit = "mail.alias.mixin"
+
+    def _alias_get_creation_values(self):
+        values = super(AliasMixin, self)._alias_get_creation_values()
+        if 'company_id' in self._fields and self.company_id:
+            values['alias_company_id'] = self.company_id.id
+        return values
 
-    def _compute_alias_domain(self):
-        alias_domain = self._default_alias_domain()
-        for record in self:
-            record.alias_domain = alias_domain
 
 class Project(models.Model):
     _inherit = "project.project"
 
-    alias_domain = fields.Char('Alias domain', default=lambda self: self.env.company.company_domain)
+    alias_domain = fields.Char('Alias domain', related='alias_id.alias_domain', readonly=True, store=True)
 
 class AccountJournal(models.Model):
     _inherit = "account.journal"
 
-    alias_domain = fields.Char('Alias domain', default=lambda self: self.env.company.company_domain)
+    alias_domain = fields.Char('Alias domain', related='alias_id.alias_domain', readonly=True, store=True)
+
+    def _get_alias_values(self, type, alias_name=None):
+        values = super(AccountJournal, self)._get_alias_values(type, alias_name=alias_name)
+        values['alias_company_id'] = self.company_id.id or self.env.company.id
+        return values
 
 
 class Job(models.Model):
     _inherit = "hr.job"
 
-    alias_domain = fields.Char('Alias domain', default=lambda self: self.env.company.company_domain)
+    alias_domain = fields.Char('Alias domain', related='alias_id.alias_domain', readonly=True, store=True)
 
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from odoo import api, fields, models, registry
+
+from .imap_idle import ImapIdleListener, imap_listeners
+
+_logger = logging.getLogger(__name__)
+
+# first key of the advisory locks held by the IMAP IDLE listeners
+IDLE_LOCK_NAMESPACE = 724301
+# default number of mailboxes fetched at once by the fetchmail cron
+FETCH_WORKERS = 4
+FETCH_LIMIT = 50
+# emails of a fetch parsed and routed together, and their maximum total size
+FETCH_BATCH_SIZE = 50
+FETCH_BATCH_BYTES = 32 * 1024 * 1024
+
+
+class _IdleLocks(object):
+    """ Session-level advisory locks on the incoming mail servers listened
+    to by this process, all held on one connection per database, in
+    autocommit so that no transaction stays open while listening. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cursors = {}
+        self._held = {}
+
+    def acquire(self, dbname, server_id):
+        """ Return whether the lock of ``server_id`` was obtained; it is not
+        when another worker, or another listener of this one, holds it. """
+        with self._lock:
+            held = self._held.setdefault(dbname, set())
+            if server_id in held:
+                return False
+            cr = self._cursors.get(dbname)
+            if cr is None:
+                cr = self._cursors[dbname] = registry(dbname).cursor()
+                cr.autocommit(True)
+            try:
+                cr.execute("SELECT pg_try_advisory_lock(%s, %s)", [IDLE_LOCK_NAMESPACE, server_id])
+                acquired = cr.fetchone()[0]
+            except Exception:
+                # the connection is lost, and the locks it held with it
+                self._close(dbname)
+                raise
+            if acquired:
+                held.add(server_id)
+            elif not held:
+                self._close(dbname)
+            return acquired
+
+    def release(self, dbname, server_id):
+        with self._lock:
+            held = self._held.get(dbname, set())
+            if server_id not in held:
+                return
+            held.discard(server_id)
+            try:
+                self._cursors[dbname].execute(
+                    "SELECT pg_advisory_unlock(%s, %s)", [IDLE_LOCK_NAMESPACE, server_id])
+            finally:
+                if not held:
+                    self._close(dbname)
+
+    def _close(self, dbname):
+        self._held.pop(dbname, None)
+        cr = self._cursors.pop(dbname, None)
+        if cr is not None:
+            try:
+                cr.close()
+            except Exception:
+                pass
+
+
+idle_locks = _IdleLocks()
+
+
+class _MailboxLock(object):
+    """ Advisory lock of a listener on its incoming mail server, see
+    ``_IdleLocks``. Evaluates to whether the lock was obtained. """
+
+    def __init__(self, dbname, server_id):
+        self.dbname = dbname
+        self.server_id = server_id
+        self.acquired = False
+
+    def __enter__(self):
+        self.acquired = idle_locks.acquire(self.dbname, self.server_id)
+        return self.acquired
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.acquired:
+            idle_locks.release(self.dbname, self.server_id)
+        return False
+
+
+class FetchmailServer(models.Model):
+    _inherit = 'fetchmail.server'
+
+    imap_idle = fields.Boolean(
+        string="Push (IMAP IDLE)",
+        help="Keep a connection open to the mailbox and process new emails as soon as "
+             "they arrive, instead of waiting for the next scheduled fetch.")
+    fetch_limit = fields.Integer(
+        string="Fetch Limit", default=FETCH_LIMIT,
+        help="Maximum number of emails processed by each scheduled fetch of an IMAP mailbox, "
+             "the fetch runs again right away for the others. 0 for no limit.")
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        servers = super(FetchmailServer, self).create(vals_list)
+        if any(vals.get('imap_idle') for vals in vals_list):
+            self._trigger_imap_idle_supervisor()
+        return servers
+
+    def write(self, vals):
+        res = super(FetchmailServer, self).write(vals)
+        if {'imap_idle', 'state', 'server', 'port', 'is_ssl', 'user', 'password'}.intersection(vals):
+            self._trigger_imap_idle_supervisor()
+        return res
+
+    @api.model
+    def _trigger_imap_idle_supervisor(self):
+        cron = self.env.ref('mail_by_company.ir_cron_imap_idle_supervisor', raise_if_not_found=False)
+        if cron:
+            cron._trigger()
+
+    @api.model
+    def _fetch_mails(self):
+        """ Fetch the mailboxes on a bounded pool of threads, set by
+        ``mail_by_company.fetch_workers``, so that a slow mailbox does not
+        delay the others. Mailboxes in IMAP IDLE are fetched by their
+        listener. """
+        servers = self.search([
+            ('state', '=', 'done'), ('server_type', 'in', ['pop', 'imap']), ('imap_idle', '=', False),
+        ])
+        workers = int(self.env['ir.config_parameter'].sudo().get_param('mail_by_company.fetch_workers', FETCH_WORKERS))
+        if workers > 1 and len(servers) > 1 and not getattr(threading.current_thread(), 'testing', False):
+            servers._fetch_concurrently(workers)
+        else:
+            servers._fetch_mail_limited()
+        return True
+
+    def _fetch_concurrently(self, workers):
+        """ Fetch each server of ``self`` in a thread with its own cursor. """
+        dbname, uid, context = self.env.cr.dbname, self.env.uid, dict(self.env.context)
+        with ThreadPoolExecutor(max_workers=min(workers, len(self))) as executor:
+            futures = {
+                executor.submit(_call_server, dbname, uid, server_id, '_fetch_mail_limited', context): server_id
+                for server_id in self.ids
+            }
+        # the servers were updated by other transactions
+        self.invalidate_cache()
+        for future, server_id in futures.items():
+            exc = future.exception()
+            if exc is not None:
+                _logger.error('Failed to fetch incoming mail server ID #%s: %s', server_id, exc, exc_info=exc)
+
+    def _fetch_mail_limited(self):
+        """ ``fetch_mail`` processing at most ``fetch_limit`` emails of each
+        IMAP mailbox, in one batch routed by ``message_process_batch``. POP
+        mailboxes keep the standard fetch.
+        WARNING: meant for cron usage only - will commit()! """
+        for server in self:
+            if server.server_type == 'imap':
+                server._fetch_imap_batch()
+            else:
+                super(FetchmailServer, server).fetch_mail()
+        return True
+
+    def _fetch_imap_batch(self):
+        self.ensure_one()
+        _logger.info('start checking for new emails on %s server %s', self.server_type, self.name)
+        imap_server = None
+        try:
+            imap_server = self.connect()
+            imap_server.select()
+            result, data = imap_server.search(None, '(UNSEEN)')
+            unseen = data[0].split()
+            nums = unseen[:self.fetch_limit] if self.fetch_limit > 0 else unseen
+            batch_size, batch_bytes = self._get_fetch_batch_limits()
+            index = 0
+            while index < len(nums):
+                # only the emails of one batch are held in memory at once
+                batch_nums, messages, size = [], [], 0
+                while index < len(nums) and len(batch_nums) < batch_size and size < batch_bytes:
+                    num = nums[index]
+                    index += 1
+                    result, data = imap_server.fetch(num, '(RFC822)')
+                    imap_server.store(num, '-FLAGS', '\\Seen')
+                    batch_nums.append(num)
+                    messages.append(data[0][1])
+                    size += len(data[0][1])
+                self._process_fetched_batch(messages)
+                # the emails are only flagged once their processing is committed
+                for num in batch_nums:
+                    imap_server.store(num, '+FLAGS', '\\Seen')
+            _logger.info("Fetched %d email(s) on %s server %s; %d left for the next run.",
+                         len(nums), self.server_type, self.name, len(unseen) - len(nums))
+            if len(unseen) > len(nums):
+                # the backlog is drained by running the fetch again right away
+                self._trigger_fetch_cron()
+        except Exception:
+            _logger.info("General failure when trying to fetch mail from %s server %s.",
+                         self.server_type, self.name, exc_info=True)
+        finally:
+            if imap_server:
+                try:
+                    imap_server.close()
+                    imap_server.logout()
+                except Exception:
+                    _logger.info("Failed to close the connection to %s server %s.", self.server_type, self.name)
+        self.write({'date': fields.Datetime.now()})
+
+    @api.model
+    def _get_fetch_batch_limits(self):
+        """ Return the ``(number of emails, total size in bytes)`` of the
+        batches processed by a fetch. """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return (max(int(get_param('mail_by_company.fetch_batch_size', FETCH_BATCH_SIZE)), 1),
+                max(int(get_param('mail_by_company.fetch_batch_bytes', FETCH_BATCH_BYTES)), 1))
+
+    @api.model
+    def _trigger_fetch_cron(self):
+        cron = self.env.ref('fetchmail.ir_cron_mail_gateway_action', raise_if_not_found=False)
+        if cron:
+            cron._trigger()
+
+    def _process_fetched_batch(self, messages):
+        """ Route ``messages`` to the model of the server and commit; fall
+        back to processing them one by one when the batch fails. """
+        MailThread = self.env['mail.thread'].with_context(
+            fetchmail_cron_running=True, default_fetchmail_server_id=self.id)
+        if not messages:
+            return
+        try:
+            MailThread.message_process_batch(
+                self.object_id.model, messages,
+                save_original=self.original, strip_attachments=(not self.attach))
+            self.env.cr.commit()
+            return
+        except Exception:
+            self.env.cr.rollback()
+            _logger.info('Failed to process a batch of %s emails from %s server %s, processing them one by one.',
+                         len(messages), self.server_type, self.name, exc_info=True)
+        for message in messages:
+            try:
+                with self.env.cr.savepoint():
+                    MailThread.message_process(
+                        self.object_id.model, message,
+                        save_original=self.original, strip_attachments=(not self.attach))
+            except Exception:
+                _logger.info('Failed to process mail from %s server %s.', self.server_type, self.name, exc_info=True)
+            self.env.cr.commit()
+
+    def _get_imap_idle_token(self):
+        """ Token of the connection settings: a listener is restarted when
+        they change. """
+        self.ensure_one()
+        values = (self.server, self.port, self.is_ssl, self.user, self.password)
+        return hashlib.sha1(repr(values).encode()).hexdigest()
+
+    @api.model
+    def _cron_imap_idle_supervisor(self):
+        """ Make sure a listener runs for every confirmed IMAP server in
+        IDLE mode. Every worker running this cron starts listeners, but a
+        database advisory lock lets only one of them listen to a mailbox;
+        the others stop right away and try again at the next run. """
+        dbname, uid, context = self.env.cr.dbname, self.env.uid, dict(self.env.context)
+        servers = self.sudo().search([('state', '=', 'done'), ('server_type', '=', 'imap'), ('imap_idle', '=', True)])
+        keys = set()
+        for server in servers:
+            key = (dbname, server.id)
+            keys.add(key)
+            token = server._get_imap_idle_token()
+            imap_listeners.ensure(key, token, lambda: _new_listener(key, token, uid, context))
+        imap_listeners.stop_others(dbname, keys)
+
+
+def _new_listener(key, token, uid, context=None):
+    dbname, server_id = key
+    return ImapIdleListener(
+        key, token,
+        connect=lambda: _call_server(dbname, uid, server_id, 'connect', context),
+        fetch=lambda: _call_server(dbname, uid, server_id, 'fetch_mail', context),
+        lock=_MailboxLock(dbname, server_id))
+
+
+def _call_server(dbname, uid, server_id, method, context=None):
+    """ Call ``method`` on the incoming mail server ``server_id`` in a new
+    cursor, with the ``context`` of the caller, from another thread. """
+    threading.current_thread().dbname = dbname
+    with api.Environment.manage(), registry(dbname).cursor() as cr:
+        server = api.Environment(cr, uid, context or {})['fetchmail.server'].browse(server_id)
+        return getattr(server, method)()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import logging
+import select
+import threading
+
+_logger = logging.getLogger(__name__)
+
+# IDLE is re-issued before the 30 minutes after which servers may drop it
+IDLE_TIMEOUT = 25 * 60
+# granularity at which a listener notices it has to stop
+POLL_INTERVAL = 5
+BACKOFF_MIN = 1
+BACKOFF_MAX = 300
+
+
+def prepare_idle_connection(imap):
+    """ Read the responses of ``imap`` without buffering, so that waiting for
+    data on its socket is reliable. Only meant for a connection dedicated to
+    IDLE: messages are fetched on other connections. """
+    imap.file = imap.sock.makefile('rb', buffering=0)
+
+
+def _wait_readable(imap, timeout):
+    pending = getattr(imap.sock, 'pending', None)
+    if pending is not None and pending():
+        return True
+    return bool(select.select([imap.sock], [], [], timeout)[0])
+
+
+def _is_exists(line):
+    return line.startswith(b'*') and line.rstrip().upper().endswith(b'EXISTS')
+
+
+def idle_wait(imap, timeout, stop_event=None):
+    """ Run one IMAP IDLE command (RFC 2177) on the selected mailbox of
+    ``imap`` and return whether new messages arrived. The command ends as
+    soon as a message arrives, after ``timeout`` seconds, or when
+    ``stop_event`` is set. """
+    tag = imap._new_tag()
+    imap.send(tag + b' IDLE\r\n')
+    while True:
+        line = imap.readline()
+        if not line:
+            raise imap.abort('connection closed before IDLE started')
+        if line.startswith(b'+'):
+            break
+        if line.startswith(tag):
+            raise imap.error('IDLE refused: %s' % line.decode('ascii', 'replace').strip())
+
+    has_new = False
+    remaining = timeout
+    while remaining > 0 and not (stop_event is not None and stop_event.is_set()):
+        wait = min(POLL_INTERVAL, remaining)
+        if not _wait_readable(imap, wait):
+            remaining -= wait
+            continue
+        line = imap.readline()
+        if not line or line.startswith(b'* BYE'):
+            raise imap.abort('connection closed during IDLE')
+        if _is_exists(line):
+            has_new = True
+            break
+
+    imap.send(b'DONE\r\n')
+    while True:
+        line = imap.readline()
+        if not line:
+            raise imap.abort('connection closed while ending IDLE')
+        if line.startswith(tag):
+            if not line[len(tag):].strip().upper().startswith(b'OK'):
+                raise imap.error('IDLE failed: %s' % line.decode('ascii', 'replace').strip())
+            return has_new
+        has_new = has_new or _is_exists(line)
+
+
+class ImapIdleListener(threading.Thread):
+    """ Thread keeping an IMAP connection in IDLE on one incoming mail server
+    and calling ``fetch()`` whenever new messages arrive, as well as after
+    every (re)connection. Connection errors are retried with an exponential
+    backoff.
+
+    :param connect: callable returning a logged in ``imaplib.IMAP4``
+    :param fetch: callable fetching and processing the new messages
+    :param lock: optional context manager held while listening, which
+        returns False when another listener owns the mailbox
+    """
+
+    def __init__(self, key, token, connect, fetch, lock=None):
+        super(ImapIdleListener, self).__init__(name='imap-idle-%s-%s' % key[:2], daemon=True)
+        self.key = key
+        self.token = token
+        self._connect = connect
+        self._fetch = fetch
+        self._lock = lock
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        try:
+            if self._lock is None:
+                self._listen()
+                return
+            with self._lock as acquired:
+                if acquired:
+                    self._listen()
+                else:
+                    _logger.debug('IMAP IDLE listener %s is running in another worker', self.key)
+        except Exception:
+            _logger.exception('IMAP IDLE listener %s stopped', self.key)
+
+    def _listen(self):
+        backoff = BACKOFF_MIN
+        while not self.stop_event.is_set():
+            imap = None
+            try:
+                imap = self._connect()
+                prepare_idle_connection(imap)
+                imap.select()
+                backoff = BACKOFF_MIN
+                self._fetch()
+                while not self.stop_event.is_set():
+                    if idle_wait(imap, IDLE_TIMEOUT, self.stop_event):
+                        self._fetch()
+            except Exception as exc:
+                if self.stop_event.is_set():
+                    break
+                _logger.warning('IMAP IDLE listener %s failed (%s), reconnecting in %ss', self.key, exc, backoff)
+                self.stop_event.wait(backoff)
+                backoff = min(backoff * 2, BACKOFF_MAX)
+            finally:
+                if imap is not None:
+                    try:
+                        imap.logout()
+                    except Exception:
+                        pass
+
+
+class ImapIdleRegistry(object):
+    """ Worker-local IDLE listeners, keyed by ``(dbname, server id)``. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = {}
+
+    def ensure(self, key, token, factory):
+        """ Start a listener for ``key`` unless one is running with the same
+        configuration ``token``; ``factory()`` returns the new listener. """
+        with self._lock:
+            listener = self._listeners.get(key)
+            if listener is not None and listener.is_alive() and listener.token == token:
+                return listener
+            if listener is not None:
+                listener.stop()
+            listener = self._listeners[key] = factory()
+            listener.start()
+            return listener
+
+    def stop_others(self, dbname, keys):
+        """ Stop the listeners of ``dbname`` not in ``keys``. """
+        with self._lock:
+            for key in [key for key in self._listeners if key[0] == dbname and key not in keys]:
+                self._listeners.pop(key).stop()
+
+    def stats(self):
+        with self._lock:
+            return {key: listener.is_alive() for key, listener in self._listeners.items()}
+
+
+imap_listeners = ImapIdleRegistry()
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from .mail_server import SPOOL_DESCRIPTION
+
+
+class IrAttachment(models.Model):
+    _inherit = 'ir.attachment'
+
+    @api.autovacuum
+    def _gc_mail_spooled_attachments(self):
+        """ Remove the attachments spooled from inbound emails that were
+        never posted (bounces, duplicates, failed routing). """
+        limit_date = fields.Datetime.now() - timedelta(days=1)
+        self.sudo().search([
+            ('res_model', '=', 'mail.compose.message'),
+            ('res_id', '=', 0),
+            ('description', '=', SPOOL_DESCRIPTION),
+            ('create_date', '<', limit_date),
+        ]).unlink()
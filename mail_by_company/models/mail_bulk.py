@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import copy
+import email
+import email.policy
+from collections import OrderedDict
+from email.generator import BytesGenerator
+from email.message import EmailMessage
+from io import BytesIO
+
+# headers generated for each recipient, always left out of the shared part
+RECIPIENT_HEADERS = ('To', 'Cc', 'Bcc', 'Message-Id')
+# contents of a batch kept as templates at once
+BULK_TEMPLATES_SIZE = 16
+
+
+class BulkMessage(object):
+    """ Message sent to many recipients with the same body and attachments.
+    The template is serialized once; the email of each recipient only
+    serializes its own headers, followed by the shared bytes of the body.
+
+    :param template: ``email.message.Message`` with the common headers, the
+        body and the attachments of the mailing
+    :param personal_headers: names of the headers set per recipient, in
+        addition to ``RECIPIENT_HEADERS``
+    """
+
+    def __init__(self, template, personal_headers=()):
+        self.policy = email.policy.SMTP
+        self.names = {name.lower() for name in RECIPIENT_HEADERS + tuple(personal_headers)}
+        shared = copy.copy(template)
+        # copy.copy shares the parts, only the top level headers are modified
+        shared._headers = [(name, value) for name, value in template._headers if name.lower() not in self.names]
+        # the boundaries of the parts are set while serializing, before the
+        # headers are shared
+        payload = self._flatten(shared)
+        self.headers = shared
+        self.body = payload[payload.index(b'\r\n\r\n') + 4:]
+
+    def _flatten(self, message):
+        fp = BytesIO()
+        BytesGenerator(fp, mangle_from_=False, policy=self.policy).flatten(message, linesep='\r\n')
+        return fp.getvalue()
+
+    def message_for(self, personal):
+        """ Return the email of one recipient: the headers of ``personal``
+        set per recipient, then the shared headers and body. """
+        message = _BulkEmailMessage(policy=self.policy)
+        message._headers = [(name, value) for name, value in personal._headers if name.lower() in self.names]
+        message._headers += self.headers._headers
+        message._bulk_body = self.body
+        return message
+
+    def get(self, name, default=None):
+        """ Value of the shared header ``name``. """
+        return self.headers.get(name, default)
+
+
+class _BulkEmailMessage(EmailMessage):
+    """ Email of a ``BulkMessage``. Its headers are its own and can be
+    modified as usual; its body is the serialized body of the template. """
+
+    def __init__(self, policy=None):
+        super(_BulkEmailMessage, self).__init__(policy=policy)
+        # an empty payload is serialized as nothing, whatever the content type
+        self._payload = ''
+        self._bulk_body = b''
+
+    def _write_headers(self, generator):
+        # the generators let the message write its headers, the body follows
+        generator._write_headers(self)
+        body = self._bulk_body
+        if generator._NL != '\r\n':
+            body = body.replace(b'\r\n', generator._NL.encode('ascii'))
+        if isinstance(generator, BytesGenerator):
+            generator._fp.write(body)
+        else:
+            generator._fp.write(body.decode('ascii', 'surrogateescape'))
+
+    def as_string(self, unixfrom=False, maxheaderlen=None, policy=None):
+        # a text serialization has no 8bit body: serialize the parts again,
+        # the way a message parsed from bytes is
+        message = email.message_from_bytes(self.as_bytes(), policy=self.policy)
+        return message.as_string(unixfrom=unixfrom, maxheaderlen=maxheaderlen, policy=policy)
+
+
+class BulkTemplates(object):
+    """ ``BulkMessage`` of the contents built for a batch of emails, by key,
+    the least recently used being dropped beyond ``size``. A content only
+    becomes a template when it is built again, so that an email sent to a
+    single recipient costs no extra serialization. """
+
+    def __init__(self, size=BULK_TEMPLATES_SIZE):
+        self.size = size
+        self._templates = OrderedDict()
+
+    def get(self, key):
+        """ Return the template of ``key``, or None when there is none yet. """
+        template = self._templates.get(key)
+        if template is not None:
+            self._templates.move_to_end(key)
+        return template
+
+    def seen(self, key):
+        """ Record that the content ``key`` was built and return whether it
+        already was. """
+        seen = key in self._templates
+        self.set(key, self._templates.get(key))
+        return seen
+
+    def set(self, key, template):
+        self._templates[key] = template
+        self._templates.move_to_end(key)
+        while len(self._templates) > self.size:
+            self._templates.popitem(last=False)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import email
+import email.policy
+import logging
+import threading
+from collections import defaultdict
+
+from odoo import api, fields, models
+
+from .mail_metrics import count
+from .smtp_pool import smtp_pool
+
+_logger = logging.getLogger(__name__)
+
+DEFERRED_MAX_ATTEMPTS = 3
+DEFERRED_BATCH_SIZE = 500
+
+
+class MailDeferredMessage(models.Model):
+    """ Email handed to ``ir.mail_server.send_email`` in deferred mode: the
+    message is stored with its headers already rewritten for its company and
+    delivered by a cron, so that the caller does not wait on the SMTP
+    exchange. Delivered messages are removed from the queue. """
+    _name = 'mail.deferred.message'
+    _description = 'Deferred Outgoing Email'
+    _order = 'id'
+
+    message_id = fields.Char('Message-Id', readonly=True)
+    raw_message = fields.Text('Message', required=True, readonly=True)
+    company_id = fields.Many2one('res.company', string='Company', readonly=True)
+    mail_server_id = fields.Many2one('ir.mail_server', string='Outgoing Server', ondelete='set null', readonly=True)
+    state = fields.Selection(
+        [('queued', 'Queued'), ('exception', 'Delivery Failed')], string='Status',
+        default='queued', required=True, index=True, readonly=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    failure_reason = fields.Text('Failure Reason', readonly=True)
+
+    @api.model
+    def _enqueue(self, message, company_id, server_id):
+        """ Store ``message`` and wake up the sender; return its Message-Id. """
+        self.sudo().create({
+            'message_id': message['Message-Id'],
+            'raw_message': message.as_string(),
+            'company_id': company_id,
+            'mail_server_id': server_id or False,
+        })
+        cron = self.env.ref('mail_by_company.ir_cron_send_deferred_messages', raise_if_not_found=False)
+        if cron:
+            cron._trigger()
+        count(self.env, 'deferred_messages_total', company=company_id)
+        return message['Message-Id']
+
+    @api.model
+    def _cron_send_deferred(self, limit=DEFERRED_BATCH_SIZE):
+        """ Deliver the queued messages over pooled SMTP sessions, one server
+        at a time, committing after each message. """
+        auto_commit = not getattr(threading.current_thread(), 'testing', False)
+        groups = defaultdict(list)
+        for deferred in self.search([('state', '=', 'queued')], limit=limit):
+            groups[(deferred.company_id.id, deferred.mail_server_id.id)].append(deferred)
+        for (company_id, server_id), messages in groups.items():
+            self.with_context(mail_company_id=company_id)._send_deferred_group(server_id, messages, auto_commit)
+
+    def _send_deferred_group(self, server_id, messages, auto_commit):
+        """ Deliver ``messages`` through ``server_id``, or through its fallback
+        server while it is unavailable, within the daily cap of the server.
+        The messages that cannot be sent now stay queued. """
+        IrMailServer = self.env['ir.mail_server'].with_context(mail_deferred_delivery=True)
+        idle_timeout, max_messages = IrMailServer._get_smtp_pool_limits()
+        while True:
+            available_id = IrMailServer._get_available_server(server_id)
+            if available_id is None:
+                _logger.info('Mail server ID #%s is unavailable, %s deferred emails postponed',
+                             server_id, len(messages))
+                count(self.env, 'smtp_unavailable_total', len(messages), server=server_id)
+                return
+            if available_id != server_id:
+                _logger.info('Mail server ID #%s is unavailable, failing over to mail server ID #%s',
+                             server_id, available_id)
+                server_id = available_id
+            try:
+                pooled = smtp_pool.acquire(
+                    IrMailServer._get_smtp_pool_key(server_id),
+                    lambda: IrMailServer._connect_pooled(server_id), idle_timeout)
+                break
+            except Exception as exc:
+                count(self.env, 'smtp_connect_failures_total', server=server_id)
+                if IrMailServer._get_available_server(server_id) == server_id:
+                    # the messages stay queued, retried at the next run
+                    _logger.info('Could not connect to mail server ID #%s, %s deferred emails postponed: %s',
+                                 server_id, len(messages), exc)
+                    return
+
+        allowed = IrMailServer._reserve_daily_quota(server_id, len(messages))
+        if allowed < len(messages):
+            _logger.info('Mail server ID #%s reached its daily cap, %s deferred emails postponed',
+                         server_id, len(messages) - allowed)
+        sent = 0
+        try:
+            for deferred in messages[:allowed]:
+                message = email.message_from_string(deferred.raw_message, policy=email.policy.SMTP)
+                try:
+                    IrMailServer.send_email(message, mail_server_id=server_id or None, smtp_session=pooled.session)
+                except Exception as exc:
+                    attempts = deferred.attempts + 1
+                    deferred.write({
+                        'attempts': attempts,
+                        'failure_reason': str(exc),
+                        'state': 'exception' if attempts >= DEFERRED_MAX_ATTEMPTS else 'queued',
+                    })
+                    _logger.info('Deferred email %s could not be sent (attempt %s): %s',
+                                 deferred.message_id, attempts, exc)
+                    if pooled.session is not None and not pooled.session.sock:
+                        # the server closed the session, retry at the next run
+                        break
+                else:
+                    pooled.sent += 1
+                    sent += 1
+                    deferred.unlink()
+                if auto_commit:
+                    self.env.cr.commit()
+        except Exception:
+            smtp_pool.discard(pooled)
+            raise
+        finally:
+            # the emails not sent do not count against the daily cap
+            IrMailServer._release_daily_quota(server_id, allowed - sent)
+        smtp_pool.release(pooled, max_messages, max_idle=IrMailServer._get_max_connections(server_id))
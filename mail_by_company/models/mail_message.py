@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from odoo import api, fields, models, tools
+
+
+class MailMessageReference(models.Model):
+    """ Narrow copy of ``mail_message.message_id`` with the document it was
+    posted on, used by ``message_route`` to detect replies without touching
+    the (wide) ``mail_message`` table. Kept up to date by ``mail.message``. """
+    _name = 'mail.message.reference'
+    _description = 'Message-ID Reference'
+    _log_access = False
+    _rec_name = 'message_id'
+    _order = 'mail_message_id desc'
+
+    message_id = fields.Char('Message-Id', required=True)
+    mail_message_id = fields.Many2one('mail.message', string='Message', required=True, ondelete='cascade', index=True)
+    model = fields.Char('Related Document Model')
+    res_id = fields.Integer('Related Document ID')
+
+    def init(self):
+        tools.create_index(self._cr, 'mail_message_reference_message_id_index',
+                           self._table, ['message_id', 'mail_message_id'])
+        self._cr.execute("SELECT 1 FROM mail_message_reference LIMIT 1")
+        if not self._cr.fetchone():
+            self._cr.execute("""
+                INSERT INTO mail_message_reference (message_id, mail_message_id, model, res_id)
+                     SELECT TRIM(message_id), id, model, res_id
+                       FROM mail_message
+                      WHERE message_id IS NOT NULL
+            """)
+
+    @api.model
+    def _find_reply(self, msg_references):
+        """ Return the ``(model, res_id)`` of the most recent message among
+        ``msg_references``, or None. A single probe of the index. """
+        if not msg_references:
+            return None
+        self._cr.execute("""
+            SELECT model, res_id
+              FROM mail_message_reference
+             WHERE message_id IN %s
+          ORDER BY mail_message_id DESC
+             LIMIT 1
+        """, [tuple(ref.strip() for ref in msg_references)])
+        row = self._cr.fetchone()
+        return (row[0] or False, row[1] or False) if row else None
+
+    @api.model
+    def _find_replies(self, msg_references):
+        """ Batch version of ``_find_reply``: return a dict ``{message_id:
+        (mail_message_id, model, res_id)}`` of the most recent message of each
+        reference found. """
+        if not msg_references:
+            return {}
+        self._cr.execute("""
+            SELECT DISTINCT ON (message_id) message_id, mail_message_id, model, res_id
+              FROM mail_message_reference
+             WHERE message_id IN %s
+          ORDER BY message_id, mail_message_id DESC
+        """, [tuple(set(ref.strip() for ref in msg_references))])
+        return {
+            message_id: (mail_message_id, model or False, res_id or False)
+            for message_id, mail_message_id, model, res_id in self._cr.fetchall()
+        }
+
+    @api.model
+    def _sync_messages(self, message_ids, replace=True):
+        """ Refresh the references of the given ``mail.message`` ids. """
+        if not message_ids:
+            return
+        self.env['mail.message'].flush(['message_id', 'model', 'res_id'])
+        if replace:
+            self._cr.execute("DELETE FROM mail_message_reference WHERE mail_message_id IN %s", [tuple(message_ids)])
+        self._cr.execute("""
+            INSERT INTO mail_message_reference (message_id, mail_message_id, model, res_id)
+                 SELECT TRIM(message_id), id, model, res_id
+                   FROM mail_message
+                  WHERE id IN %s AND message_id IS NOT NULL
+        """, [tuple(message_ids)])
+
+
+class Message(models.Model):
+    _inherit = 'mail.message'
+
+    @api.model_create_multi
+    def create(self, values_list):
+        messages = super(Message, self).create(values_list)
+        self.env['mail.message.reference']._sync_messages(messages.ids, replace=False)
+        return messages
+
+    def write(self, vals):
+        res = super(Message, self).write(vals)
+        if {'message_id', 'model', 'res_id'}.intersection(vals):
+            self.env['mail.message.reference']._sync_messages(self.ids)
+        return res
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from odoo.tools import config
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_logger = logging.getLogger(__name__)
+
+METRICS_PARAM = 'mail_by_company.metrics_enabled'
+PREFIX = 'mail_by_company'
+# seconds between two snapshots of the metrics of a process on disk
+SAVE_INTERVAL = 10
+# counters of the processes that exited, and generation of all the counters
+EXITED_NAME = 'exited.json'
+GENERATION_NAME = 'generation'
+LOCK_NAME = '.lock'
+
+
+class _NullStage(object):
+    """ Stage used when metrics are disabled: does nothing at all. """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    """ Measure the duration and the SQL queries of a block of code. """
+    __slots__ = ('metrics', 'name', 'cr', 'labels', 'start', 'queries')
+
+    def __init__(self, metrics, name, cr, labels):
+        self.metrics = metrics
+        self.name = name
+        self.cr = cr
+        self.labels = labels
+
+    def __enter__(self):
+        self.queries = getattr(self.cr, 'sql_log_count', 0)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        queries = getattr(self.cr, 'sql_log_count', 0) - self.queries
+        self.metrics.observe(self.name, duration, queries, failed=exc_type is not None, **self.labels)
+        return False
+
+
+class MailMetrics(object):
+    """ Counters of the mail routing and sending stages, rendered in the
+    Prometheus text exposition format.
+
+    Each process counts in memory and saves a snapshot of its counters in
+    ``directory`` every ``SAVE_INTERVAL`` seconds, so that the worker serving
+    the scrape renders the sum of the counters of all the processes (prefork
+    workers, cron workers) sharing the data directory. The snapshots of the
+    processes that exited are folded into one file. ``reset`` starts a new
+    generation of counters, which the live processes switch to.
+    """
+
+    def __init__(self, directory=None):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+        self._directory = directory
+        self._pid = None
+        self._generation = None
+        self._saved = 0.0
+
+    @property
+    def directory(self):
+        return self._directory or os.path.join(config['data_dir'], 'mail_by_company', 'metrics')
+
+    def observe(self, stage, duration, queries, failed=False, **labels):
+        key = (stage, _label_key(labels))
+        with self._lock:
+            self._check_fork()
+            values = self._stages.get(key)
+            if values is None:
+                values = self._stages[key] = [0, 0.0, 0, 0]
+            values[0] += 1
+            values[1] += duration
+            values[2] += queries
+            values[3] += failed
+        self._save_periodically()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._check_fork()
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._save_periodically()
+
+    def reset(self):
+        """ Drop the counters of every process: the snapshots are deleted and
+        the other processes drop their counters at their next save or scrape,
+        once they see the new generation. """
+        generation = uuid.uuid4().hex
+        with self._lock:
+            self._check_fork()
+            self._stages.clear()
+            self._counters.clear()
+            self._generation = generation
+        directory = self.directory
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with _locked(directory):
+                _write_json(os.path.join(directory, GENERATION_NAME), generation)
+                for path in glob.glob(os.path.join(directory, '*.json')):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+        except OSError:
+            _logger.warning('Could not reset the mail metrics in %s', directory, exc_info=True)
+
+    def _check_fork(self):
+        # the counters of a forked worker start from zero, those of the
+        # parent process are already saved under the name of the parent
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._name = '%s-%s.json' % (self._pid, uuid.uuid4().hex)
+            self._stages.clear()
+            self._counters.clear()
+            self._generation = None
+            self._saved = 0.0
+
+    def _check_generation(self, generation):
+        # the counters of a previous generation were reset
+        if self._generation is not None and self._generation != generation:
+            self._stages.clear()
+            self._counters.clear()
+        self._generation = generation
+
+    def _save_periodically(self):
+        if time.monotonic() - self._saved >= SAVE_INTERVAL:
+            self.save()
+
+    def save_on_exit(self):
+        # the counters of the last seconds of a worker are not lost
+        if self._pid == os.getpid():
+            self.save()
+
+    def save(self):
+        """ Write the snapshot of the counters of this process, and fold the
+        snapshots of the processes that exited. """
+        directory = self.directory
+        generation = _read_generation(directory)
+        with self._lock:
+            self._check_fork()
+            self._check_generation(generation)
+            self._saved = time.monotonic()
+            snapshot = _snapshot(generation, self._stages, self._counters)
+            name = self._name
+        try:
+            os.makedirs(directory, exist_ok=True)
+            _write_json(os.path.join(directory, name), snapshot)
+            self._fold_exited(directory, generation)
+        except OSError:
+            _logger.warning('Could not save the mail metrics in %s', directory, exc_info=True)
+
+    def _fold_exited(self, directory, generation):
+        """ Add the snapshots of the processes that exited to the counters of
+        ``EXITED_NAME`` and delete them. """
+        exited = [path for path, pid in _snapshot_paths(directory) if not _is_alive(pid)]
+        if not exited:
+            return
+        with _locked(directory):
+            stages, counters = {}, {}
+            exited_path = os.path.join(directory, EXITED_NAME)
+            _merge(stages, counters, _load(exited_path, generation))
+            for path in exited:
+                _merge(stages, counters, _load(path, generation))
+            _write_json(exited_path, _snapshot(generation, stages, counters))
+            for path in exited:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def collect(self):
+        """ Return ``(stages, counters)``, the counters of this process
+        summed with the snapshots of the other processes. """
+        directory = self.directory
+        generation = _read_generation(directory)
+        with self._lock:
+            self._check_fork()
+            self._check_generation(generation)
+            stages = {key: list(values) for key, values in self._stages.items()}
+            counters = dict(self._counters)
+            name = self._name
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            if os.path.basename(path) != name:
+                _merge(stages, counters, _load(path, generation))
+        return stages, counters
+
+    def render(self, gauges=None):
+        """ Return the metrics of all the processes in the Prometheus text
+        format. ``gauges`` is an optional dict ``{name: value}`` of values of
+        the current process to expose, labelled with its pid. """
+        pid = str(os.getpid())
+        stages, counters = self.collect()
+        stages = sorted(stages.items())
+        counters = sorted(counters.items())
+        lines = []
+        stage_series = (
+            ('stage_seconds_count', 'counter', 0),
+            ('stage_seconds_sum', 'counter', 1),
+            ('stage_queries_total', 'counter', 2),
+            ('stage_failures_total', 'counter', 3),
+        )
+        for suffix, kind, index in stage_series:
+            if not stages:
+                break
+            lines.append('# TYPE %s_%s %s' % (PREFIX, suffix, kind))
+            for (stage, labels), values in stages:
+                lines.append('%s_%s%s %s' % (
+                    PREFIX, suffix, _format_labels(labels + (('stage', stage),)), values[index]))
+        names = []
+        for (name, labels), value in counters:
+            if name not in names:
+                names.append(name)
+                lines.append('# TYPE %s_%s counter' % (PREFIX, name))
+            lines.append('%s_%s%s %s' % (PREFIX, name, _format_labels(labels), value))
+        for name, value in sorted((gauges or {}).items()):
+            lines.append('# TYPE %s_%s gauge' % (PREFIX, name))
+            lines.append('%s_%s%s %s' % (PREFIX, name, _format_labels((('worker', pid),)), value))
+        return '\n'.join(lines) + '\n'
+
+
+def _snapshot_paths(directory):
+    """ Paths and pids of the snapshots of the processes in ``directory``. """
+    for path in glob.glob(os.path.join(directory, '*-*.json')):
+        pid = os.path.basename(path).split('-', 1)[0]
+        if pid.isdigit():
+            yield path, int(pid)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. a process of another user
+        return True
+    return True
+
+
+@contextmanager
+def _locked(directory):
+    """ Exclusive lock of the processes sharing ``directory``. """
+    with open(os.path.join(directory, LOCK_NAME), 'a') as fp:
+        if fcntl is not None:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+        yield
+
+
+def _read_generation(directory):
+    try:
+        with open(os.path.join(directory, GENERATION_NAME)) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return ''
+
+
+def _write_json(path, value):
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(value, fp)
+    os.replace(path + '.tmp', path)
+
+
+def _snapshot(generation, stages, counters):
+    return {
+        'generation': generation,
+        'stages': [[stage, labels, values] for (stage, labels), values in stages.items()],
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+    }
+
+
+def _load(path, generation):
+    """ Snapshot of ``path``, None when unreadable or of another generation. """
+    try:
+        with open(path) as fp:
+            snapshot = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if snapshot.get('generation', '') != generation:
+        return None
+    return snapshot
+
+
+def _merge(stages, counters, snapshot):
+    """ Add the counters of ``snapshot`` to ``stages`` and ``counters``. """
+    if not snapshot:
+        return
+    for stage, labels, values in snapshot['stages']:
+        key = (stage, tuple(map(tuple, labels)))
+        total = stages.setdefault(key, [0, 0.0, 0, 0])
+        for index, value in enumerate(values):
+            total[index] += value
+    for counter, labels, value in snapshot['counters']:
+        key = (counter, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items() if value is not None))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+
+mail_metrics = MailMetrics()
+atexit.register(mail_metrics.save_on_exit)
+
+
+def metrics_enabled(env):
+    return bool(env['ir.config_parameter'].sudo().get_param(METRICS_PARAM))
+
+
+def stage(env, name, **labels):
+    """ Context manager measuring the stage ``name``; free when disabled. """
+    if not metrics_enabled(env):
+        return NULL_STAGE
+    return _Stage(mail_metrics, name, env.cr, labels)
+
+
+def count(env, name, value=1, **labels):
+    if metrics_enabled(env):
+        mail_metrics.inc(name, value, **labels)
@@ -1,34 +1,429 @@
 # -*- coding: utf-8 -*-
+import email
+import email.policy
 import logging
+import random
 import smtplib
-from odoo import _, api, fields, models, tools
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from email.utils import make_msgid
+from xmlrpc import client as xmlrpclib
+
+from odoo import _, api, fields, models, registry, tools
 from odoo.addons.base.models.ir_mail_server import MailDeliveryException
 from odoo.exceptions import UserError
-from odoo.tools import ustr
+from odoo.tools import config, ustr
 from ssl import SSLError
 from socket import gaierror, timeout
 import idna
 
+from .mail_bulk import BulkMessage, BulkTemplates
+from .mail_metrics import mail_metrics, metrics_enabled, stage, count
+from .smtp_balancer import smtp_balancers
+from .smtp_breaker import CircuitOpenError, smtp_breakers
+from .smtp_pipelining import enable_pipelining
+from .smtp_pool import smtp_pool
+from .smtp_throttle import is_throttling_reply, is_transient_failure, smtp_throttles
+
 _logger = logging.getLogger(__name__)
 
-class Message(models.Model):
-    _inherit = 'mail.message'
+SMTP_POOL_IDLE_TIMEOUT = 60
+SMTP_POOL_MAX_MESSAGES = 100
+SEND_WORKERS = 4
+THROTTLE_RETRIES = 2
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 60
+SPOOL_THRESHOLD = 0
+QUEUE_LIMIT = 10000
+# priority lanes of the outgoing queue, by decreasing priority, with the
+# share of each lane in a run of the queue
+MAIL_PRIORITIES = [('transactional', 'Transactional'), ('normal', 'Normal'), ('bulk', 'Bulk')]
+MAIL_PRIORITY_WEIGHTS = {'transactional': 8, 'normal': 3, 'bulk': 1}
+MAIL_PRIORITY_RANKS = {priority: rank for rank, (priority, _label) in enumerate(MAIL_PRIORITIES)}
+TRANSACTIONAL_MODELS = 'account.move,account.payment,sale.order,res.users'
+# retries of emails failing for a transient reason
+RETRY_MAX = 5
+RETRY_BASE_DELAY = 60
+RETRY_MAX_DELAY = 3600
+RETRY_RELEASE_RATE = 60
+SPOOL_DESCRIPTION = 'Spooled inbound email attachment'
+HEALTH_FIELDS = {'health_state', 'health_failures', 'health_error', 'health_checked_at'}
 
-    @api.model_create_multi
-    def create(self, values_list):
-        self.env['ir.config_parameter'].set_param("mail.catchall.domain", self.env.company.company_domain)
-        return super(Message, self).create(values_list)
+# size of the last message written by an SMTP session of the thread
+_sent_size = threading.local()
+
+
+def track_sent_size(smtp_session):
+    """ Record in ``_sent_size`` the size of the messages sent through
+    ``smtp_session``, as serialized by smtplib. """
+    sendmail = smtp_session.sendmail
+
+    def tracked_sendmail(from_addr, to_addrs, msg, *args, **kwargs):
+        _sent_size.value = len(msg)
+        return sendmail(from_addr, to_addrs, msg, *args, **kwargs)
+    smtp_session.sendmail = tracked_sendmail
+
+
+def thread_cursor_budget():
+    """ Number of cursors the threads started by a job may hold at once:
+    half of the ``db_maxconn`` connections of the process, the rest being
+    left to the job itself and to the other threads of the process. """
+    return max(int(config['db_maxconn']) // 2, 1)
 
 
 class IrMailServer(models.Model):
     _inherit = "ir.mail_server"
 
     default_company = fields.Many2one('res.company', string="Company")
+    send_weight = fields.Integer(
+        string="Weight", default=1,
+        help="Share of the company's emails sent through this server, relative to the "
+             "weights of the other servers of the company.")
+    send_capacity = fields.Integer(
+        string="Capacity",
+        help="Maximum number of emails sent through this server per run of the email "
+             "queue, 0 for no limit. Emails over the capacity of all the servers of the "
+             "company wait for the next run.")
+    send_rate = fields.Integer(
+        string="Emails per Minute",
+        help="Maximum sustained sending rate allowed by the provider, 0 for no limit. "
+             "The rate is lowered automatically when the server answers with a throttling reply.")
+    send_burst = fields.Integer(
+        string="Burst", default=10,
+        help="Number of emails that can be sent at once before the rate applies.")
+    smtp_max_connections = fields.Integer(
+        string="Parallel Connections", default=1,
+        help="Number of sessions opened at once to this server to send a batch of "
+             "emails. Commands are pipelined on servers supporting it.")
+    send_daily_cap = fields.Integer(
+        string="Daily Cap",
+        help="Maximum number of emails sent per day (UTC) through this server, 0 for no limit. "
+             "Emails over the cap stay in the queue until the next day.")
+    daily_sent_date = fields.Date(string="Daily Count Date", readonly=True, copy=False)
+    daily_sent_count = fields.Integer(string="Sent Today", readonly=True, copy=False)
+    fallback_mail_server_id = fields.Many2one(
+        'ir.mail_server', string="Fallback Server",
+        help="Server used for the emails of this server while it is down.")
+    health_state = fields.Selection(
+        [('unknown', 'Unknown'), ('ok', 'Up'), ('down', 'Down')], string="Health",
+        default='unknown', readonly=True, copy=False,
+        help="Result of the last scheduled connection check. Emails are not sent "
+             "through a server that is down, but through its fallback server if any.")
+    health_failures = fields.Integer(string="Failed Checks", readonly=True, copy=False)
+    health_error = fields.Text(string="Last Check Error", readonly=True, copy=False)
+    health_checked_at = fields.Datetime(string="Last Check", readonly=True, copy=False)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        servers = super(IrMailServer, self).create(vals_list)
+        self.clear_caches()
+        return servers
+
+    def write(self, vals):
+        res = super(IrMailServer, self).write(vals)
+        self.clear_caches()
+        if set(vals) - HEALTH_FIELDS:
+            self._clear_smtp_pool()
+        return res
+
+    def unlink(self):
+        res = super(IrMailServer, self).unlink()
+        self.clear_caches()
+        self._clear_smtp_pool()
+        return res
+
+    @api.model
+    @tools.ormcache('company_id')
+    def _get_company_mail_servers(self, company_id):
+        """ Return the outgoing servers of a company as a tuple of
+        ``(server_id, return_path, from_suffix, weight, capacity)``, where
+        ``return_path`` and ``from_suffix`` are the header values derived from
+        its ``smtp_user`` (False without one). Cached until an
+        ``ir.mail_server`` is created, written or unlinked. """
+        servers = self.sudo().search([('default_company', '=', company_id)])
+        return tuple(
+            (server.id,
+             server.smtp_user or False,
+             server.smtp_user and ' <' + server.smtp_user + '>',
+             server.send_weight,
+             server.send_capacity)
+            for server in servers
+        )
+
+    @api.model
+    def _get_company_balanced_servers(self, company_id):
+        """ Return the ``(server_id, weight, capacity)`` of the available
+        servers of the company, or of all of them when none is available so
+        that the failover of ``mail.mail`` applies. """
+        servers = [(server_id, weight, capacity) for server_id, _path, _suffix, weight, capacity
+                   in self._get_company_mail_servers(company_id)]
+        available = [server for server in servers if self._get_available_server(server[0]) == server[0]]
+        return available or servers
+
+    @api.model
+    @tools.ormcache('server_id')
+    def _get_server_account(self, server_id):
+        """ Return the ``(return_path, from_suffix)`` of ``server_id``, as in
+        ``_get_company_mail_servers``. """
+        server = self.sudo().browse(server_id).exists()
+        smtp_user = server.smtp_user if server else False
+        return smtp_user or False, smtp_user and ' <' + smtp_user + '>'
+
+    @api.model
+    def _pick_company_server(self, company_id):
+        """ Return the next server of the company by weighted round-robin. """
+        servers = self._get_company_balanced_servers(company_id)
+        if not servers:
+            return False
+        if len(servers) == 1:
+            return servers[0][0]
+        balancer = smtp_balancers.get((self.env.cr.dbname, company_id))
+        return balancer.pick([(server_id, weight) for server_id, weight, _capacity in servers])
+
+    @api.model
+    @tools.ormcache('server_id')
+    def _get_smtp_pool_key(self, server_id):
+        """ Key of the pooled SMTP sessions of ``server_id``. It embeds the
+        last modification of the servers, so that sessions opened with an
+        outdated configuration are never reused by any worker. """
+        last_server = self.sudo().with_context(active_test=False).search([], order='write_date desc', limit=1)
+        return (self.env.cr.dbname, server_id, str(last_server.write_date))
+
+    @api.model
+    @tools.ormcache('server_id')
+    def _get_throttle_config(self, server_id):
+        """ Return ``(emails per second, burst, daily cap)`` of ``server_id``. """
+        server = self.sudo().browse(server_id).exists() if server_id else self
+        if not server:
+            return 0.0, 0, 0
+        return server.send_rate / 60.0, server.send_burst, server.send_daily_cap
+
+    @api.model
+    @tools.ormcache('server_id')
+    def _get_server_health(self, server_id):
+        """ Return ``(health state, fallback server id)`` of ``server_id``. """
+        server = self.sudo().browse(server_id).exists() if server_id else self
+        if not server:
+            return 'unknown', False
+        return server.health_state, server.fallback_mail_server_id.id
+
+    @api.model
+    def _get_breaker(self, server_id):
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return smtp_breakers.get(
+            (self.env.cr.dbname, server_id),
+            int(get_param('mail_by_company.smtp_breaker_threshold', BREAKER_THRESHOLD)),
+            int(get_param('mail_by_company.smtp_breaker_cooldown', BREAKER_COOLDOWN)))
+
+    @api.model
+    def _get_available_server(self, server_id):
+        """ Return ``server_id`` if emails can be sent through it, else the
+        first available server of its fallback chain, else None. A server is
+        unavailable when the health check found it down or when the circuit
+        breaker of this worker is open. """
+        seen = set()
+        while server_id not in seen:
+            seen.add(server_id)
+            health_state, fallback_id = self._get_server_health(server_id)
+            if health_state != 'down' and not self._get_breaker(server_id).is_open:
+                return server_id
+            if not fallback_id:
+                break
+            server_id = fallback_id
+        return None
+
+    @api.model
+    @tools.ormcache('server_id')
+    def _get_max_connections(self, server_id):
+        """ Number of sessions a batch may open at once to ``server_id``. """
+        server = self.sudo().browse(server_id).exists() if server_id else self
+        return max(server.smtp_max_connections, 1) if server else 1
+
+    @api.model
+    def _get_throttle_bucket(self, server_id):
+        rate, burst, daily_cap = self._get_throttle_config(server_id)
+        if not rate:
+            return None
+        return smtp_throttles.get((self.env.cr.dbname, server_id), rate, burst)
+
+    @api.model
+    def _reserve_daily_quota(self, server_id, count):
+        """ Reserve up to ``count`` emails on the daily cap of ``server_id``
+        and return how many can be sent. The reservation is committed in its
+        own transaction so that concurrent senders never wait on each other. """
+        daily_cap = self._get_throttle_config(server_id)[2]
+        if not daily_cap or not count:
+            return count
+        with registry(self.env.cr.dbname).cursor() as cr:
+            cr.execute("""
+                WITH current AS (
+                    SELECT id, CASE WHEN daily_sent_date = %(today)s THEN daily_sent_count ELSE 0 END AS sent
+                      FROM ir_mail_server
+                     WHERE id = %(server_id)s
+                       FOR UPDATE
+                ), reserved AS (
+                    SELECT id, sent, LEAST(%(count)s, GREATEST(%(cap)s - sent, 0)) AS allowed
+                      FROM current
+                )
+                UPDATE ir_mail_server server
+                   SET daily_sent_count = reserved.sent + reserved.allowed,
+                       daily_sent_date = %(today)s
+                  FROM reserved
+                 WHERE server.id = reserved.id
+             RETURNING reserved.allowed
+            """, {'today': fields.Date.today(), 'server_id': server_id, 'count': count, 'cap': daily_cap})
+            row = cr.fetchone()
+        self.browse(server_id).invalidate_cache(['daily_sent_count', 'daily_sent_date'])
+        return row[0] if row else count
+
+    @api.model
+    def _release_daily_quota(self, server_id, count):
+        """ Give back ``count`` emails reserved with ``_reserve_daily_quota``
+        that were not sent. """
+        if not count or not self._get_throttle_config(server_id)[2]:
+            return
+        with registry(self.env.cr.dbname).cursor() as cr:
+            cr.execute("""
+                UPDATE ir_mail_server
+                   SET daily_sent_count = GREATEST(daily_sent_count - %s, 0)
+                 WHERE id = %s AND daily_sent_date = %s
+            """, [count, server_id, fields.Date.today()])
+        self.browse(server_id).invalidate_cache(['daily_sent_count', 'daily_sent_date'])
+
+    @api.model
+    def _connect_pooled(self, server_id):
+        """ Open a session for the SMTP pool, tagged with its server. """
+        with stage(self.env, 'smtp_connect', server=server_id):
+            smtp_session = self.connect(mail_server_id=server_id)
+        if smtp_session is not None:
+            smtp_session.mail_by_company_server_id = server_id
+        return smtp_session
+
+    def connect(self, host=None, port=None, user=None, password=None, encryption=None,
+                smtp_debug=False, mail_server_id=None):
+        # servers failing repeatedly are not contacted until their breaker
+        # closes, except by the probes of the health check
+        breaker = self._get_breaker(mail_server_id) if mail_server_id else None
+        if breaker is not None and breaker.is_open and not self.env.context.get('mail_smtp_probe'):
+            raise CircuitOpenError(_('Mail server ID #%s is unavailable, its circuit breaker is open') % mail_server_id)
+        try:
+            smtp_session = super(IrMailServer, self).connect(
+                host=host, port=port, user=user, password=password, encryption=encryption,
+                smtp_debug=smtp_debug, mail_server_id=mail_server_id)
+        except Exception:
+            if breaker is not None and breaker.failure():
+                _logger.warning('Mail server ID #%s failed %s times in a row, circuit breaker open for %ss',
+                                mail_server_id, breaker.failures, breaker.cooldown)
+            raise
+        if breaker is not None:
+            breaker.success()
+        if smtp_session is not None:
+            try:
+                enable_pipelining(smtp_session)
+            except smtplib.SMTPException:
+                _logger.info('Could not check the PIPELINING support of mail server ID #%s',
+                             mail_server_id, exc_info=True)
+            track_sent_size(smtp_session)
+        return smtp_session
+
+    @api.model
+    def _get_smtp_pool_limits(self):
+        """ Return the ``(idle timeout in seconds, max messages per connection)``
+        applied to pooled SMTP sessions. """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return (
+            int(get_param('mail_by_company.smtp_pool_idle_timeout', SMTP_POOL_IDLE_TIMEOUT)),
+            max(int(get_param('mail_by_company.smtp_pool_max_messages', SMTP_POOL_MAX_MESSAGES)), 1),
+        )
+
+    @api.model
+    def get_smtp_pool_stats(self):
+        """ Hit/miss counters of the SMTP connection pool of this worker. """
+        return smtp_pool.stats()
+
+    @api.model
+    def get_mail_metrics(self):
+        """ Routing and SMTP metrics of all the workers, in the Prometheus text
+        format, with the gauges of the SMTP pool of this worker. Collected only
+        when ``mail_by_company.metrics_enabled`` is set. """
+        pool_stats = smtp_pool.stats()
+        return mail_metrics.render(gauges={
+            'smtp_pool_hits': pool_stats['hits'],
+            'smtp_pool_misses': pool_stats['misses'],
+            'smtp_pool_discarded': pool_stats['discarded'],
+            'smtp_pool_idle': pool_stats['idle'],
+            'smtp_breakers_open': sum(smtp_breakers.stats().values()),
+        })
+
+    def _clear_smtp_pool(self):
+        dbname = self.env.cr.dbname
+        smtp_pool.clear(lambda key: key[0] == dbname)
+
+    @api.model
+    def _apply_company_headers(self, message, company_id, server_id):
+        """ Rewrite ``From`` and ``Return-Path`` of ``message`` with the
+        account of ``server_id``, or of the first server of the company when
+        no server is given. A server of another company, such as a fallback
+        server, sends with its own account. """
+        servers = self._get_company_mail_servers(company_id)
+        if not servers:
+            return
+        server = next((server for server in servers if server[0] == server_id), None)
+        if server is None and server_id:
+            return_path, from_suffix = self._get_server_account(server_id)
+        else:
+            return_path, from_suffix = (server or servers[0])[1:3]
+        if return_path and 'Return-Path' in message:
+            email_from_user = message['From'].split(' ', 1)[0] or ''
+            message.replace_header('Return-Path', return_path)
+            message.replace_header('From', email_from_user + from_suffix)
 
-    _sql_constraints = [
-        ('smtp_company_uniq', 'unique(default_company)',
-         'That company already has a default server.')
-    ]
+    @api.model
+    def _is_send_deferred(self):
+        """ Whether ``send_email`` only queues the message, for the
+        ``mail_defer_send`` context key or else the
+        ``mail_by_company.defer_send`` parameter. """
+        defer = self.env.context.get('mail_defer_send')
+        if defer is None:
+            defer = self.env['ir.config_parameter'].sudo().get_param('mail_by_company.defer_send')
+        return bool(defer)
+
+    @api.model
+    def build_email(self, email_from, email_to, subject, body, email_cc=None, email_bcc=None, reply_to=False,
+                    attachments=None, message_id=None, references=None, object_id=False, subtype='plain',
+                    headers=None, body_alternative=None, subtype_alternative='plain'):
+        """ With the ``mail_bulk_templates`` context key, a ``BulkTemplates``,
+        the emails built again with the same content are built from a
+        ``BulkMessage``: their body and attachments are serialized once and
+        only their own headers are built. """
+        templates = self.env.context.get('mail_bulk_templates')
+        if templates is None:
+            return super(IrMailServer, self).build_email(
+                email_from, email_to, subject, body, email_cc=email_cc, email_bcc=email_bcc,
+                reply_to=reply_to, attachments=attachments, message_id=message_id,
+                references=references, object_id=object_id, subtype=subtype, headers=headers,
+                body_alternative=body_alternative, subtype_alternative=subtype_alternative)
+        key = (email_from, subject, body, subtype, body_alternative, subtype_alternative, reply_to,
+               tuple(sorted(headers or ())), tuple(tuple(attachment) for attachment in attachments or ()))
+        template = templates.get(key)
+        if template is not None:
+            personal = super(IrMailServer, self).build_email(
+                email_from, email_to, subject, '', email_cc=email_cc, email_bcc=email_bcc,
+                reply_to=reply_to, message_id=message_id, references=references,
+                object_id=object_id, headers=headers)
+            return template.message_for(personal)
+        message = super(IrMailServer, self).build_email(
+            email_from, email_to, subject, body, email_cc=email_cc, email_bcc=email_bcc,
+            reply_to=reply_to, attachments=attachments, message_id=message_id,
+            references=references, object_id=object_id, subtype=subtype, headers=headers,
+            body_alternative=body_alternative, subtype_alternative=subtype_alternative)
+        if templates.seen(key):
+            templates.set(key, BulkMessage(message, personal_headers=('References', 'Date') + tuple(headers or ())))
+        return message
 
     @api.model
     def send_email(self, message, mail_server_id=None,
@@ -36,75 +431,229 @@ class IrMailServer(models.Model):
                    smtp_password=None, smtp_encryption=None,
                    smtp_debug=False, smtp_session=None):
 
-        active_company_id = self.env.company
-        server_id = self.env['ir.mail_server'].search([('default_company', '=', active_company_id.id)], limit=1)
-        email_from_user = message['From'].split(' ', 1)[0] or ''
-        from_value = email_from_user + ' <' + server_id.smtp_user + '>'
-
-        if server_id and server_id[0]:
-            if 'Return-Path' in message:
-                message.replace_header('Return-Path', server_id.smtp_user)
-                message.replace_header('From', from_value)
-        return super(IrMailServer, self).send_email(message, mail_server_id,
-                                                    smtp_server, smtp_port,
-                                                    smtp_user, smtp_password,
-                                                    smtp_encryption,
-                                                    smtp_debug, smtp_session)
+        # mail.mail batches are sent for the company of their emails, other
+        # emails through the next server of the company
+        company_id = self.env.context.get('mail_company_id') or self.env.company.id
+        server_id = getattr(smtp_session, 'mail_by_company_server_id', None) or mail_server_id
+        direct = not smtp_session and not smtp_server
+        if not server_id and direct:
+            server_id = mail_server_id = self._pick_company_server(company_id) or None
+        deferred = direct and not self.env.context.get('mail_deferred_delivery') and self._is_send_deferred()
+        if server_id and direct and not deferred:
+            # a server that is down or whose breaker is open is replaced by
+            # its fallback server rather than waited for
+            available_id = self._get_available_server(server_id)
+            if available_id is None:
+                raise MailDeliveryException(_('Mail server ID #%s is unavailable') % server_id)
+            server_id = mail_server_id = available_id
+        # applied again when delivering a deferred message, which may go
+        # through another server than the one it was queued for
+        self._apply_company_headers(message, company_id, server_id)
+        if deferred:
+            return self.env['mail.deferred.message']._enqueue(message, company_id, server_id)
 
-    def test_smtp_connection(self):
-        for server in self:
-            smtp = False
+        def send():
+            return super(IrMailServer, self).send_email(message, mail_server_id,
+                                                        smtp_server, smtp_port,
+                                                        smtp_user, smtp_password,
+                                                        smtp_encryption,
+                                                        smtp_debug, smtp_session)
+
+        bucket = self._get_throttle_bucket(server_id) if not smtp_server else None
+        _sent_size.value = None
+        message_id = self._send_throttled(send, message['Message-Id'], server_id, company_id, bucket, smtp_session)
+        if metrics_enabled(self.env):
+            mail_metrics.inc('smtp_messages_sent_total', server=server_id, company=company_id)
+            if _sent_size.value:
+                mail_metrics.inc('smtp_bytes_total', _sent_size.value, server=server_id, company=company_id)
+        return message_id
+
+    def _send_throttled(self, send, message_id, server_id, company_id, bucket, smtp_session=None):
+        """ Call ``send()``, which delivers the message ``message_id``, at the
+        pace of the throttle ``bucket`` of the server, slowing down and
+        retrying when the server replies it is throttling. """
+        attempt = 0
+        while True:
+            if bucket is not None:
+                wait = bucket.reserve()
+                if wait:
+                    time.sleep(wait)
             try:
-                smtp = self.connect(mail_server_id=server.id)
-                # simulate sending an email from current user's address - without sending it!
-                email_from, email_to = self.smtp_user, 'noreply@odoo.com'
-                if not email_from:
-                    raise UserError(_('Please configure an email on the current user to simulate '
-                                      'sending an email message via this outgoing server'))
-                # Testing the MAIL FROM step should detect sender filter problems
-                (code, repl) = smtp.mail(email_from)
-                if code != 250:
-                    raise UserError(_('The server refused the sender address (%(email_from)s) '
-                                      'with error %(repl)s') % locals())
-                # Testing the RCPT TO step should detect most relaying problems
-                (code, repl) = smtp.rcpt(email_to)
-                if code not in (250, 251):
-                    raise UserError(_('The server refused the test recipient (%(email_to)s) '
-                                      'with error %(repl)s') % locals())
-                # Beginning the DATA step should detect some deferred rejections
-                # Can't use self.data() as it would actually send the mail!
-                smtp.putcmd("data")
-                (code, repl) = smtp.getreply()
-                if code != 354:
-                    raise UserError(_('The server refused the test connection '
-                                      'with error %(repl)s') % locals())
-            except UserError as e:
-                # let UserErrors (messages) bubble up
-                raise e
-            except (UnicodeError, idna.core.InvalidCodepoint) as e:
-                raise UserError(_("Invalid server name !\n %s", ustr(e)))
-            except (gaierror, timeout) as e:
-                raise UserError(_("No response received. Check server address and port number.\n %s", ustr(e)))
-            except smtplib.SMTPServerDisconnected as e:
-                raise UserError(_(
-                    "The server has closed the connection unexpectedly. Check configuration served on this port number.\n %s",
-                    ustr(e.strerror)))
-            except smtplib.SMTPResponseException as e:
-                raise UserError(_("Server replied with following exception:\n %s", ustr(e.smtp_error)))
-            except smtplib.SMTPException as e:
-                raise UserError(_("An SMTP exception occurred. Check port number and connection security type.\n %s",
-                                  ustr(e.smtp_error)))
-            except SSLError as e:
-                raise UserError(_("An SSL exception occurred. Check connection security type.\n %s", ustr(e)))
-            except Exception as e:
-                raise UserError(_("Connection Test Failed! Here is what we got instead:\n %s", ustr(e)))
-            finally:
+                with stage(self.env, 'smtp_send', server=server_id, company=company_id):
+                    result = send()
+            except MailDeliveryException as exc:
+                count(self.env, 'smtp_failures_total', server=server_id, company=company_id)
+                send_errors = self.env.context.get('mail_send_errors')
+                if send_errors is not None:
+                    send_errors[message_id] = exc
+                if bucket is None or not is_throttling_reply(exc):
+                    raise
+                bucket.throttled()
+                attempt += 1
+                # a closed session (421) cannot be retried, the batch will reconnect
+                if attempt > THROTTLE_RETRIES or (smtp_session is not None and not smtp_session.sock):
+                    raise
+                _logger.info('Mail server ID #%s is throttling, slowing down (retry %s)', server_id, attempt)
+                continue
+            if bucket is not None:
+                bucket.accepted()
+            return result
+
+    @api.model
+    def send_email_bulk(self, message, recipients, mail_server_id=None, smtp_session=None):
+        """ Send ``message`` to many recipients with the same body and
+        attachments, e.g. a mailing built once with ``build_email``. The body
+        is serialized once, the email of each recipient only serializes its
+        own headers and goes through ``send_email``. Without ``smtp_session``,
+        the emails are sent through a pooled session of the server, or of
+        its fallback server while it is unavailable, within its daily cap.
+
+        :param message: ``email.message.Message`` with the common headers,
+            the body and the attachments. Its ``To``, ``Cc``, ``Bcc`` and
+            ``Message-Id`` are ignored.
+        :param recipients: list of dicts of the headers of each recipient,
+            at least ``To``. A ``Message-Id`` is generated when missing.
+        :return: ``(message_ids, failures)``: the Message-Id of each
+            recipient, in order, and the ``MailDeliveryException`` of the
+            emails that could not be sent, by Message-Id
+        """
+        bulk = BulkMessage(message, personal_headers=tuple({name for headers in recipients for name in headers}))
+        messages = []
+        for headers in recipients:
+            personal = EmailMessage(policy=email.policy.SMTP)
+            for name, value in headers.items():
+                if value:
+                    personal[name] = value
+            if 'Message-Id' not in personal:
+                personal['Message-Id'] = make_msgid()
+            messages.append(bulk.message_for(personal))
+        message_ids = [bulk_message['Message-Id'] for bulk_message in messages]
+
+        company_id = self.env.context.get('mail_company_id') or self.env.company.id
+        server_id = getattr(smtp_session, 'mail_by_company_server_id', None) or mail_server_id
+        if not server_id and not smtp_session:
+            server_id = self._pick_company_server(company_id) or None
+        failures = {}
+        if smtp_session is not None or not server_id or self._is_send_deferred():
+            for bulk_message in messages:
                 try:
-                    if smtp:
-                        smtp.close()
+                    self.send_email(bulk_message, mail_server_id=server_id, smtp_session=smtp_session)
+                except MailDeliveryException as exc:
+                    failures[bulk_message['Message-Id']] = exc
+            return message_ids, failures
+
+        available_id = self._get_available_server(server_id)
+        if available_id is None:
+            error = MailDeliveryException(_('Mail server ID #%s is unavailable') % server_id)
+            return message_ids, dict.fromkeys(message_ids, error)
+        server_id = available_id
+        allowed = self._reserve_daily_quota(server_id, len(messages))
+        if allowed < len(messages):
+            error = MailDeliveryException(_('Mail server ID #%s reached its daily cap') % server_id)
+            failures.update(dict.fromkeys(message_ids[allowed:], error))
+        idle_timeout, max_messages = self._get_smtp_pool_limits()
+        pool_key = self._get_smtp_pool_key(server_id)
+        index = sent = 0
+        try:
+            while index < allowed:
+                try:
+                    pooled = smtp_pool.acquire(pool_key, lambda: self._connect_pooled(server_id), idle_timeout)
+                except Exception as exc:
+                    count(self.env, 'smtp_connect_failures_total', server=server_id)
+                    error = MailDeliveryException(_('Unable to connect to SMTP Server'), exc)
+                    failures.update(dict.fromkeys(message_ids[index:allowed], error))
+                    break
+                chunk = messages[index:min(index + max(max_messages - pooled.sent, 1), allowed)]
+                closed = False
+                try:
+                    for bulk_message in chunk:
+                        index += 1
+                        try:
+                            self.send_email(bulk_message, mail_server_id=server_id, smtp_session=pooled.session)
+                        except MailDeliveryException as exc:
+                            failures[bulk_message['Message-Id']] = exc
+                            # the server closed the session, open another one
+                            closed = pooled.session is not None and not pooled.session.sock
+                            if closed:
+                                break
+                        else:
+                            pooled.sent += 1
+                            sent += 1
                 except Exception:
-                    # ignored, just a consequence of the previous exception
-                    pass
+                    smtp_pool.discard(pooled)
+                    raise
+                if closed:
+                    smtp_pool.discard(pooled)
+                else:
+                    smtp_pool.release(pooled, max_messages, max_idle=self._get_max_connections(server_id))
+        finally:
+            # the emails not sent do not count against the daily cap
+            self._release_daily_quota(server_id, allowed - sent)
+        _logger.info('Sent %s bulk emails via mail server ID #%s, %s failed',
+                     len(messages) - len(failures), server_id, len(failures))
+        return message_ids, failures
+
+    def _check_smtp_connection(self, email_from=None):
+        """ Connect to the server and simulate sending an email (MAIL FROM,
+        RCPT TO and DATA) without sending it. Raise a UserError describing
+        the problem if any. """
+        self.ensure_one()
+        smtp = False
+        try:
+            smtp = self.with_context(mail_smtp_probe=True).connect(mail_server_id=self.id)
+            # simulate sending an email from current user's address - without sending it!
+            email_from, email_to = email_from or self.smtp_user, 'noreply@odoo.com'
+            if not email_from:
+                raise UserError(_('Please configure an email on the current user to simulate '
+                                  'sending an email message via this outgoing server'))
+            # Testing the MAIL FROM step should detect sender filter problems
+            (code, repl) = smtp.mail(email_from)
+            if code != 250:
+                raise UserError(_('The server refused the sender address (%(email_from)s) '
+                                  'with error %(repl)s') % locals())
+            # Testing the RCPT TO step should detect most relaying problems
+            (code, repl) = smtp.rcpt(email_to)
+            if code not in (250, 251):
+                raise UserError(_('The server refused the test recipient (%(email_to)s) '
+                                  'with error %(repl)s') % locals())
+            # Beginning the DATA step should detect some deferred rejections
+            # Can't use self.data() as it would actually send the mail!
+            smtp.putcmd("data")
+            (code, repl) = smtp.getreply()
+            if code != 354:
+                raise UserError(_('The server refused the test connection '
+                                  'with error %(repl)s') % locals())
+        except UserError as e:
+            # let UserErrors (messages) bubble up
+            raise e
+        except (UnicodeError, idna.core.InvalidCodepoint) as e:
+            raise UserError(_("Invalid server name !\n %s", ustr(e)))
+        except (gaierror, timeout) as e:
+            raise UserError(_("No response received. Check server address and port number.\n %s", ustr(e)))
+        except smtplib.SMTPServerDisconnected as e:
+            raise UserError(_(
+                "The server has closed the connection unexpectedly. Check configuration served on this port number.\n %s",
+                ustr(e.strerror)))
+        except smtplib.SMTPResponseException as e:
+            raise UserError(_("Server replied with following exception:\n %s", ustr(e.smtp_error)))
+        except smtplib.SMTPException as e:
+            raise UserError(_("An SMTP exception occurred. Check port number and connection security type.\n %s",
+                              ustr(e.smtp_error)))
+        except SSLError as e:
+            raise UserError(_("An SSL exception occurred. Check connection security type.\n %s", ustr(e)))
+        except Exception as e:
+            raise UserError(_("Connection Test Failed! Here is what we got instead:\n %s", ustr(e)))
+        finally:
+            try:
+                if smtp:
+                    smtp.close()
+            except Exception:
+                # ignored, just a consequence of the previous exception
+                pass
+
+    def test_smtp_connection(self):
+        for server in self:
+            server._check_smtp_connection()
 
         title = _("Connection Test Succeeded!")
         message = _("Everything seems properly set up!")
@@ -119,40 +668,494 @@ class IrMailServer(models.Model):
         }
 
 
+    @api.model
+    def _cron_check_smtp_health(self):
+        """ Probe every active outgoing server and record its health, which
+        ``mail.mail`` uses to skip dead servers or fail over to their
+        fallback server. The health fields are updated in SQL so that the
+        pooled sessions of the servers stay valid. """
+        changed = False
+        for server in self.sudo().search([]):
+            email_from = server.smtp_user or server.with_context(
+                mail_company_id=server.default_company.id)._get_default_bounce_address()
+            if not email_from:
+                # nothing to probe with, the breaker still protects the sending
+                continue
+            try:
+                server._check_smtp_connection(email_from)
+            except UserError as e:
+                error = ustr(e.args[0] if e.args else e)
+                state, failures = 'down', server.health_failures + 1
+                _logger.warning('Health check of mail server %s (#%s) failed: %s', server.name, server.id, error)
+            else:
+                error, state, failures = False, 'ok', 0
+                self._get_breaker(server.id).success()
+            changed = changed or state != server.health_state
+            self.env.cr.execute("""
+                UPDATE ir_mail_server
+                   SET health_state = %s, health_failures = %s, health_error = %s, health_checked_at = %s
+                 WHERE id = %s
+            """, [state, failures, error or None, fields.Datetime.now(), server.id])
+            count(self.env, 'smtp_health_checks_total', server=server.id, state=state)
+        self.invalidate_cache(list(HEALTH_FIELDS))
+        if changed:
+            self.clear_caches()
+
+
 class MailMail(models.Model):
     _inherit = "mail.mail"
 
+    company_id = fields.Many2one(
+        'res.company', string='Company', compute='_compute_company_id', store=True, index=True,
+        help="Company whose outgoing server sends this email, taken from the related "
+             "document or else from the author.")
+    mail_priority = fields.Selection(
+        MAIL_PRIORITIES, string='Priority', default='normal', required=True, index=True,
+        help="Lane of the outgoing queue: transactional emails are sent first, bulk "
+             "emails (mass mailing) get a small share of each run of the queue.")
+    retry_count = fields.Integer(
+        'Retries', readonly=True, copy=False,
+        help="Number of times the email was rescheduled after a transient failure.")
+    retry_server_id = fields.Many2one(
+        'ir.mail_server', string='Retried Server', readonly=True, copy=False, index=True, ondelete='set null',
+        help="Server whose transient failure rescheduled the email.")
+
+    def init(self):
+        # outgoing emails by lane and company, read by _get_fair_queue_ids
+        if not tools.index_exists(self._cr, 'mail_mail_outgoing_queue_index'):
+            self._cr.execute("""
+                CREATE INDEX mail_mail_outgoing_queue_index
+                          ON mail_mail (mail_priority, company_id, id)
+                       WHERE state = 'outgoing'
+            """)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        transactional_models = None
+        for vals in vals_list:
+            if vals.get('mail_priority') or self.env.context.get('default_mail_priority'):
+                continue
+            if transactional_models is None:
+                transactional_models = self._get_transactional_models()
+            if vals.get('model') in transactional_models:
+                vals['mail_priority'] = 'transactional'
+        return super(MailMail, self).create(vals_list)
+
+    @api.model
+    def _get_transactional_models(self):
+        """ Models whose emails go to the transactional lane by default. """
+        models_param = self.env['ir.config_parameter'].sudo().get_param(
+            'mail_by_company.transactional_models', TRANSACTIONAL_MODELS)
+        return {model.strip() for model in models_param.split(',') if model.strip()}
+
+    @api.model
+    def process_email_queue(self, ids=None):
+        """ Send the outgoing emails picked by ``_get_fair_queue_ids``. """
+        if 'filters' in self._context:
+            return super(MailMail, self).process_email_queue(ids=ids)
+        queue_ids = self._get_fair_queue_ids()
+        if ids:
+            ids = set(ids)
+            queue_ids = [mail_id for mail_id in queue_ids if mail_id in ids]
+        res = None
+        try:
+            # auto-commit except in testing mode
+            auto_commit = not getattr(threading.current_thread(), 'testing', False)
+            mails = self.browse(queue_ids)
+            if auto_commit:
+                # the emails may be sent from other threads and cursors, which
+                # only see committed emails and must not wait on our locks
+                self.env.cr.commit()
+                mails = mails.with_context(mail_send_committed=True)
+            res = mails.send(auto_commit=auto_commit)
+        except Exception:
+            _logger.exception("Failed processing mail queue")
+        return res
+
+    @api.model
+    def _get_fair_queue_ids(self, limit=QUEUE_LIMIT):
+        """ Return up to ``limit`` ids of emails ready to be sent, picked by
+        weighted fair queuing: the emails of each (lane, company) are taken
+        in turn, each lane getting a share of the run proportional to its
+        weight. A large bulk send of a company therefore never delays the
+        transactional emails, nor the emails of the other companies. """
+        self.flush(['state', 'scheduled_date', 'mail_priority', 'company_id'])
+        self.env.cr.execute("""
+            SELECT id
+              FROM (SELECT id, mail_priority,
+                           row_number() OVER (PARTITION BY mail_priority, company_id ORDER BY id) AS position
+                      FROM mail_mail
+                     WHERE state = 'outgoing'
+                       AND (scheduled_date < %(now)s OR scheduled_date IS NULL)) queue
+          ORDER BY position::float / (CASE mail_priority
+                                          WHEN 'transactional' THEN %(transactional)s
+                                          WHEN 'normal' THEN %(normal)s
+                                          ELSE %(bulk)s
+                                      END),
+                   id
+             LIMIT %(limit)s
+        """, dict(MAIL_PRIORITY_WEIGHTS, now=fields.Datetime.to_string(fields.Datetime.now()), limit=limit))
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    @api.depends('model', 'res_id', 'author_id')
+    def _compute_company_id(self):
+        records_by_model = defaultdict(set)
+        for mail in self:
+            if mail.model and mail.res_id and mail.model in self.env:
+                records_by_model[mail.model].add(mail.res_id)
+        record_companies = {}
+        for model, res_ids in records_by_model.items():
+            Model = self.env[model].sudo()
+            if 'company_id' not in Model._fields or Model._fields['company_id'].comodel_name != 'res.company':
+                continue
+            for record in Model.browse(res_ids).exists():
+                record_companies[(model, record.id)] = record.company_id.id
+        for mail in self:
+            company_id = record_companies.get((mail.model, mail.res_id))
+            if not company_id and mail.author_id:
+                author = mail.author_id.sudo()
+                company_id = author.user_ids[:1].company_id.id or author.company_id.id
+            mail.company_id = company_id or False
+
+    def _split_by_company_server(self):
+        """ Group the emails by company and spread them over the outgoing
+        servers of that company by weighted round-robin, within the capacity
+        of each server. Companies without server use the emails' own server.
+        Batches are yielded by priority lane, and higher lanes are served
+        first when the capacity of the servers is reached.
+
+        :return: generator of ``(company_id, server_id, batch_ids)``
+        """
+        IrMailServer = self.env['ir.mail_server']
+        default_company_id = self.env.company.id
+        company_mails = defaultdict(list)
+        lanes = {}
+        # Turn prefetch OFF to avoid MemoryError on very large mail queues
+        for mail in self.with_context(prefetch_fields=False):
+            company_mails[mail.company_id.id or default_company_id].append((mail.id, mail.mail_server_id.id))
+            lanes[mail.id] = MAIL_PRIORITY_RANKS.get(mail.mail_priority, 1)
+
+        groups = defaultdict(list)
+        for company_id, mails in company_mails.items():
+            mails.sort(key=lambda mail: lanes[mail[0]])
+            servers = IrMailServer._get_company_balanced_servers(company_id)
+            if not servers:
+                for mail_id, mail_server_id in mails:
+                    groups[(lanes[mail_id], company_id, mail_server_id)].append(mail_id)
+                continue
+            balancer = smtp_balancers.get((self.env.cr.dbname, company_id))
+            assigned, leftover = balancer.distribute([mail_id for mail_id, _server_id in mails], servers)
+            for server_id, mail_ids in assigned.items():
+                for mail_id in mail_ids:
+                    groups[(lanes[mail_id], company_id, server_id)].append(mail_id)
+            if leftover:
+                _logger.info('Mail servers of company ID #%s reached their capacity, %s emails postponed',
+                             company_id, len(leftover))
+
+        batch_size = int(self.env['ir.config_parameter'].sudo().get_param('mail.session.batch.size', 1000))
+        for (_lane, company_id, server_id), record_ids in sorted(groups.items(), key=lambda item: item[0][0]):
+            for batch_ids in tools.split_every(batch_size, record_ids):
+                yield company_id, server_id, batch_ids
+
     def send(self, auto_commit=False, raise_exception=False):
-        for server_id, batch_ids in self._split_by_server():
-            smtp_session = None
+        with stage(self.env, 'mail_split'):
+            batches = list(self._split_by_company_server())
+        queues = defaultdict(list)
+        for company_id, server_id, batch_ids in batches:
+            queues[company_id].append((company_id, server_id, batch_ids))
 
+        workers = int(self.env['ir.config_parameter'].sudo().get_param('mail_by_company.send_workers', SEND_WORKERS))
+        workers = min(workers, thread_cursor_budget())
+        # companies are only dispatched in parallel by the mail queue, once the
+        # emails are committed: the worker cursors cannot see uncommitted
+        # emails and would wait on the locks of the calling transaction
+        if auto_commit and self.env.context.get('mail_send_committed') and workers > 1 and len(queues) > 1 \
+                and not getattr(threading.current_thread(), 'testing', False):
+            self._send_concurrently(list(queues.values()), workers, raise_exception)
+        else:
+            for company_id, server_id, batch_ids in batches:
+                self.browse(batch_ids).with_context(mail_company_id=company_id)._send_batch(
+                    server_id, auto_commit=auto_commit, raise_exception=raise_exception)
+        _logger.debug('SMTP connection pool: %s', smtp_pool.stats())
 
-            # active_company_id = self.env['res.users'].browse(self._context.get('uid') or self.env.user).company_id
-            active_company_id = self.env.company
-            company_server_id = self.env['ir.mail_server'].search([('default_company', '=', active_company_id.id)],limit=1)
-            server_id = company_server_id and company_server_id.id or server_id
-            try:
-                smtp_session = self.env['ir.mail_server'].connect(mail_server_id=server_id)
-            except Exception as exc:
+    def _send_concurrently(self, queues, workers, raise_exception):
+        """ Send each company queue on a bounded pool of threads, each thread
+        using its own cursor. The cursors left by the threads within
+        ``thread_cursor_budget`` are shared between them for the parallel
+        sessions of their batches. """
+        workers = min(workers, len(queues))
+        dbname, uid = self.env.cr.dbname, self.env.uid
+        context = dict(self.env.context, mail_cursor_budget=max(thread_cursor_budget() - workers, 0) // workers)
+
+        def send_queue(queue):
+            threading.current_thread().dbname = dbname
+            with api.Environment.manage(), registry(dbname).cursor() as cr:
+                MailMail = api.Environment(cr, uid, context)['mail.mail']
+                for company_id, server_id, batch_ids in queue:
+                    MailMail.browse(batch_ids).with_context(mail_company_id=company_id)._send_batch(
+                        server_id, auto_commit=True, raise_exception=raise_exception)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(send_queue, queue) for queue in queues]
+        # the emails were updated by other transactions
+        self.invalidate_cache()
+        for future in futures:
+            exc = future.exception()
+            if exc is not None:
                 if raise_exception:
-                    # To be consistent and backward compatible with mail_mail.send() raised
-                    # exceptions, it is encapsulated into an Odoo MailDeliveryException
-                    raise MailDeliveryException(_('Unable to connect to SMTP Server'), exc)
-                else:
-                    batch = self.browse(batch_ids)
-                    batch.write({'state': 'exception', 'failure_reason': exc})
-                    batch._postprocess_sent_message(success_pids=[], failure_type="SMTP")
-            else:
-                self.browse(batch_ids)._send(
-                    auto_commit=auto_commit,
-                    raise_exception=raise_exception,
-                    smtp_session=smtp_session)
+                    raise exc
+                _logger.error('Failed to send a company mail queue: %s', exc, exc_info=exc)
+
+    def _send_batch(self, server_id, auto_commit=False, raise_exception=False):
+        """ Send the emails of ``self`` through ``server_id`` with pooled SMTP
+        sessions. """
+        IrMailServer = self.env['ir.mail_server']
+        max_messages = IrMailServer._get_smtp_pool_limits()[1]
+
+        # a dead server is skipped right away, its emails stay outgoing
+        available_id = IrMailServer._get_available_server(server_id)
+        if available_id is None:
+            if raise_exception:
+                raise MailDeliveryException(_('Mail server ID #%s is unavailable') % server_id)
+            _logger.info('Mail server ID #%s is unavailable, %s emails postponed', server_id, len(self.ids))
+            count(self.env, 'smtp_unavailable_total', len(self.ids), server=server_id)
+            return
+        if available_id != server_id:
+            _logger.info('Mail server ID #%s is unavailable, failing over to mail server ID #%s',
+                         server_id, available_id)
+            server_id = available_id
+        remaining_ids = list(self.ids)
+
+        # large batches of the mail queue are split over several sessions to
+        # the same server, each one in its own thread and cursor but the first
+        # one, within the cursors left to this thread
+        cursor_budget = self.env.context.get('mail_cursor_budget')
+        if cursor_budget is None:
+            cursor_budget = thread_cursor_budget()
+        connections = min(IrMailServer._get_max_connections(server_id), len(remaining_ids) // max_messages + 1,
+                          cursor_budget + 1)
+        if auto_commit and connections > 1 and self.env.context.get('mail_send_committed') \
+                and not getattr(threading.current_thread(), 'testing', False):
+            self._send_parallel_sessions(server_id, remaining_ids, connections, raise_exception)
+        else:
+            self._send_pooled(server_id, remaining_ids, auto_commit=auto_commit, raise_exception=raise_exception)
+
+    def _send_parallel_sessions(self, server_id, mail_ids, connections, raise_exception):
+        """ Send ``mail_ids`` through ``connections`` sessions to ``server_id``
+        at once: one on the current thread and cursor, the others on their own
+        thread and cursor. Each thread commits the state of its emails. """
+        dbname, uid, context = self.env.cr.dbname, self.env.uid, dict(self.env.context)
+
+        def send_slice(slice_ids):
+            threading.current_thread().dbname = dbname
+            with api.Environment.manage(), registry(dbname).cursor() as cr:
+                MailMail = api.Environment(cr, uid, context)['mail.mail']
+                MailMail.browse(slice_ids)._send_pooled(server_id, slice_ids, auto_commit=True,
+                                                        raise_exception=raise_exception)
+
+        slices = [mail_ids[index::connections] for index in range(connections)]
+        executor = ThreadPoolExecutor(max_workers=connections - 1)
+        futures = [executor.submit(send_slice, slice_ids) for slice_ids in slices[1:] if slice_ids]
+        try:
+            self.browse(slices[0])._send_pooled(server_id, slices[0], auto_commit=True,
+                                                raise_exception=raise_exception)
+        finally:
+            executor.shutdown(wait=True)
+            # the emails were updated by other transactions
+            self.invalidate_cache()
+        for future in futures:
+            exc = future.exception()
+            if exc is not None:
+                if raise_exception:
+                    raise exc
+                _logger.error('Failed to send emails via mail server ID #%s: %s', server_id, exc, exc_info=exc)
+
+    def _send_pooled(self, server_id, remaining_ids, auto_commit=False, raise_exception=False):
+        """ Send the emails ``remaining_ids`` through ``server_id`` with pooled
+        SMTP sessions, failing over to the fallback server when it becomes
+        unavailable. The daily quota of the server is reserved for the
+        emails, and the part of it not used by delivered emails given back. """
+        IrMailServer = self.env['ir.mail_server']
+        idle_timeout, max_messages = IrMailServer._get_smtp_pool_limits()
+        # sessions are kept open between batches and cron runs, a session
+        # is renewed once it sent max_messages emails
+        pool_key = IrMailServer._get_smtp_pool_key(server_id)
+        remaining_ids = self._reserve_server_quota(server_id, remaining_ids)
+        # the emails of the batch with the same content share its serialization
+        templates = BulkTemplates()
+        # quota reserved on server_id and used by the emails delivered so far
+        reserved, delivered = len(remaining_ids), 0
+        try:
+            while remaining_ids:
+                try:
+                    pooled = smtp_pool.acquire(
+                        pool_key, lambda: IrMailServer._connect_pooled(server_id), idle_timeout)
+                except Exception as exc:
+                    count(self.env, 'smtp_connect_failures_total', server=server_id)
+                    available_id = IrMailServer._get_available_server(server_id)
+                    if available_id is not None and available_id != server_id:
+                        _logger.info('Mail server ID #%s is unavailable, failing over to mail server ID #%s',
+                                     server_id, available_id)
+                        IrMailServer._release_daily_quota(server_id, reserved - delivered)
+                        reserved = delivered = 0
+                        server_id = available_id
+                        pool_key = IrMailServer._get_smtp_pool_key(server_id)
+                        remaining_ids = self._reserve_server_quota(server_id, remaining_ids)
+                        reserved = len(remaining_ids)
+                        continue
+                    if available_id is None and raise_exception:
+                        raise MailDeliveryException(_('Mail server ID #%s is unavailable') % server_id, exc)
+                    if available_id is None:
+                        # the breaker opened, the emails are retried at the next run
+                        _logger.info('Mail server ID #%s is unavailable, %s emails postponed',
+                                     server_id, len(remaining_ids))
+                        break
+                    if raise_exception:
+                        # To be consistent and backward compatible with mail_mail.send() raised
+                        # exceptions, it is encapsulated into an Odoo MailDeliveryException
+                        raise MailDeliveryException(_('Unable to connect to SMTP Server'), exc)
+                    else:
+                        batch = self.browse(remaining_ids)
+                        if is_transient_failure(exc):
+                            batch = batch._schedule_retry(server_id, exc)
+                        if batch:
+                            batch.write({'state': 'exception', 'failure_reason': exc})
+                            batch._postprocess_sent_message(success_pids=[], failure_type="SMTP")
+                    break
+
+                chunk_ids = remaining_ids[:max(max_messages - pooled.sent, 1)]
+                remaining_ids = remaining_ids[len(chunk_ids):]
+                send_errors = {}
+                try:
+                    with stage(self.env, 'mail_send_batch', server=server_id,
+                               company=self.env.context.get('mail_company_id')):
+                        self.browse(chunk_ids).with_context(
+                            mail_send_errors=send_errors, mail_bulk_templates=templates)._send(
+                            auto_commit=auto_commit,
+                            raise_exception=raise_exception,
+                            smtp_session=pooled.session)
+                except smtplib.SMTPServerDisconnected as exc:
+                    # the server dropped the session: the unsent emails are retried later
+                    smtp_pool.discard(pooled)
+                    if raise_exception:
+                        raise
+                    delivered += len(chunk_ids) - len(self._filter_unsent(chunk_ids))
+                    unsent = self.browse(chunk_ids + remaining_ids).filtered(lambda mail: mail.state == 'outgoing')
+                    unsent._schedule_retry(server_id, exc).write({'state': 'exception', 'failure_reason': ustr(exc)})
+                    break
+                except Exception:
+                    # the session may be in an unknown state, never reuse it
+                    smtp_pool.discard(pooled)
+                    raise
+                delivered += len(chunk_ids) - len(self._filter_unsent(chunk_ids))
+                if send_errors:
+                    self._retry_transient_failures(server_id, chunk_ids, send_errors)
+                pooled.sent += len(chunk_ids)
+                smtp_pool.release(pooled, max_messages, max_idle=IrMailServer._get_max_connections(server_id))
                 _logger.info(
                     'Sent batch %s emails via mail server ID #%s',
-                    len(batch_ids), server_id)
-            finally:
-                if smtp_session:
-                    smtp_session.quit()
+                    len(chunk_ids), server_id)
+        finally:
+            # emails not delivered do not count against the daily quota
+            IrMailServer._release_daily_quota(server_id, reserved - delivered)
+
+    def _filter_unsent(self, mail_ids):
+        """ Emails of ``mail_ids`` still waiting after ``_send``, the sent
+        ones being either marked as such or deleted. """
+        return self.browse(mail_ids).exists().filtered(lambda mail: mail.state != 'sent')
+
+    def _retry_transient_failures(self, server_id, mail_ids, send_errors):
+        """ Reschedule the emails of ``mail_ids`` that ``_send`` put in
+        exception because of a transient SMTP failure, recorded by
+        ``send_email`` in ``send_errors`` (by Message-Id). """
+        failed = self.browse(mail_ids).filtered(
+            lambda mail: mail.state == 'exception' and mail.message_id in send_errors
+            and is_transient_failure(send_errors[mail.message_id]))
+        if failed:
+            failed._schedule_retry(server_id, send_errors[failed[0].message_id])
+
+    def _schedule_retry(self, server_id, exc):
+        """ Put the emails back in the queue after a transient failure of
+        ``server_id``, with an exponential backoff on their number of retries
+        and a random jitter. The retries of a server are spread at
+        ``mail_by_company.retry_release_rate`` emails per minute after the
+        ones already queued for it by previous batches, so that a backlog
+        drains progressively once the server is back.
+
+        :return: the emails that exhausted their retries, left to the caller
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        max_retries = int(get_param('mail_by_company.retry_max', RETRY_MAX))
+        base_delay = int(get_param('mail_by_company.retry_base_delay', RETRY_BASE_DELAY))
+        max_delay = int(get_param('mail_by_company.retry_max_delay', RETRY_MAX_DELAY))
+        release_rate = max(int(get_param('mail_by_company.retry_release_rate', RETRY_RELEASE_RATE)), 1)
+
+        to_retry = self.filtered(lambda mail: mail.retry_count < max_retries)
+        if not to_retry:
+            return self
+        now = fields.Datetime.now()
+        interval = timedelta(seconds=60.0 / release_rate)
+        next_slot = now
+        if server_id:
+            self.flush(['state', 'scheduled_date', 'retry_server_id'])
+            self.env.cr.execute("""
+                SELECT MAX(scheduled_date)
+                  FROM mail_mail
+                 WHERE state = 'outgoing' AND retry_server_id = %s
+            """, [server_id])
+            last_retry = self.env.cr.fetchone()[0]
+            if last_retry:
+                next_slot = max(now, fields.Datetime.to_datetime(last_retry) + interval)
+        rnd = random.Random()
+        mail_ids, retry_counts, scheduled_dates = [], [], []
+        for mail in to_retry:
+            retry_count = mail.retry_count + 1
+            # equal jitter: between half and the whole of the backoff delay
+            delay = min(max_delay, base_delay * 2 ** (retry_count - 1))
+            scheduled_date = max(now + timedelta(seconds=rnd.uniform(delay / 2.0, delay)), next_slot)
+            next_slot = scheduled_date + interval
+            mail_ids.append(mail.id)
+            retry_counts.append(retry_count)
+            scheduled_dates.append(fields.Datetime.to_string(scheduled_date))
+        self.env.cr.execute("""
+            UPDATE mail_mail mail
+               SET state = 'outgoing',
+                   retry_count = retry.retry_count,
+                   retry_server_id = %s,
+                   scheduled_date = retry.scheduled_date,
+                   failure_reason = %s
+              FROM unnest(%s::int[], %s::int[], %s::varchar[]) AS retry(id, retry_count, scheduled_date)
+             WHERE mail.id = retry.id
+        """, [server_id or None, ustr(exc), mail_ids, retry_counts, scheduled_dates])
+        # the failure must not stay visible on the notifications meanwhile
+        self.env['mail.notification'].sudo().search([
+            ('mail_id', 'in', mail_ids), ('notification_status', '=', 'exception'),
+        ]).write({'notification_status': 'ready', 'failure_type': False, 'failure_reason': False})
+        self.invalidate_cache(['state', 'retry_count', 'retry_server_id', 'scheduled_date', 'failure_reason'], mail_ids)
+        _logger.info('Mail server ID #%s failed (%s), %s emails rescheduled', server_id, exc, len(mail_ids))
+        count(self.env, 'mail_retries_total', len(mail_ids), server=server_id)
+        return self - to_retry
+
+    def _reserve_server_quota(self, server_id, mail_ids):
+        """ Return the ids of ``mail_ids`` allowed by the daily cap of
+        ``server_id``, the other emails stay outgoing. """
+        allowed = self.env['ir.mail_server']._reserve_daily_quota(server_id, len(mail_ids))
+        if allowed < len(mail_ids):
+            _logger.info('Mail server ID #%s reached its daily cap, %s emails postponed',
+                         server_id, len(mail_ids) - allowed)
+        return mail_ids[:allowed]
+
+
+class MailComposer(models.TransientModel):
+    _inherit = 'mail.compose.message'
+
+    def get_mail_values(self, res_ids):
+        """ Emails of mass mailings go to the bulk lane of the queue. """
+        results = super(MailComposer, self).get_mail_values(res_ids)
+        if self.composition_mode == 'mass_mail':
+            for values in results.values():
+                values.setdefault('mail_priority', 'bulk')
+        return results
 
 
 class MailThread(models.AbstractModel):
@@ -165,65 +1168,485 @@ class MailThread(models.AbstractModel):
         original_partner_ids = message_dict.pop('partner_ids', [])
         thread_id = False
         for model, thread_id, custom_values, user_id, alias in routes or ():
-            subtype_id = False
-            related_user = self.env['res.users'].browse(user_id)
-            Model = self.env[model].with_context(mail_create_nosubscribe=True, mail_create_nolog=True)
-            if not (thread_id and hasattr(Model, 'message_update') or hasattr(Model, 'message_new')):
-                raise ValueError(
-                    "Undeliverable mail with Message-Id %s, model %s does not accept incoming emails" %
-                    (message_dict['message_id'], model)
-                )
+            thread, subtype_id = self._message_route_get_thread(message_dict, model, thread_id, custom_values, user_id, alias)
+            thread_id = thread.id
+            self._message_route_post(thread, message_dict, subtype_id, original_partner_ids)
+            count(self.env, 'inbound_messages_total', model=model, domain=alias and alias.alias_domain or None)
+        return thread_id
+
+    @api.model
+    def _message_route_model(self, model, user_id):
+        Model = self.env[model].with_context(mail_create_nosubscribe=True, mail_create_nolog=True)
+        # disabled subscriptions during message_new/update to avoid having the system user running the
+        # email gateway become a follower of all inbound messages
+        return Model.with_user(self.env['res.users'].browse(user_id)).sudo()
 
-            # disabled subscriptions during message_new/update to avoid having the system user running the
-            # email gateway become a follower of all inbound messages
-            ModelCtx = Model.with_user(related_user).sudo()
-            if thread_id and hasattr(ModelCtx, 'message_update'):
-                thread = ModelCtx.browse(thread_id)
+    @api.model
+    def _message_route_get_thread(self, message_dict, model, thread_id, custom_values, user_id, alias):
+        """ Update or create the thread targeted by a route, return it with
+        the subtype to post the message with (False for updates). """
+        ModelCtx = self._message_route_model(model, user_id)
+        if not (thread_id and hasattr(ModelCtx, 'message_update') or hasattr(ModelCtx, 'message_new')):
+            raise ValueError(
+                "Undeliverable mail with Message-Id %s, model %s does not accept incoming emails" %
+                (message_dict['message_id'], model)
+            )
+
+        if thread_id and hasattr(ModelCtx, 'message_update'):
+            thread = ModelCtx.browse(thread_id)
+            with stage(self.env, 'route_message_update', model=model):
                 thread.message_update(message_dict)
+            return thread, False
+
+        # if a new thread is created, parent is irrelevant
+        message_dict.pop('parent_id', None)
+        # threads created in bulk by message_process_batch
+        created = self.env.context.get('mail_route_threads')
+        key = _route_thread_key(message_dict, model, user_id, alias)
+        if created and created.get(key):
+            return created[key].pop(0)
+        with stage(self.env, 'route_message_new', model=model):
+            thread = ModelCtx.message_new(message_dict, custom_values)
+            self._message_route_set_company(thread, alias)
+        return thread, thread._creation_subtype().id
+
+    @api.model
+    def _message_route_set_company(self, threads, alias):
+        """ Assign new threads to the company of ``alias``, or the one owning
+        its domain. """
+        if not alias or 'company_id' not in threads._fields:
+            return
+        if alias.alias_company_id:
+            threads.sudo().write({'company_id': alias.alias_company_id.id})
+            return
+        if not alias.alias_domain:
+            return
+        routing_index = self.env['mail.alias']._get_routing_index()
+        company_ids = routing_index['companies'].get(alias.alias_domain.strip().lower())
+        if company_ids:
+            threads.sudo().write({'company_id': company_ids[0]})
+
+    @api.model
+    def _message_route_post(self, thread, message_dict, subtype_id, original_partner_ids):
+        # replies to internal message are considered as notes, but parent message
+        # author is added in recipients to ensure he is notified of a private answer
+        parent_message = False
+        if message_dict.get('parent_id'):
+            parent_message = self.env['mail.message'].sudo().browse(message_dict['parent_id'])
+        partner_ids = []
+        if not subtype_id:
+            if message_dict.get('is_internal'):
+                subtype_id = self.env['ir.model.data'].xmlid_to_res_id('mail.mt_note')
+                if parent_message and parent_message.author_id:
+                    partner_ids = [parent_message.author_id.id]
             else:
-                # if a new thread is created, parent is irrelevant
-                message_dict.pop('parent_id', None)
-                thread = ModelCtx.message_new(message_dict, custom_values)
-
-
-                company_id = self.env['res.company'].search([('company_domain', '=', alias.alias_domain)])
-                thread.sudo().write({'company_id': company_id.id})
-
-                
-                thread_id = thread.id
-                subtype_id = thread._creation_subtype().id
-
-            # replies to internal message are considered as notes, but parent message
-            # author is added in recipients to ensure he is notified of a private answer
-            parent_message = False
-            if message_dict.get('parent_id'):
-                parent_message = self.env['mail.message'].sudo().browse(message_dict['parent_id'])
-            partner_ids = []
-            if not subtype_id:
-                if message_dict.get('is_internal'):
-                    subtype_id = self.env['ir.model.data'].xmlid_to_res_id('mail.mt_note')
-                    if parent_message and parent_message.author_id:
-                        partner_ids = [parent_message.author_id.id]
-                else:
-                    subtype_id = self.env['ir.model.data'].xmlid_to_res_id('mail.mt_comment')
+                subtype_id = self.env['ir.model.data'].xmlid_to_res_id('mail.mt_comment')
 
-            post_params = dict(subtype_id=subtype_id, partner_ids=partner_ids, **message_dict)
-            # remove computational values not stored on mail.message and avoid warnings when creating it
-            for x in ('from', 'to', 'cc', 'recipients', 'references', 'in_reply_to', 'bounced_email', 'bounced_message', 'bounced_msg_id', 'bounced_partner'):
-                post_params.pop(x, None)
-            new_msg = False
+        post_params = dict(subtype_id=subtype_id, partner_ids=partner_ids, **message_dict)
+        # remove computational values not stored on mail.message and avoid warnings when creating it
+        for x in ('from', 'to', 'cc', 'recipients', 'references', 'in_reply_to', 'bounced_email', 'bounced_message', 'bounced_msg_id', 'bounced_partner'):
+            post_params.pop(x, None)
+        # attachments spooled by message_parse are copied for each route as
+        # pending attachments of the routed user, which message_post binds to
+        # the thread; the copies share the stored files of the spooled ones,
+        # left to the garbage collection
+        spooled_attachments = self.env['ir.attachment'].sudo().browse(post_params.pop('attachment_ids', None) or [])
+        attachments = self.env['ir.attachment']
+        for attachment in spooled_attachments.with_user(thread.env.uid).sudo():
+            attachments |= attachment.copy({'description': False})
+        if attachments and thread._name != 'mail.thread':
+            post_params['attachment_ids'] = attachments.ids
+        new_msg = False
+        with stage(self.env, 'route_message_post', model=thread._name):
             if thread._name == 'mail.thread':  # message with parent_id not linked to record
                 new_msg = thread.message_notify(**post_params)
+                if new_msg and attachments:
+                    attachments.write({'res_model': 'mail.message', 'res_id': new_msg.id})
+                    new_msg.sudo().write({'attachment_ids': [(4, attachment_id) for attachment_id in attachments.ids]})
             else:
                 # parsing should find an author independently of user running mail gateway, and ensure it is not odoobot
                 partner_from_found = message_dict.get('author_id') and message_dict['author_id'] != self.env['ir.model.data'].xmlid_to_res_id('base.partner_root')
                 thread = thread.with_context(mail_create_nosubscribe=not partner_from_found)
                 new_msg = thread.message_post(**post_params)
 
-            if new_msg and original_partner_ids:
-                # postponed after message_post, because this is an external message and we don't want to create
-                # duplicate emails due to notifications
-                new_msg.write({'partner_ids': original_partner_ids})
-        return thread_id
-        
+        if new_msg and original_partner_ids:
+            # postponed after message_post, because this is an external message and we don't want to create
+            # duplicate emails due to notifications
+            new_msg.write({'partner_ids': original_partner_ids})
+        return new_msg
+
+    # ------------------------------------------------------------
+    # ATTACHMENT SPOOLING
+    # ------------------------------------------------------------
+
+    @api.model
+    def message_process(self, model, message, custom_values=None,
+                        save_original=False, strip_attachments=False,
+                        thread_id=None):
+        # large attachments are dropped while parsing instead of being spooled
+        return super(MailThread, self.with_context(mail_strip_attachments=strip_attachments)).message_process(
+            model, message, custom_values=custom_values, save_original=save_original,
+            strip_attachments=strip_attachments, thread_id=thread_id)
+
+    @api.model
+    def message_parse(self, message, save_original=False):
+        """ Store the attachments larger than
+        ``mail_by_company.attachment_spool_threshold`` bytes in the filestore
+        as soon as the message is parsed, and remove them from ``message``.
+        ``message_dict`` carries their ids in ``attachment_ids`` instead of
+        their content, so that the decoded payloads are never all held in
+        memory at once while the message is routed and posted. """
+        threshold = self._message_spool_threshold()
+        if not threshold:
+            return super(MailThread, self).message_parse(message, save_original=save_original)
+        spooled_ids = []
+        if save_original:
+            spooled_ids.append(self._message_spool_attachment(
+                'original_email.eml', message.as_bytes(), 'message/rfc822'))
+        spooled_ids += self._message_spool_parts(message, threshold)
+        msg_dict = super(MailThread, self).message_parse(message, save_original=False)
+        if spooled_ids:
+            msg_dict['attachment_ids'] = spooled_ids
+        return msg_dict
+
+    @api.model
+    def _message_spool_threshold(self):
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'mail_by_company.attachment_spool_threshold', SPOOL_THRESHOLD))
+
+    @api.model
+    def _message_spool_parts(self, message, threshold):
+        """ Spool then detach the explicit attachments of ``message`` whose
+        encoded size exceeds ``threshold``. Inline parts (with a Content-ID)
+        are kept, as the body refers to them. Return the attachment ids. """
+        strip = self.env.context.get('mail_strip_attachments')
+        spooled_ids = []
+        for container in [part for part in message.walk() if part.is_multipart()]:
+            parts = container.get_payload()
+            kept = []
+            for part in parts:
+                if part.is_multipart() or part.get('content-id') or not (
+                        part.get_filename() or part.get('content-disposition', '').strip().startswith('attachment')):
+                    kept.append(part)
+                elif len(part.get_payload()) <= threshold:
+                    kept.append(part)
+                elif not strip:
+                    spooled_ids.append(self._message_spool_attachment(
+                        part.get_filename() or 'attachment', part.get_payload(decode=True) or b'',
+                        part.get_content_type()))
+            if len(kept) != len(parts):
+                container.set_payload(kept)
+        return spooled_ids
+
+    @api.model
+    def _message_spool_attachment(self, name, content, mimetype):
+        """ Store ``content`` as a pending attachment, linked to its thread
+        by ``_message_route_post``; the unrouted ones are garbage collected. """
+        return self.env['ir.attachment'].sudo().create({
+            'name': name,
+            'raw': content,
+            'mimetype': mimetype,
+            'res_model': 'mail.compose.message',
+            'res_id': 0,
+            'description': SPOOL_DESCRIPTION,
+        }).id
+
+    # ------------------------------------------------------------
+    # BATCHED GATEWAY
+    # ------------------------------------------------------------
+
+    @api.model
+    def message_process_batch(self, model, messages, custom_values=None,
+                              save_original=False, strip_attachments=False,
+                              thread_id=None):
+        """ Batched version of ``message_process``, meant for the messages
+        fetched in one run of an incoming mail server.
+
+        References, authors and aliases of the whole batch are prefetched
+        with a few set-based queries, and new threads of models keeping the
+        default ``message_new`` are created with one ``create`` per model.
+        Each message is parsed and processed in its own savepoints: a failing
+        message is logged and does not abort the others. Replies to messages of the
+        batch are processed once those are posted, so that they join their
+        thread as with ``message_process``.
+
+        :param messages: list of raw RFC2822 messages (bytes, str or
+            xmlrpclib.Binary)
+        :return: list of thread ids, aligned on ``messages``; False for
+            duplicates, bounces and messages that failed
+        """
+        parsed = []
+        for message in messages:
+            if isinstance(message, xmlrpclib.Binary):
+                message = bytes(message.data)
+            if isinstance(message, str):
+                message = message.encode('utf-8')
+            try:
+                # parsing may spool attachments
+                with self.env.cr.savepoint():
+                    message = email.message_from_bytes(message, policy=email.policy.SMTP)
+                    msg_dict = self.with_context(mail_strip_attachments=strip_attachments).message_parse(
+                        message, save_original=save_original)
+            except Exception:
+                _logger.info('Failed to parse a mail of the batch', exc_info=True)
+                parsed.append((None, None))
+                continue
+            if strip_attachments:
+                msg_dict.pop('attachments', None)
+            parsed.append((message, msg_dict))
+
+        message_ids = [msg_dict['message_id'] for message, msg_dict in parsed if msg_dict and msg_dict.get('message_id')]
+        existing_msg_ids = set(self.env['mail.message.reference'].sudo()._find_replies(message_ids))
+
+        pending = []
+        for index, (message, msg_dict) in enumerate(parsed):
+            if msg_dict is None:
+                continue
+            if msg_dict.get('message_id') in existing_msg_ids:
+                _logger.info('Ignored mail from %s to %s with Message-Id %s: found duplicated Message-Id during processing',
+                             msg_dict.get('email_from'), msg_dict.get('to'), msg_dict.get('message_id'))
+                continue
+            existing_msg_ids.add(msg_dict.get('message_id'))
+            pending.append((index, message, msg_dict))
+
+        prefetch = self._message_route_prefetch([msg_dict for message, msg_dict in parsed if msg_dict])
+        Thread = self.with_context(mail_route_prefetch=prefetch, attachments_mime_plainxml=True)
+
+        # replies to messages of the batch are routed once those are posted,
+        # as message_process called on each message in turn would do
+        batch_msg_ids = {msg_dict['message_id'].strip() for index, message, msg_dict in pending if msg_dict.get('message_id')}
+        done_msg_ids = set()
+        results = [False] * len(parsed)
+        while pending:
+            wave, deferred = [], []
+            for item in pending:
+                own_id = (item[2].get('message_id') or '').strip()
+                waiting = self._message_batch_references(item[2]) & batch_msg_ids - done_msg_ids - {own_id}
+                (deferred if waiting else wave).append(item)
+            if not wave:
+                # references looping within the batch
+                wave, deferred = deferred, []
+            if done_msg_ids:
+                references = set().union(*(self._message_batch_references(msg_dict) for index, message, msg_dict in wave))
+                prefetch['replies'].update(self.env['mail.message.reference'].sudo()._find_replies(references))
+            Thread._message_process_batch_wave(wave, model, thread_id, custom_values, results)
+            done_msg_ids.update((msg_dict.get('message_id') or '').strip() for index, message, msg_dict in wave)
+            pending = deferred
+        return results
+
+    @api.model
+    def _message_batch_references(self, msg_dict):
+        thread_references = msg_dict['references'] or msg_dict['in_reply_to']
+        return {ref.strip() for ref in tools.mail_header_msgid_re.findall(thread_references) if 'reply_to' not in ref}
+
+    @api.model
+    def _message_process_batch_wave(self, items, model, thread_id, custom_values, results):
+        """ Route and process the ``(index, message, msg_dict)`` of ``items``
+        with ``_message_route_process``, setting the thread ids in
+        ``results``. The new threads of the wave are created beforehand. """
+        prefetch = self.env.context['mail_route_prefetch']
+        routed = []
+        for index, message, msg_dict in items:
+            try:
+                with self.env.cr.savepoint():
+                    routes = self.message_route(message, msg_dict, model, thread_id, custom_values)
+            except Exception:
+                _logger.info('Failed to route mail with Message-Id %s', msg_dict.get('message_id'), exc_info=True)
+                continue
+            routed.append((index, message, msg_dict, routes))
+
+        if prefetch['bounces']:
+            try:
+                with self.env.cr.savepoint():
+                    self._routing_handle_bounce_batch(prefetch['bounces'])
+            except Exception:
+                _logger.info('Failed to process %s bounces', len(prefetch['bounces']), exc_info=True)
+            prefetch['bounces'] = []
+
+        created = self._message_route_create_threads(
+            [(msg_dict, routes) for index, message, msg_dict, routes in routed])
+        Thread = self.with_context(mail_route_threads=created)
+        for index, message, msg_dict, routes in routed:
+            try:
+                with self.env.cr.savepoint():
+                    results[index] = Thread._message_route_process(message, msg_dict, routes)
+            except Exception:
+                _logger.info('Failed to process mail with Message-Id %s', msg_dict.get('message_id'), exc_info=True)
+
+    @api.model
+    def _message_route_prefetch(self, message_dicts):
+        """ Fetch the replied messages and the gateway users of a batch of
+        parsed messages, used by ``message_route`` through the
+        ``mail_route_prefetch`` context key. """
+        references, emails = set(), set()
+        for msg_dict in message_dicts:
+            references.update(self._message_batch_references(msg_dict))
+            normalized_email = tools.email_normalize(msg_dict['email_from'])
+            if normalized_email:
+                emails.add(normalized_email)
+
+        replies = self.env['mail.message.reference'].sudo()._find_replies(references)
+
+        # alias addresses never match a user, see ``_mail_find_user_for_gateway``
+        routing_index = self.env['mail.alias']._get_routing_index()
+        Alias = self.env['mail.alias']
+        alias_domains = set(routing_index['companies'])
+        catchall_domain = self.env['ir.config_parameter'].sudo().get_param('mail.catchall.domain')
+        if catchall_domain:
+            alias_domains.add(catchall_domain.lower())
+        alias_emails = set()
+        for normalized_email in emails:
+            localpart, domain = normalized_email.rsplit('@', 1)
+            if domain in alias_domains and Alias._get_route_aliases_by_name(localpart):
+                alias_emails.add(normalized_email)
+        # only the senders matching a user are kept, the others fall back on
+        # the standard lookup, e.g. the user of the alias
+        users = {}
+        remaining_emails = list(emails - alias_emails)
+        if remaining_emails:
+            for user in self.env['res.users'].search([('email_normalized', 'in', remaining_emails)]):
+                users.setdefault(user.email_normalized, user.id)
+
+        return {'replies': replies, 'users': users, 'alias_emails': alias_emails, 'bounces': []}
+
+    @api.model
+    def _message_route_create_threads(self, routed):
+        """ Create with one ``create`` per model and user the new threads of
+        the routes of ``routed``, ``(message_dict, routes)`` pairs, whose
+        model keeps the default ``message_new``. Return them with their
+        creation subtype, by route key, for ``_message_route_get_thread``.
+        Groups whose creation fails are left to ``message_new``. """
+        base_message_new = type(self.env['mail.thread']).message_new
+        groups = defaultdict(list)
+        for message_dict, routes in routed:
+            for model_name, route_thread_id, route_values, user_id, alias in routes or ():
+                Model = self.env[model_name]
+                if route_thread_id and hasattr(Model, 'message_update'):
+                    continue
+                if type(Model).message_new is not base_message_new:
+                    continue
+                groups[(model_name, user_id)].append((message_dict, route_values, alias))
+
+        created = defaultdict(list)
+        for (model_name, user_id), group in groups.items():
+            ModelCtx = self._message_route_model(model_name, user_id)
+            name_field = ModelCtx._rec_name or 'name'
+            vals_list = []
+            for message_dict, route_values, alias in group:
+                # same values as the default ``message_new``
+                data = route_values.copy() if isinstance(route_values, dict) else {}
+                if name_field in ModelCtx._fields and not data.get('name'):
+                    data[name_field] = message_dict.get('subject', '')
+                vals_list.append(data)
+            try:
+                with self.env.cr.savepoint():
+                    threads = ModelCtx.create(vals_list)
+                    threads_by_alias = defaultdict(list)
+                    for (message_dict, route_values, alias), thread in zip(group, threads):
+                        threads_by_alias[alias].append(thread.id)
+                    for alias, thread_ids in threads_by_alias.items():
+                        self._message_route_set_company(ModelCtx.browse(thread_ids), alias)
+            except Exception:
+                _logger.info('Bulk creation of %s %s records failed, falling back on message_new',
+                             len(group), model_name, exc_info=True)
+                continue
+            for (message_dict, route_values, alias), thread in zip(group, threads):
+                created[_route_thread_key(message_dict, model_name, user_id, alias)].append(
+                    (thread, thread._creation_subtype().id))
+        return created
+
+    @api.model
+    def _routing_handle_bounce_batch(self, bounces):
+        """ Set-based version of ``_routing_handle_bounce`` for the parsed
+        bounces (message dicts) of a batch:
+
+          * ``message_bounce`` of the blacklist-enabled records sharing the
+            bounced emails is increased with one UPDATE per model;
+          * notifications of the bounced messages are marked as bounced with
+            one UPDATE;
+          * emails of partners reaching ``mail_by_company.bounce_blacklist_threshold``
+            bounces (0 to disable) are blacklisted with one create.
+
+        Models overriding ``_message_receive_bounce`` keep receiving it.
+        """
+        bounces = [message_dict for message_dict in bounces if message_dict.get('bounced_email')]
+        if not bounces:
+            return
+        bounce_counts = Counter(message_dict['bounced_email'] for message_dict in bounces)
+        emails = list(bounce_counts)
+
+        # blacklist-enabled records with email_normalized = bounced email
+        handled = set()
+        blacklist_receive_bounce = type(self.env['mail.thread.blacklist'])._message_receive_bounce
+        bl_models = self.env['ir.model'].sudo().search([('is_mail_blacklist', '=', True), ('model', '!=', 'mail.thread.blacklist')])
+        for model_name in bl_models.mapped('model'):
+            if model_name not in self.env:  # transient test models
+                continue
+            Model = self.env[model_name].sudo()
+            if type(Model)._message_receive_bounce is blacklist_receive_bounce:
+                Model.flush(['email_normalized', 'message_bounce'])
+                self.env.cr.execute("""
+                    UPDATE "%s" record
+                       SET message_bounce = COALESCE(record.message_bounce, 0) + bounce.count
+                      FROM unnest(%%s::varchar[], %%s::int[]) AS bounce(email, count)
+                     WHERE record.email_normalized = bounce.email
+                 RETURNING record.id
+                """ % Model._table, [emails, [bounce_counts[email] for email in emails]])
+                record_ids = [row[0] for row in self.env.cr.fetchall()]
+                Model.invalidate_cache(['message_bounce'], record_ids)
+            else:
+                records = Model.search([('email_normalized', 'in', emails)])
+                for message_dict in bounces:
+                    records.filtered(lambda record: record.email_normalized == message_dict['bounced_email'])\
+                        ._message_receive_bounce(message_dict['bounced_email'], message_dict['bounced_partner'])
+                record_ids = records.ids
+            handled.update((model_name, record_id) for record_id in record_ids)
+
+        # records of the bounced messages, when not done above and not a no-op
+        thread_receive_bounce = type(self.env['mail.thread'])._message_receive_bounce
+        notification_keys = set()
+        for message_dict in bounces:
+            bounced_message = message_dict['bounced_message']
+            bounced_partner = message_dict['bounced_partner']
+            if bounced_partner and bounced_message:
+                notification_keys.update(
+                    (message_id, partner_id) for message_id in bounced_message.ids for partner_id in bounced_partner.ids)
+            model_name, res_id = bounced_message[:1].model, bounced_message[:1].res_id
+            if not (model_name and model_name in self.env and res_id) or (model_name, res_id) in handled:
+                continue
+            Model = self.env[model_name].sudo()
+            if type(Model)._message_receive_bounce is thread_receive_bounce:
+                continue
+            Model.browse(res_id).exists()._message_receive_bounce(message_dict['bounced_email'], bounced_partner)
+
+        if notification_keys:
+            Notification = self.env['mail.notification'].sudo()
+            Notification.flush(['notification_status'])
+            self.env.cr.execute("""
+                UPDATE mail_notification
+                   SET notification_status = 'bounce'
+                 WHERE (mail_message_id, res_partner_id) IN %s
+            """, [tuple(notification_keys)])
+            Notification.invalidate_cache(['notification_status'])
+
+        threshold = int(self.env['ir.config_parameter'].sudo().get_param('mail_by_company.bounce_blacklist_threshold', 0))
+        if threshold:
+            self.env['res.partner'].flush(['email_normalized', 'message_bounce'])
+            self.env.cr.execute("""
+                SELECT DISTINCT email_normalized
+                  FROM res_partner
+                 WHERE email_normalized IN %s AND message_bounce >= %s
+            """, [tuple(emails), threshold])
+            to_blacklist = set(row[0] for row in self.env.cr.fetchall())
+            if to_blacklist:
+                Blacklist = self.env['mail.blacklist'].sudo().with_context(active_test=False)
+                existing = Blacklist.search([('email', 'in', list(to_blacklist))])
+                existing.filtered(lambda entry: not entry.active).write({'active': True})
+                Blacklist.create([{'email': email} for email in to_blacklist - set(existing.mapped('email'))])
+
+        _logger.info('Processed %s bounces for %s emails', len(bounces), len(bounce_counts))
+
 
+def _route_thread_key(message_dict, model, user_id, alias):
+    """ Key of the thread created in bulk for a route of ``message_dict``. """
+    return id(message_dict), model, user_id, alias.id if alias else False
@@ -1,9 +1,75 @@
 # -*- coding: utf-8 -*-
-from odoo import fields, models
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
 
 class Company(models.Model):
 
     _inherit = 'res.company'
 
     company_domain = fields.Char(string="Domain", store=True)
+    bounce_alias = fields.Char(
+        string="Bounce Alias",
+        help="Local part of the bounce address on the company domain (e.g. 'bounce' for "
+             "bounce@domain). Falls back on the global mail.bounce.alias parameter.")
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        companies = super(Company, self).create(vals_list)
+        if any(vals.get('company_domain') or vals.get('bounce_alias') for vals in vals_list):
+            # the mail routing index is keyed on company domains
+            self.clear_caches()
+        return companies
+
+    def write(self, vals):
+        res = super(Company, self).write(vals)
+        if 'company_domain' in vals:
+            self._update_alias_domains()
+        if 'company_domain' in vals or 'bounce_alias' in vals:
+            self.clear_caches()
+        return res
+
+    def _update_alias_domains(self):
+        """ Propagate the company domain to the aliases of the companies in
+        one UPDATE, instead of writing them one by one. Raise a UserError when
+        an alias would then clash with an alias of the same name on the new
+        domain. """
+        Alias = self.env['mail.alias']
+        self.flush(['company_domain'])
+        Alias.flush(['alias_domain', 'alias_company_id', 'alias_name'])
+        # domain of the aliases sharing a name with the moved ones, after the update
+        self.env.cr.execute("""
+            SELECT target.domain, target.alias_name
+              FROM (
+                    SELECT CASE WHEN company.id IS NULL THEN alias.alias_domain
+                                ELSE company.company_domain END AS domain,
+                           alias.alias_name
+                      FROM mail_alias alias
+                 LEFT JOIN res_company company
+                        ON company.id = alias.alias_company_id AND company.id IN %(ids)s
+                     WHERE alias.alias_name IN (
+                            SELECT alias_name FROM mail_alias WHERE alias_company_id IN %(ids)s)
+                   ) target
+             WHERE target.domain IS NOT NULL
+          GROUP BY target.domain, target.alias_name
+            HAVING COUNT(*) > 1
+             LIMIT 1
+        """, {'ids': tuple(self.ids)})
+        conflict = self.env.cr.fetchone()
+        if conflict:
+            raise UserError(_('The e-mail alias %s@%s is already used, please choose a unique one.')
+                            % (conflict[1], conflict[0]))
+        self.env.cr.execute("""
+            UPDATE mail_alias alias
+               SET alias_domain = company.company_domain
+              FROM res_company company
+             WHERE alias.alias_company_id = company.id
+               AND company.id IN %s
+               AND alias.alias_domain IS DISTINCT FROM company.company_domain
+         RETURNING alias.id
+        """, [tuple(self.ids)])
+        aliases = Alias.browse([row[0] for row in self.env.cr.fetchall()])
+        Alias.invalidate_cache(['alias_domain'])
+        # recompute the alias domain stored on the records owning the aliases
+        aliases.modified(['alias_domain'])
+        # the routing index holds the alias domains
+        Alias.clear_caches()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import threading
+
+
+class WeightedRoundRobin(object):
+    """ Smooth weighted round-robin over the outgoing servers of a company.
+
+    Each pick adds its weight to the score of every server and takes the
+    highest one, whose score is then lowered by the total weight: a server
+    of weight 3 next to one of weight 1 is picked 3 times out of 4, and the
+    picks are interleaved instead of sent in runs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scores = {}
+
+    def pick(self, weights):
+        """ Return the next server among ``weights``, a list of
+        ``(server_id, weight)``. """
+        with self._lock:
+            return self._pick(weights)
+
+    def distribute(self, record_ids, servers):
+        """ Spread ``record_ids`` over ``servers``, a list of ``(server_id,
+        weight, capacity)`` where a capacity of 0 means no limit.
+
+        :return: ``(assigned, leftover)`` where ``assigned`` is a dict
+            ``{server_id: [record ids]}`` and ``leftover`` the ids above the
+            total capacity of the servers
+        """
+        assigned = {server_id: [] for server_id, _weight, _capacity in servers}
+        capacities = {server_id: capacity for server_id, _weight, capacity in servers}
+        weights = [(server_id, weight) for server_id, weight, _capacity in servers]
+        with self._lock:
+            for index, record_id in enumerate(record_ids):
+                if not weights:
+                    return assigned, list(record_ids[index:])
+                server_id = self._pick(weights)
+                assigned[server_id].append(record_id)
+                if capacities[server_id] and len(assigned[server_id]) >= capacities[server_id]:
+                    weights = [item for item in weights if item[0] != server_id]
+        return assigned, []
+
+    def _pick(self, weights):
+        total, best = 0, None
+        for server_id, weight in weights:
+            weight = max(weight, 1)
+            score = self._scores[server_id] = self._scores.get(server_id, 0) + weight
+            total += weight
+            if best is None or score > self._scores[best]:
+                best = server_id
+        self._scores[best] -= total
+        return best
+
+
+class BalancerRegistry(object):
+    """ Worker-local balancers, keyed by ``(dbname, company id)``. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._balancers = {}
+
+    def get(self, key):
+        with self._lock:
+            balancer = self._balancers.get(key)
+            if balancer is None:
+                balancer = self._balancers[key] = WeightedRoundRobin()
+            return balancer
+
+
+smtp_balancers = BalancerRegistry()
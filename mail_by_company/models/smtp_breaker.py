@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of connecting to a mail server whose breaker is open. """
+
+
+class CircuitBreaker(object):
+    """ Circuit breaker of the connections to one mail server.
+
+    After ``threshold`` consecutive connection failures the breaker opens:
+    the server is not contacted anymore for ``cooldown`` seconds. Past the
+    cooldown, connections are attempted again (half-open); the first success
+    closes the breaker, a failure opens it for another cooldown.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.configure(threshold, cooldown)
+
+    def configure(self, threshold, cooldown):
+        self.threshold = max(threshold, 1)
+        self.cooldown = cooldown
+
+    @property
+    def is_open(self):
+        """ Whether connections are currently refused. """
+        with self._lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        """ Record a connection failure and return whether the breaker is open. """
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            return self.opened_at is not None
+
+
+class BreakerRegistry(object):
+    """ Worker-local circuit breakers, keyed by ``(dbname, mail server id)``. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def get(self, key, threshold, cooldown):
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(threshold, cooldown)
+            elif (breaker.threshold, breaker.cooldown) != (max(threshold, 1), cooldown):
+                breaker.configure(threshold, cooldown)
+            return breaker
+
+    def stats(self):
+        with self._lock:
+            breakers = list(self._breakers.items())
+        return {key: breaker.is_open for key, breaker in breakers}
+
+
+smtp_breakers = BreakerRegistry()
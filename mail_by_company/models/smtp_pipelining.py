@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import re
+import smtplib
+
+CRLF = b'\r\n'
+
+
+def _quote_periods(data):
+    return re.sub(br'(?m)^\.', b'..', data)
+
+
+def pipelined_sendmail(smtp, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+    """ ``smtplib.SMTP.sendmail`` using the PIPELINING extension (RFC 2920):
+    MAIL, RCPT and DATA are written at once and their replies read
+    afterwards, which saves a round trip per command. Same arguments, return
+    value and exceptions as ``sendmail``. """
+    smtp.ehlo_or_helo_if_needed()
+    if isinstance(msg, str):
+        msg = smtplib._fix_eols(msg).encode('ascii')
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    mail_options = list(mail_options)
+    if smtp.does_esmtp and smtp.has_extn('size'):
+        mail_options.insert(0, 'size=%d' % len(msg))
+
+    commands = ['mail FROM:%s%s' % (smtplib.quoteaddr(from_addr), _options(mail_options))]
+    commands += ['rcpt TO:%s%s' % (smtplib.quoteaddr(to_addr), _options(rcpt_options)) for to_addr in to_addrs]
+    commands.append('data')
+    if smtp.debuglevel > 0:
+        smtp._print_debug('pipelined:', commands)
+    smtp.send(''.join(command + '\r\n' for command in commands))
+
+    code, resp = smtp.getreply()
+    mail_refused = code != 250 and (code, resp)
+    senderrs = {}
+    for to_addr in to_addrs:
+        rcpt_code, rcpt_resp = smtp.getreply()
+        if rcpt_code not in (250, 251):
+            senderrs[to_addr] = (rcpt_code, rcpt_resp)
+    data_code, data_resp = smtp.getreply()
+
+    if data_code == 354 and (mail_refused or len(senderrs) == len(to_addrs)):
+        # the server accepted DATA anyway: send an empty message and drop it
+        smtp.send(b'.' + CRLF)
+        smtp.getreply()
+        data_code = None
+    if mail_refused:
+        _reset(smtp, code)
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    if len(senderrs) == len(to_addrs):
+        _reset(smtp)
+        raise smtplib.SMTPRecipientsRefused(senderrs)
+    if data_code != 354:
+        _reset(smtp)
+        raise smtplib.SMTPDataError(data_code, data_resp)
+
+    data = _quote_periods(msg)
+    if data[-2:] != CRLF:
+        data += CRLF
+    smtp.send(data + b'.' + CRLF)
+    code, resp = smtp.getreply()
+    if code != 250:
+        _reset(smtp, code)
+        raise smtplib.SMTPDataError(code, resp)
+    return senderrs
+
+
+def enable_pipelining(smtp):
+    """ Make ``smtp`` pipeline its ``sendmail`` commands when the server
+    supports it. Return whether it does. """
+    smtp.ehlo_or_helo_if_needed()
+    if not smtp.has_extn('pipelining'):
+        return False
+    smtp.sendmail = lambda *args, **kwargs: pipelined_sendmail(smtp, *args, **kwargs)
+    return True
+
+
+def _options(options):
+    return (' ' + ' '.join(options)) if options else ''
+
+
+def _reset(smtp, code=None):
+    # same as smtplib: a 421 closes the session, anything else is reset
+    if code == 421:
+        smtp.close()
+    else:
+        try:
+            smtp.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import logging
+import smtplib
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class PooledSession(object):
+    """ An SMTP session checked out of the pool, with its usage counters. """
+    __slots__ = ('key', 'session', 'sent', 'last_used')
+
+    def __init__(self, key, session):
+        self.key = key
+        self.session = session
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+
+class SmtpConnectionPool(object):
+    """ Worker-local pool of authenticated SMTP sessions.
+
+    Sessions are keyed by ``(dbname, mail server id, configuration token)``
+    and are checked out exclusively: a session is either idle in the pool or
+    used by a single thread. Idle sessions are checked with NOOP before being
+    handed out again, and dropped once they exceeded the idle timeout.
+    """
+
+    def __init__(self, max_idle_per_key=4):
+        self.max_idle_per_key = max_idle_per_key
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._stats = {'hits': 0, 'misses': 0, 'discarded': 0}
+
+    def acquire(self, key, connect, idle_timeout):
+        """ Return a :class:`PooledSession` for ``key``, reusing an idle live
+        session when possible and calling ``connect()`` otherwise. """
+        while True:
+            with self._lock:
+                entries = self._idle.get(key)
+                entry = entries.pop() if entries else None
+            if entry is None:
+                break
+            if time.monotonic() - entry.last_used > idle_timeout or not self._is_alive(entry.session):
+                self.discard(entry)
+                continue
+            self._count('hits')
+            return entry
+        self._count('misses')
+        return PooledSession(key, connect())
+
+    def release(self, entry, max_messages, max_idle=None):
+        """ Give ``entry`` back to the pool, or close it when it reached
+        ``max_messages`` or the pool is full for its key (``max_idle``
+        sessions, by default ``max_idle_per_key``). """
+        if entry.session is None:
+            return
+        if entry.sent >= max_messages:
+            self.discard(entry)
+            return
+        entry.last_used = time.monotonic()
+        with self._lock:
+            entries = self._idle.setdefault(entry.key, [])
+            if len(entries) < max(max_idle or 0, self.max_idle_per_key):
+                entries.append(entry)
+                return
+        self.discard(entry)
+
+    def discard(self, entry):
+        """ Close the session of ``entry`` without returning it to the pool. """
+        if entry.session is None:
+            return
+        self._count('discarded')
+        try:
+            entry.session.quit()
+        except Exception:
+            # the session is dead already, make sure the socket is released
+            try:
+                entry.session.close()
+            except Exception:
+                pass
+
+    def clear(self, predicate=None):
+        """ Close idle sessions whose key matches ``predicate`` (all by default). """
+        with self._lock:
+            keys = [key for key in self._idle if predicate is None or predicate(key)]
+            entries = [entry for key in keys for entry in self._idle.pop(key)]
+        for entry in entries:
+            self.discard(entry)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = sum(len(entries) for entries in self._idle.values())
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    @staticmethod
+    def _is_alive(session):
+        try:
+            return session.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+
+smtp_pool = SmtpConnectionPool()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import smtplib
+import ssl
+import threading
+import time
+
+from .smtp_breaker import CircuitOpenError
+
+# SMTP replies with which providers signal that the sender goes too fast
+THROTTLING_CODES = (421, 450, 451, 452)
+
+
+class AdaptiveTokenBucket(object):
+    """ Token bucket pacing the emails sent through one mail server.
+
+    The effective rate starts at the configured rate and is halved each time
+    the provider answers with a throttling reply, then recovers additively
+    with every accepted email (AIMD), so that the sender settles at the
+    provider's actual ceiling.
+    """
+    MIN_FACTOR = 1.0 / 8
+    RECOVERY = 0.02
+
+    def __init__(self, rate, burst):
+        self._lock = threading.Lock()
+        self.factor = 1.0
+        self.configure(rate, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def configure(self, rate, burst):
+        """ Set the rate (emails per second) and the burst size. """
+        self.rate = rate
+        self.burst = max(burst, 1)
+
+    def reserve(self):
+        """ Take one token and return how many seconds to wait before using it. """
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / (self.rate * self.factor)
+
+    def throttled(self):
+        """ The provider refused an email because of its rate limits. """
+        with self._lock:
+            self._refill()
+            self.factor = max(self.factor / 2, self.MIN_FACTOR)
+            self.tokens = min(self.tokens, 0.0)
+
+    def accepted(self):
+        with self._lock:
+            self.factor = min(self.factor + self.RECOVERY, 1.0)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate * self.factor, float(self.burst))
+        self.updated = now
+
+
+class ThrottleRegistry(object):
+    """ Worker-local token buckets, keyed by ``(dbname, mail server id)``. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def get(self, key, rate, burst):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = AdaptiveTokenBucket(rate, burst)
+            elif (bucket.rate, bucket.burst) != (rate, max(burst, 1)):
+                bucket.configure(rate, burst)
+            return bucket
+
+    def stats(self):
+        with self._lock:
+            return {key: bucket.factor for key, bucket in self._buckets.items()}
+
+
+smtp_throttles = ThrottleRegistry()
+
+
+def is_throttling_reply(exc):
+    """ Whether ``exc`` (or the exception it wraps) is a throttling reply. """
+    while exc is not None:
+        code = getattr(exc, 'smtp_code', None)
+        if code in THROTTLING_CODES:
+            return True
+        recipients = getattr(exc, 'recipients', None)
+        if isinstance(recipients, dict) and recipients and all(
+                code in THROTTLING_CODES for code, _resp in recipients.values()):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+def is_transient_failure(exc):
+    """ Whether sending failed for a reason that may go away by itself
+    (network error, server unavailable, 4xx reply), as opposed to a
+    permanent failure (5xx reply, TLS or configuration error). """
+    while exc is not None:
+        if isinstance(exc, (CircuitOpenError, smtplib.SMTPServerDisconnected)):
+            return True
+        code = getattr(exc, 'smtp_code', None)
+        if isinstance(code, int) and code >= 400:
+            return code < 500
+        recipients = getattr(exc, 'recipients', None)
+        if isinstance(recipients, dict) and recipients:
+            return all(400 <= code < 500 for code, _resp in recipients.values())
+        if isinstance(exc, ssl.SSLError):
+            return False
+        if isinstance(exc, OSError):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+from . import test_benchmark
+from . import test_fetchmail
+from . import test_mail_alias
+from . import test_mail_gateway
+from . import test_mail_metrics
+from . import test_mail_server
+from . import test_smtp_pool
+from . import test_smtp_throttle
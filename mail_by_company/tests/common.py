@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from odoo.tests import common
+
+MAIL_TEMPLATE = """From: {email_from}
+To: {email_to}
+Subject: {subject}
+Message-ID: {message_id}
+{headers}Content-Type: text/plain; charset="utf-8"
+
+{body}
+"""
+
+
+class MailByCompanyCommon(common.SavepointCase):
+    """ A company with a mail domain and a lead alias on it. """
+
+    @classmethod
+    def setUpClass(cls):
+        super(MailByCompanyCommon, cls).setUpClass()
+        cls.company = cls.env.company
+        cls.company.write({'company_domain': 'gateway.example.com'})
+        cls.lead_model = cls.env['ir.model']._get('crm.lead')
+        cls.alias = cls.env['mail.alias'].create({
+            'alias_name': 'sales',
+            'alias_model_id': cls.lead_model.id,
+            'alias_contact': 'everyone',
+        })
+
+    @staticmethod
+    def format_message(email_to, message_id, subject='Request', body='Hello', headers=None,
+                       email_from='Customer <customer@customer.example.org>'):
+        return MAIL_TEMPLATE.format(
+            email_from=email_from, email_to=email_to, subject=subject, message_id=message_id, body=body,
+            headers=''.join('%s: %s\n' % item for item in (headers or {}).items()))
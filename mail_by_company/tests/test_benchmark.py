@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import smtplib
+import threading
+from unittest.mock import patch
+
+from odoo.tests import common
+
+from ..tools import benchmark
+from ..tools.smtp_sink import SmtpSink
+
+
+class TestBenchmark(common.SavepointCase):
+
+    def test_smtp_sink(self):
+        with SmtpSink(throttle_every=2) as sink:
+            session = smtplib.SMTP(sink.host, sink.port)
+            session.sendmail('a@example.com', ['b@example.com'], b'Subject: One\r\n\r\nHello\r\n')
+            with self.assertRaises(smtplib.SMTPSenderRefused) as refused:
+                session.sendmail('a@example.com', ['b@example.com'], b'Subject: Two\r\n\r\nHello\r\n')
+            self.assertEqual(refused.exception.smtp_code, 451)
+            session.quit()
+        self.assertEqual(sink.stats['messages'], 1)
+        self.assertEqual(sink.stats['throttled'], 1)
+
+    def test_run(self):
+        """ The benchmark routes its messages and delivers its emails to the
+        SMTP sink, without leaving anything in the database. """
+        companies = self.env['res.company'].search_count([])
+        # emails are only sent for real outside of the test mode
+        with patch.object(threading.current_thread(), 'testing', False):
+            reports = benchmark.run(self.env, companies=2, aliases=1, messages=4, mails=6, log=False)
+
+        reports = {report['scenario']: report for report in reports}
+        for scenario in ('new thread: message_route', 'new thread: _message_route_process',
+                         'reply: message_route', 'bounce: message_route',
+                         'catchall: message_route', 'new thread: message_process_batch'):
+            self.assertIn(scenario, reports)
+        self.assertEqual(reports['new thread: message_route']['messages'], 4)
+        self.assertEqual(reports['new thread: message_process_batch']['messages'], 5)
+        self.assertEqual(reports['MailMail.send']['messages'], 6)
+        self.assertEqual(reports['MailMail.send']['delivered'], 6)
+        self.assertEqual(self.env['res.company'].search_count([]), companies)
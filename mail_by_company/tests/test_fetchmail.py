@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import imaplib
+import threading
+from unittest.mock import patch
+
+from odoo.tests import common
+
+from ..models import imap_idle
+from ..models.imap_idle import ImapIdleListener, ImapIdleRegistry
+from ..tools.imap_stub import ImapStub
+
+RAW_MESSAGE = b"""From: customer@customer.example.org
+To: sales@gateway.example.com
+Subject: Pushed
+Message-ID: <pushed@customer.example.org>
+
+Hello
+"""
+
+
+class FakeListener(threading.Thread):
+
+    def __init__(self, token):
+        super(FakeListener, self).__init__(daemon=True)
+        self.token = token
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        self.stop_event.wait(10)
+
+
+class TestImapIdle(common.BaseCase):
+
+    def test_listener(self):
+        """ The listener fetches once connected, then whenever a message
+        arrives in the mailbox. """
+        fetched = []
+        fetch_event = threading.Event()
+
+        def fetch():
+            fetched.append(len(stub.messages))
+            fetch_event.set()
+
+        def connect():
+            imap = imaplib.IMAP4(stub.host, stub.port)
+            imap.login('user', 'password')
+            return imap
+
+        with ImapStub() as stub, patch.object(imap_idle, 'POLL_INTERVAL', 0.1):
+            listener = ImapIdleListener(('db', 1), 'token', connect, fetch)
+            listener.start()
+            self.assertTrue(fetch_event.wait(10))
+            fetch_event.clear()
+            stub.deliver(RAW_MESSAGE)
+            self.assertTrue(fetch_event.wait(10))
+            listener.stop()
+            listener.join(10)
+        self.assertFalse(listener.is_alive())
+        self.assertEqual(fetched, [0, 1])
+
+    def test_listener_lock(self):
+        """ A listener whose mailbox is locked by another worker stops. """
+        class Locked(object):
+            def __enter__(self):
+                return False
+
+            def __exit__(self, exc_type, exc_value, traceback):
+                return False
+
+        connect = []
+        listener = ImapIdleListener(('db', 1), 'token', lambda: connect.append(1), lambda: None, lock=Locked())
+        listener.start()
+        listener.join(10)
+        self.assertFalse(listener.is_alive())
+        self.assertFalse(connect)
+
+    def test_registry_restart(self):
+        registry = ImapIdleRegistry()
+        first = registry.ensure(('db', 1), 'token', lambda: FakeListener('token'))
+        self.assertIs(registry.ensure(('db', 1), 'token', lambda: FakeListener('token')), first)
+        # a listener is restarted when the settings of its server change
+        second = registry.ensure(('db', 1), 'changed', lambda: FakeListener('changed'))
+        self.assertIsNot(second, first)
+        self.assertTrue(first.stop_event.is_set())
+        # or when it died
+        second.stop()
+        second.join(10)
+        third = registry.ensure(('db', 1), 'changed', lambda: FakeListener('changed'))
+        self.assertIsNot(third, second)
+        # and stopped once its server is not in IDLE mode anymore
+        registry.stop_others('db', set())
+        self.assertTrue(third.stop_event.is_set())
+        self.assertEqual(registry.stats(), {})
+
+
+class TestFetchMails(common.SavepointCase):
+
+    def test_fetch_mails_skip_idle(self):
+        """ The scheduled fetch leaves the mailboxes in IDLE mode to their listener. """
+        FetchmailServer = self.env['fetchmail.server']
+        polled, idle = FetchmailServer.create([{
+            'name': name,
+            'server': 'imap.example.com',
+            'server_type': 'imap',
+            'state': 'done',
+            'imap_idle': name == 'Idle',
+        } for name in ('Polled', 'Idle')])
+        fetched_ids = []
+
+        def fetch_mail_limited(servers):
+            fetched_ids.extend(servers.ids)
+            return True
+
+        with patch.object(type(FetchmailServer), '_fetch_mail_limited', autospec=True,
+                          side_effect=fetch_mail_limited):
+            FetchmailServer._fetch_mails()
+        self.assertIn(polled.id, fetched_ids)
+        self.assertNotIn(idle.id, fetched_ids)
+
+    def _fetch_imap_stub(self, server, stub):
+        """ Fetch ``server`` from the mailbox of ``stub``, returning the
+        number of emails of each processed batch. """
+        batches = []
+
+        def connect(server):
+            imap = imaplib.IMAP4(stub.host, stub.port)
+            imap.login('user', 'password')
+            return imap
+
+        def process_fetched_batch(server, messages):
+            batches.append(len(messages))
+
+        FetchmailServer = type(self.env['fetchmail.server'])
+        with patch.object(FetchmailServer, 'connect', autospec=True, side_effect=connect), \
+                patch.object(FetchmailServer, '_process_fetched_batch', autospec=True,
+                             side_effect=process_fetched_batch):
+            server._fetch_imap_batch()
+        return batches
+
+    def test_fetch_imap_backlog(self):
+        """ A mailbox holding more emails than the fetch limit is fetched
+        again right away. """
+        server = self.env['fetchmail.server'].create({
+            'name': 'Backlog',
+            'server': '127.0.0.1',
+            'server_type': 'imap',
+            'state': 'done',
+            'fetch_limit': 2,
+        })
+        with ImapStub() as stub:
+            for _index in range(3):
+                stub.deliver(RAW_MESSAGE)
+            batches = self._fetch_imap_stub(server, stub)
+            seen = [seen for raw, seen in stub.messages]
+        self.assertEqual(batches, [2])
+        self.assertEqual(seen, [True, True, False])
+        cron = self.env.ref('fetchmail.ir_cron_mail_gateway_action')
+        self.assertTrue(self.env['ir.cron.trigger'].search([('cron_id', '=', cron.id)]))
+
+    def test_fetch_imap_batches(self):
+        """ The emails of a fetch are processed and flagged in batches
+        bounded in number and size. """
+        server = self.env['fetchmail.server'].create({
+            'name': 'Batches',
+            'server': '127.0.0.1',
+            'server_type': 'imap',
+            'state': 'done',
+            'fetch_limit': 0,
+        })
+        set_param = self.env['ir.config_parameter'].sudo().set_param
+        set_param('mail_by_company.fetch_batch_size', 2)
+        with ImapStub() as stub:
+            for _index in range(3):
+                stub.deliver(RAW_MESSAGE)
+            self.assertEqual(self._fetch_imap_stub(server, stub), [2, 1])
+            self.assertTrue(all(seen for raw, seen in stub.messages))
+
+            # a batch is closed once its size reaches the limit
+            for number in range(1, 4):
+                stub.set_seen(number, False)
+            set_param('mail_by_company.fetch_batch_bytes', len(RAW_MESSAGE))
+            self.assertEqual(self._fetch_imap_stub(server, stub), [1, 1, 1])
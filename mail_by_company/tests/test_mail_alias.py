@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from odoo.exceptions import UserError
+
+from .common import MailByCompanyCommon
+
+
+class TestAliasDomain(MailByCompanyCommon):
+
+    def _create_alias(self, name, **values):
+        return self.env['mail.alias'].create(dict(values, alias_name=name, alias_model_id=self.lead_model.id))
+
+    def test_create_alias_domain(self):
+        self.assertEqual(self._create_alias('default').alias_domain, 'gateway.example.com')
+        # a domain given by the caller is kept
+        alias = self._create_alias('custom', alias_domain='custom.example.com')
+        self.assertEqual(alias.alias_domain, 'custom.example.com')
+        # and is the one the name must be unique on
+        self.assertEqual(self._create_alias('sales', alias_domain='custom.example.com').alias_name, 'sales')
+        with self.assertRaises(UserError):
+            self._create_alias('custom', alias_domain='custom.example.com')
+
+    def test_company_domain_propagation(self):
+        self.company.write({'company_domain': 'new.example.com'})
+        self.assertEqual(self.alias.alias_domain, 'new.example.com')
+        Alias = self.env['mail.alias']
+        self.assertEqual(Alias._get_route_alias_ids('new.example.com', 'sales'), (self.alias.id,))
+        self.assertEqual(Alias._get_route_alias_ids('gateway.example.com', 'sales'), ())
+
+    def test_company_domain_owner(self):
+        """ The domain stored on the record owning an alias follows the
+        domain of its company. """
+        project = self.env['project.project'].create({
+            'name': 'Support',
+            'alias_name': 'support',
+            'company_id': self.company.id,
+        })
+        self.assertEqual(project.alias_domain, 'gateway.example.com')
+        self.company.write({'company_domain': 'new.example.com'})
+        project.flush(['alias_domain'])
+        self.env.cr.execute("SELECT alias_domain FROM project_project WHERE id = %s", [project.id])
+        self.assertEqual(self.env.cr.fetchone()[0], 'new.example.com')
+
+    def test_company_domain_conflict(self):
+        other = self.env['res.company'].create({'name': 'Other Company', 'company_domain': 'other.example.com'})
+        alias = self._create_alias('sales', alias_company_id=other.id)
+        self.assertEqual(alias.alias_domain, 'other.example.com')
+        with self.assertRaises(UserError), self.cr.savepoint():
+            other.write({'company_domain': 'gateway.example.com'})
+        self.assertEqual(alias.alias_domain, 'other.example.com')
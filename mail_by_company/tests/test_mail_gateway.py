@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+from email.message import EmailMessage
+from unittest.mock import patch
+
+from .common import MailByCompanyCommon
+
+BOUNCE_TEMPLATE = """From: MAILER-DAEMON@mail.customer.example.org
+To: bounce@gateway.example.com
+Subject: Undelivered Mail Returned to Sender
+Message-ID: <bounce@mail.customer.example.org>
+MIME-Version: 1.0
+Content-Type: multipart/report; report-type=delivery-status; boundary="REPORT"
+
+--REPORT
+Content-Type: text/plain
+
+Delivery failed.
+
+--REPORT
+Content-Type: message/delivery-status
+
+Reporting-MTA: dns; mail.customer.example.org
+
+Final-Recipient: rfc822; {email}
+Action: failed
+Status: 5.1.1
+
+--REPORT
+Content-Type: text/rfc822-headers
+
+Message-Id: {message_id}
+From: sales@gateway.example.com
+To: {email}
+Subject: Hello
+
+--REPORT--
+"""
+
+
+class TestMailGatewayBatch(MailByCompanyCommon):
+
+    def test_batch_reply_to_message_of_batch(self):
+        """ A reply to a message of the same batch joins its thread, as with
+        message_process called on each message in turn. """
+        first = self.format_message('sales@gateway.example.com', '<first@customer.example.org>')
+        reply = self.format_message(
+            'sales@gateway.example.com', '<reply@customer.example.org>', subject='Re: Request',
+            headers={'In-Reply-To': '<first@customer.example.org>', 'References': '<first@customer.example.org>'})
+        other = self.format_message('sales@gateway.example.com', '<other@customer.example.org>')
+
+        results = self.env['mail.thread'].message_process_batch('crm.lead', [first, reply, other])
+
+        self.assertTrue(results[0])
+        self.assertEqual(results[1], results[0])
+        self.assertNotEqual(results[2], results[0])
+        lead = self.env['crm.lead'].browse(results[0])
+        self.assertIn('<reply@customer.example.org>', lead.message_ids.mapped('message_id'))
+
+    def test_batch_duplicate(self):
+        raw = self.format_message('sales@gateway.example.com', '<dup@customer.example.org>')
+        results = self.env['mail.thread'].message_process_batch('crm.lead', [raw, raw])
+        self.assertTrue(results[0])
+        self.assertFalse(results[1])
+
+    def test_batch_route_process(self):
+        """ Each routed message goes through ``_message_route_process``, on
+        which overrides such as mass_mailing's rely. """
+        MailThread = self.env['mail.thread']
+        route_process = type(MailThread)._message_route_process
+        processed = []
+
+        def spy_route_process(model, message, message_dict, routes):
+            processed.append(message_dict['message_id'])
+            return route_process(model, message, message_dict, routes)
+
+        messages = [
+            self.format_message('sales@gateway.example.com', '<hook1@customer.example.org>'),
+            self.format_message('sales@gateway.example.com', '<hook2@customer.example.org>'),
+        ]
+        with patch.object(type(MailThread), '_message_route_process', autospec=True, side_effect=spy_route_process):
+            results = MailThread.message_process_batch('crm.lead', messages)
+
+        self.assertEqual(processed, ['<hook1@customer.example.org>', '<hook2@customer.example.org>'])
+        self.assertTrue(all(results))
+        self.assertEqual(len(set(results)), 2)
+
+    def test_batch_alias_user(self):
+        """ Threads of senders matching no user are created by the user of
+        the alias, as with message_process. """
+        user = self.env['res.users'].create({
+            'name': 'Alias Owner',
+            'login': 'alias_owner',
+            'groups_id': [(6, 0, [self.env.ref('sales_team.group_sale_salesman').id])],
+        })
+        self.alias.alias_user_id = user
+        raw = self.format_message('sales@gateway.example.com', '<owner@customer.example.org>')
+        results = self.env['mail.thread'].message_process_batch('crm.lead', [raw])
+        self.assertEqual(self.env['crm.lead'].browse(results[0]).create_uid, user)
+
+    def test_batch_parse_failure(self):
+        """ A message that cannot be parsed is skipped, the others of the
+        batch are processed. """
+        good = self.format_message('sales@gateway.example.com', '<good@customer.example.org>')
+        bad = self.format_message('sales@gateway.example.com', '<bad@customer.example.org>')
+        MailThread = self.env['mail.thread']
+        message_parse = type(MailThread).message_parse
+
+        def failing_parse(model, message, save_original=False):
+            if message['Message-ID'] == '<bad@customer.example.org>':
+                raise ValueError('Unparsable')
+            return message_parse(model, message, save_original=save_original)
+
+        with patch.object(type(MailThread), 'message_parse', autospec=True, side_effect=failing_parse):
+            results = MailThread.message_process_batch('crm.lead', [bad, good])
+
+        self.assertFalse(results[0])
+        self.assertTrue(results[1])
+
+
+class TestBounceBatch(MailByCompanyCommon):
+
+    def test_routing_handle_bounce_batch(self):
+        email = 'bouncing@customer.example.org'
+        partner = self.env['res.partner'].create({'name': 'Bouncing Customer', 'email': email})
+        lead = self.env['crm.lead'].create({'name': 'Bouncing Lead', 'email_from': email})
+        message = self.env['mail.message'].create({
+            'model': 'crm.lead', 'res_id': lead.id, 'message_type': 'comment', 'body': 'Hello',
+        })
+        notification = self.env['mail.notification'].create({
+            'mail_message_id': message.id, 'res_partner_id': partner.id,
+            'notification_type': 'email', 'notification_status': 'sent',
+        })
+        self.env['ir.config_parameter'].set_param('mail_by_company.bounce_blacklist_threshold', 2)
+        bounce = {'bounced_email': email, 'bounced_partner': partner, 'bounced_message': message}
+        not_a_bounce = {'bounced_email': False, 'bounced_partner': self.env['res.partner'],
+                        'bounced_message': self.env['mail.message']}
+
+        self.env['mail.thread']._routing_handle_bounce_batch([bounce, dict(bounce), not_a_bounce])
+
+        self.assertEqual(partner.message_bounce, 2)
+        self.assertEqual(lead.message_bounce, 2)
+        self.assertEqual(notification.notification_status, 'bounce')
+        self.assertTrue(self.env['mail.blacklist'].search([('email', '=', email)]))
+
+    def test_bounce_batch_hook(self):
+        """ Overrides of ``_routing_handle_bounce`` still run for the bounces
+        of a batch, the records being updated once. """
+        email = 'bouncing@customer.example.org'
+        partner = self.env['res.partner'].create({'name': 'Bouncing Customer', 'email': email})
+        lead = self.env['crm.lead'].create({'name': 'Bouncing Lead', 'email_from': email})
+        message = self.env['mail.message'].create({
+            'model': 'crm.lead', 'res_id': lead.id, 'message_type': 'comment', 'body': 'Hello',
+            'message_id': '<sent@gateway.example.com>',
+        })
+        MailThread = self.env['mail.thread']
+        handle_bounce = type(MailThread)._routing_handle_bounce
+        bounced_msg_ids = []
+
+        def override_handle_bounce(model, email_message, message_dict):
+            bounced_msg_ids.extend(message_dict['bounced_msg_id'])
+            return handle_bounce(model, email_message, message_dict)
+
+        raw = BOUNCE_TEMPLATE.format(email=email, message_id=message.message_id)
+        with patch.object(type(MailThread), '_routing_handle_bounce', autospec=True, side_effect=override_handle_bounce):
+            results = MailThread.message_process_batch('crm.lead', [raw])
+
+        self.assertEqual(results, [False])
+        self.assertEqual(bounced_msg_ids, ['<sent@gateway.example.com>'])
+        self.assertEqual(partner.message_bounce, 1)
+        self.assertEqual(lead.message_bounce, 1)
+
+
+class TestAliasRouting(MailByCompanyCommon):
+
+    def test_route_alias_index(self):
+        Alias = self.env['mail.alias']
+        self.assertEqual(Alias._get_route_alias_ids('gateway.example.com', 'sales'), (self.alias.id,))
+        self.assertEqual(Alias._get_route_alias_ids('gateway.example.com', 'unknown'), ())
+        self.assertEqual(Alias._get_route_alias_ids('other.example.com', 'sales'), ())
+
+        # the index follows the aliases
+        support = Alias.create({
+            'alias_name': 'support',
+            'alias_model_id': self.lead_model.id,
+            'alias_contact': 'everyone',
+        })
+        self.assertEqual(Alias._get_route_alias_ids('gateway.example.com', 'support'), (support.id,))
+        self.assertEqual(Alias._get_route_aliases_by_name('support'), ((support.id, 'crm.lead'),))
+
+        lead_id = self.env['mail.thread'].message_process(
+            None, self.format_message('Support <SUPPORT@Gateway.Example.com>', '<support@customer.example.org>'))
+        self.assertEqual(self.env['crm.lead'].browse(lead_id).name, 'Request')
+
+
+class TestSpooledAttachments(MailByCompanyCommon):
+
+    def test_spooled_attachment_multi_route(self):
+        """ Each route of a message gets the attachments spooled while parsing it. """
+        self.env['ir.config_parameter'].set_param('mail_by_company.attachment_spool_threshold', 100)
+        self.env['mail.alias'].create({
+            'alias_name': 'support',
+            'alias_model_id': self.lead_model.id,
+            'alias_contact': 'everyone',
+        })
+        message = EmailMessage()
+        message['From'] = 'Customer <customer@customer.example.org>'
+        message['To'] = 'sales@gateway.example.com, support@gateway.example.com'
+        message['Subject'] = 'Spooled'
+        message['Message-ID'] = '<spooled@customer.example.org>'
+        message.set_content('See attached.')
+        message.add_attachment(b'x' * 1000, maintype='application', subtype='octet-stream', filename='large.bin')
+        message.add_attachment(b'small', maintype='application', subtype='octet-stream', filename='small.bin')
+
+        self.env['mail.thread'].message_process(None, message.as_bytes())
+
+        leads = self.env['crm.lead'].search([('name', '=', 'Spooled')])
+        self.assertEqual(len(leads), 2)
+        for lead in leads:
+            attachments = lead.message_ids.attachment_ids
+            self.assertEqual(sorted(attachments.mapped('name')), ['large.bin', 'small.bin'])
+            self.assertEqual(attachments.filtered(lambda attachment: attachment.name == 'large.bin').raw, b'x' * 1000)
+            self.assertEqual(set(attachments.mapped('res_id')), {lead.id})
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from odoo.tests import common
+
+from ..models.mail_metrics import MailMetrics
+
+
+class TestMailMetrics(common.BaseCase):
+
+    def setUp(self):
+        super(TestMailMetrics, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_render_all_processes(self):
+        """ The scrape sums the counters saved by the other workers. """
+        worker, scraper = MailMetrics(self.directory), MailMetrics(self.directory)
+        worker.inc('smtp_messages_sent_total', 3, server=1)
+        worker.observe('smtp_send', 0.5, 2, server=1)
+        worker.save()
+        scraper.inc('smtp_messages_sent_total', 2, server=1)
+        scraper.inc('smtp_messages_sent_total', 1, server=2)
+
+        body = scraper.render(gauges={'smtp_pool_idle': 4})
+        self.assertIn('mail_by_company_smtp_messages_sent_total{server="1"} 5\n', body)
+        self.assertIn('mail_by_company_smtp_messages_sent_total{server="2"} 1\n', body)
+        self.assertIn('mail_by_company_stage_seconds_count{server="1",stage="smtp_send"} 1\n', body)
+        self.assertIn('mail_by_company_stage_queries_total{server="1",stage="smtp_send"} 2\n', body)
+        self.assertRegex(body, r'mail_by_company_smtp_pool_idle\{worker="\d+"\} 4\n')
+
+        # the other processes drop their counters too
+        worker.reset()
+        self.assertNotIn('smtp_messages_sent_total', scraper.render())
+        scraper.inc('smtp_messages_sent_total', 1, server=1)
+        self.assertIn('mail_by_company_smtp_messages_sent_total{server="1"} 1\n', scraper.render())
+
+    def test_fold_exited(self):
+        """ The snapshots of the processes that exited are folded into one. """
+        exited = subprocess.Popen([sys.executable, '-c', ''])
+        exited.wait()
+        worker, scraper = MailMetrics(self.directory), MailMetrics(self.directory)
+        worker.inc('smtp_messages_sent_total', 3, server=1)
+        worker.save()
+        # the snapshot of a worker that exited
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                os.rename(os.path.join(self.directory, name),
+                          os.path.join(self.directory, '%s-exited.json' % exited.pid))
+
+        scraper.inc('smtp_messages_sent_total', 1, server=1)
+        scraper.save()
+        self.assertEqual(sorted(name for name in os.listdir(self.directory) if name.endswith('.json')),
+                         sorted(['exited.json', scraper._name]))
+        self.assertIn('mail_by_company_smtp_messages_sent_total{server="1"} 4\n', scraper.render())
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import email
+import email.policy
+import smtplib
+from datetime import timedelta
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.addons.base.models.ir_mail_server import IrMailServer as BaseIrMailServer, MailDeliveryException
+from odoo.tests import common
+
+from ..models.mail_bulk import BulkTemplates
+from ..models.smtp_breaker import CircuitOpenError
+
+
+class MailServerCommon(common.SavepointCase):
+    """ A server of the company, with a fallback server of another company. """
+
+    @classmethod
+    def setUpClass(cls):
+        super(MailServerCommon, cls).setUpClass()
+        cls.other_company = cls.env['res.company'].create({'name': 'Fallback Company'})
+        cls.fallback = cls.env['ir.mail_server'].create({
+            'name': 'Fallback',
+            'smtp_host': 'smtp.fallback.example.com',
+            'smtp_user': 'relay@fallback.example.com',
+            'default_company': cls.other_company.id,
+        })
+        cls.server = cls.env['ir.mail_server'].create({
+            'name': 'Company',
+            'smtp_host': 'smtp.example.com',
+            'smtp_user': 'noreply@example.com',
+            'default_company': cls.env.company.id,
+            'fallback_mail_server_id': cls.fallback.id,
+        })
+
+    def _build_email(self):
+        return self.env['ir.mail_server'].build_email(
+            'Sender <sender@example.com>', ['recipient@example.org'], 'Subject', 'Body',
+            headers={'Return-Path': 'bounce@example.com'})
+
+
+class TestMailServerFailover(MailServerCommon):
+
+    def test_company_headers(self):
+        IrMailServer = self.env['ir.mail_server']
+        message = self._build_email()
+        IrMailServer._apply_company_headers(message, self.env.company.id, self.server.id)
+        self.assertEqual(message['Return-Path'], 'noreply@example.com')
+        self.assertEqual(message['From'], 'Sender <noreply@example.com>')
+
+        # the fallback server sends with its own account
+        message = self._build_email()
+        IrMailServer._apply_company_headers(message, self.env.company.id, self.fallback.id)
+        self.assertEqual(message['Return-Path'], 'relay@fallback.example.com')
+        self.assertEqual(message['From'], 'Sender <relay@fallback.example.com>')
+
+    def test_unavailable_server_raises(self):
+        mail = self.env['mail.mail'].create({
+            'subject': 'Unavailable',
+            'body_html': '<p>Unavailable</p>',
+            'email_from': 'sender@example.com',
+            'email_to': 'recipient@example.org',
+        })
+        (self.server | self.fallback).write({'health_state': 'down'})
+        with self.assertRaises(MailDeliveryException):
+            mail.send(raise_exception=True)
+        # without raise_exception, the email waits for the next run
+        mail.send()
+        self.assertEqual(mail.state, 'outgoing')
+
+    def test_direct_send_failover(self):
+        """ A direct send through a server that is down goes through its
+        fallback server, with the account of the fallback. """
+        IrMailServer = self.env['ir.mail_server']
+        sent = []
+
+        def send_email(model, message, mail_server_id=None, *args, **kwargs):
+            sent.append((mail_server_id, message['Return-Path']))
+            return message['Message-Id']
+
+        self.server.write({'health_state': 'down'})
+        with patch.object(BaseIrMailServer, 'send_email', autospec=True, side_effect=send_email):
+            IrMailServer.send_email(self._build_email(), mail_server_id=self.server.id)
+            self.assertEqual(sent, [(self.fallback.id, 'relay@fallback.example.com')])
+
+            self.fallback.write({'health_state': 'down'})
+            with self.assertRaises(MailDeliveryException):
+                IrMailServer.send_email(self._build_email(), mail_server_id=self.server.id)
+        self.assertEqual(len(sent), 1)
+
+    def test_connect_breaker(self):
+        """ Connecting to a server whose breaker is open fails right away,
+        except for the probes of the health check. """
+        IrMailServer = self.env['ir.mail_server']
+        breaker = IrMailServer._get_breaker(self.server.id)
+        self.addCleanup(breaker.success)
+        while not breaker.failure():
+            pass
+        with self.assertRaises(CircuitOpenError):
+            IrMailServer.connect(mail_server_id=self.server.id)
+        IrMailServer.with_context(mail_smtp_probe=True).connect(mail_server_id=self.server.id)
+        self.assertFalse(breaker.is_open)
+
+
+class TestMailQueue(common.SavepointCase):
+
+    def _create_mail(self, **values):
+        return self.env['mail.mail'].create(dict({
+            'subject': 'Queued',
+            'body_html': '<p>Queued</p>',
+            'email_from': 'sender@example.com',
+            'email_to': 'recipient@example.org',
+            'auto_delete': False,
+        }, **values))
+
+    def test_process_email_queue(self):
+        now = fields.Datetime.now()
+        past = self._create_mail(scheduled_date=fields.Datetime.to_string(now - timedelta(hours=1)))
+        unscheduled = self._create_mail()
+        future = self._create_mail(scheduled_date=fields.Datetime.to_string(now + timedelta(days=1)))
+
+        self.env['mail.mail'].process_email_queue()
+
+        self.assertEqual(past.state, 'sent')
+        self.assertEqual(unscheduled.state, 'sent')
+        self.assertEqual(future.state, 'outgoing')
+
+    def test_retry_stagger(self):
+        """ The retries of a server are released at the configured rate,
+        after the ones rescheduled by previous batches. """
+        server = self.env['ir.mail_server'].create({'name': 'Retried', 'smtp_host': 'smtp.example.com'})
+        set_param = self.env['ir.config_parameter'].set_param
+        set_param('mail_by_company.retry_base_delay', 60)
+        set_param('mail_by_company.retry_release_rate', 1)
+        first = self._create_mail() | self._create_mail()
+        second = self._create_mail() | self._create_mail()
+        exc = smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+
+        self.assertFalse(first._schedule_retry(server.id, exc))
+        self.assertFalse(second._schedule_retry(server.id, exc))
+
+        mails = first | second
+        self.assertEqual(mails.mapped('retry_server_id'), server)
+        self.assertEqual(set(mails.mapped('retry_count')), {1})
+        dates = [fields.Datetime.to_datetime(mail.scheduled_date) for mail in mails]
+        self.assertGreater(dates[0], fields.Datetime.now() + timedelta(seconds=29))
+        for previous, date in zip(dates, dates[1:]):
+            self.assertGreaterEqual(date - previous, timedelta(seconds=60))
+
+    def test_fair_queue(self):
+        """ A transactional email is not queued behind a bulk send. """
+        bulk = self._create_mail(mail_priority='bulk') | self._create_mail(mail_priority='bulk')
+        transactional = self._create_mail(mail_priority='transactional')
+        queue_ids = self.env['mail.mail']._get_fair_queue_ids()
+        self.assertLess(queue_ids.index(transactional.id), queue_ids.index(bulk[1].id))
+
+
+class TestDeferredDelivery(MailServerCommon):
+
+    def setUp(self):
+        super(TestDeferredDelivery, self).setUp()
+        # the daily quota is reserved in its own transaction
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+
+    def test_deferred_failover_and_cap(self):
+        """ Deferred emails go through the fallback of a server that is down,
+        within the daily cap of the fallback. """
+        self.server.write({'health_state': 'down'})
+        self.fallback.write({'send_daily_cap': 1})
+        IrMailServer = self.env['ir.mail_server'].with_context(mail_defer_send=True)
+        for _index in range(2):
+            IrMailServer.send_email(self._build_email())
+        Deferred = self.env['mail.deferred.message']
+        queued = Deferred.search([('mail_server_id', '=', self.server.id)])
+        self.assertEqual(len(queued), 2)
+
+        Deferred._cron_send_deferred()
+
+        self.assertEqual(len(queued.exists()), 1)
+        self.assertEqual(queued.exists().state, 'queued')
+        self.assertEqual(self.fallback.daily_sent_count, 1)
+
+
+class TestBulkEmail(MailServerCommon):
+
+    @staticmethod
+    def _parse(message):
+        """ Headers and contents of ``message`` as sent, without what differs
+        between two builds: the date and the boundaries. """
+        parsed = email.message_from_bytes(message.as_bytes(), policy=email.policy.SMTP)
+        headers = sorted((name, str(value)) for name, value in parsed.items() if name not in ('Date', 'Content-Type'))
+        parts = [(part.get_content_type(), part.get_content()) for part in parsed.walk() if not part.is_multipart()]
+        return headers, parsed.get_content_type(), parts
+
+    def test_build_email_templates(self):
+        """ The emails of a batch with the same content are built from a
+        template, the same as when built one by one. """
+        IrMailServer = self.env['ir.mail_server']
+        templates = BulkTemplates()
+
+        def build(mail_server, email_to):
+            return mail_server.build_email(
+                'Sender <sender@example.com>', [email_to], 'Mailing', '<p>Hello wörld</p>',
+                attachments=[('report.pdf', b'%PDF report', 'application/pdf')],
+                message_id='<%s>' % email_to, subtype='html', headers={'Return-Path': 'bounce@example.com'})
+
+        recipients = ['first@example.org', 'second@example.org', 'third@example.org']
+        bulk = [build(IrMailServer.with_context(mail_bulk_templates=templates), email_to) for email_to in recipients]
+        # the content becomes a template once built again
+        self.assertEqual(type(bulk[0]), type(bulk[1]))
+        self.assertNotEqual(type(bulk[2]), type(bulk[0]))
+        self.assertEqual([self._parse(message) for message in bulk],
+                         [self._parse(build(IrMailServer, email_to)) for email_to in recipients])
+
+    def test_send_email_bulk(self):
+        """ ``send_email_bulk`` sends the same emails as ``send_email`` called
+        for each recipient. """
+        IrMailServer = self.env['ir.mail_server']
+        recipients = [
+            {'To': 'first@example.org', 'Message-Id': '<first@example.com>'},
+            {'To': 'second@example.org', 'Cc': 'cc@example.org', 'Message-Id': '<second@example.com>'},
+        ]
+        sent = []
+
+        def send_email(model, message, *args, **kwargs):
+            sent.append(self._parse(message))
+            return message['Message-Id']
+
+        with patch.object(BaseIrMailServer, 'send_email', autospec=True, side_effect=send_email):
+            for headers in recipients:
+                message = IrMailServer.build_email(
+                    'Sender <sender@example.com>', [headers['To']], 'Subject', 'Body',
+                    email_cc=[headers['Cc']] if headers.get('Cc') else None, message_id=headers['Message-Id'],
+                    headers={'Return-Path': 'bounce@example.com'})
+                IrMailServer.send_email(message, mail_server_id=self.server.id)
+            single = sent[:]
+            del sent[:]
+            message_ids, failures = IrMailServer.send_email_bulk(
+                self._build_email(), recipients, mail_server_id=self.server.id)
+
+        self.assertEqual(message_ids, ['<first@example.com>', '<second@example.com>'])
+        self.assertEqual(failures, {})
+        self.assertEqual(sent, single)
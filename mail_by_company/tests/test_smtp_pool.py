@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import smtplib
+
+from odoo.tests import common
+
+from ..models.smtp_pipelining import enable_pipelining
+from ..models.smtp_pool import SmtpConnectionPool
+from ..tools.smtp_sink import SmtpSink
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def noop(self):
+        return (421, b'closed') if self.closed else (250, b'OK')
+
+    def quit(self):
+        self.closed = True
+
+
+class TestSmtpPool(common.BaseCase):
+
+    def test_release_max_idle(self):
+        pool = SmtpConnectionPool(max_idle_per_key=1)
+        entries = [pool.acquire('key', FakeSession, 60) for _i in range(3)]
+        self.assertEqual(pool.stats()['misses'], 3)
+
+        # up to max_idle sessions of the key stay open for the next batch
+        for entry in entries:
+            pool.release(entry, max_messages=100, max_idle=2)
+        self.assertEqual(pool.stats()['idle'], 2)
+        self.assertEqual([entry.session.closed for entry in entries], [False, False, True])
+
+        # without max_idle, the pool keeps max_idle_per_key sessions
+        reused = pool.acquire('key', FakeSession, 60)
+        self.assertIn(reused, entries[:2])
+        self.assertEqual(pool.stats()['hits'], 1)
+        pool.release(reused, max_messages=100)
+        self.assertEqual(pool.stats()['idle'], 1)
+        self.assertTrue(reused.session.closed)
+
+    def test_release_max_messages(self):
+        pool = SmtpConnectionPool()
+        entry = pool.acquire('key', FakeSession, 60)
+        entry.sent = 10
+        pool.release(entry, max_messages=10)
+        self.assertTrue(entry.session.closed)
+        self.assertEqual(pool.stats()['idle'], 0)
+
+
+class TestSmtpPipelining(common.BaseCase):
+
+    def _send(self, sink, count):
+        session = smtplib.SMTP(sink.host, sink.port)
+        pipelined = enable_pipelining(session)
+        errors = []
+        for index in range(count):
+            try:
+                session.sendmail('a@example.com', ['b@example.com', 'c@example.com'],
+                                 b'Subject: %d\r\n\r\n.Hello\r\n' % index)
+            except smtplib.SMTPSenderRefused as exc:
+                errors.append(exc.smtp_code)
+        session.quit()
+        return pipelined, errors
+
+    def test_pipelined(self):
+        with SmtpSink(throttle_every=2) as sink:
+            pipelined, errors = self._send(sink, 4)
+        self.assertTrue(pipelined)
+        # the refused emails leave the session usable for the next ones
+        self.assertEqual(errors, [451, 451])
+        self.assertEqual(sink.stats['messages'], 2)
+
+    def test_not_pipelined(self):
+        """ Servers without PIPELINING get the regular SMTP dialogue. """
+        with SmtpSink(throttle_every=2, pipelining=False) as sink:
+            pipelined, errors = self._send(sink, 4)
+        self.assertFalse(pipelined)
+        self.assertEqual(errors, [451, 451])
+        self.assertEqual(sink.stats['messages'], 2)
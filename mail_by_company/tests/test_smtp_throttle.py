@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import smtplib
+from unittest.mock import patch
+
+from odoo.addons.base.models.ir_mail_server import MailDeliveryException
+from odoo.tests import common
+
+from ..models import smtp_throttle
+from ..models.smtp_throttle import AdaptiveTokenBucket, is_throttling_reply
+
+
+class TestTokenBucket(common.BaseCase):
+
+    def setUp(self):
+        super(TestTokenBucket, self).setUp()
+        self.now = 1000.0
+        patcher = patch.object(smtp_throttle.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_rate(self):
+        bucket = AdaptiveTokenBucket(rate=2.0, burst=3)
+        self.assertEqual([bucket.reserve() for _i in range(3)], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+        self.assertAlmostEqual(bucket.reserve(), 1.0)
+        # the tokens come back at the rate, never over the burst
+        self.now += 10
+        self.assertEqual([bucket.reserve() for _i in range(3)], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+
+    def test_throttled_halves_rate(self):
+        bucket = AdaptiveTokenBucket(rate=2.0, burst=1)
+        bucket.throttled()
+        self.assertEqual(bucket.factor, 0.5)
+        self.assertAlmostEqual(bucket.reserve(), 1.0)
+        for _i in range(10):
+            bucket.throttled()
+        self.assertEqual(bucket.factor, AdaptiveTokenBucket.MIN_FACTOR)
+        # each accepted email recovers the rate additively, up to the configured one
+        bucket.accepted()
+        self.assertAlmostEqual(bucket.factor, AdaptiveTokenBucket.MIN_FACTOR + AdaptiveTokenBucket.RECOVERY)
+        for _i in range(100):
+            bucket.accepted()
+        self.assertEqual(bucket.factor, 1.0)
+
+    def test_throttling_reply(self):
+        self.assertTrue(is_throttling_reply(smtplib.SMTPSenderRefused(421, b'Too fast', 'a@example.com')))
+        self.assertTrue(is_throttling_reply(smtplib.SMTPRecipientsRefused({'a@example.com': (452, b'Later')})))
+        self.assertFalse(is_throttling_reply(smtplib.SMTPSenderRefused(550, b'Denied', 'a@example.com')))
+        try:
+            try:
+                raise smtplib.SMTPDataError(451, b'Slow down')
+            except smtplib.SMTPDataError as exc:
+                raise MailDeliveryException('Mail Delivery Failed', exc)
+        except MailDeliveryException as wrapped:
+            self.assertTrue(is_throttling_reply(wrapped))
+
+
+class TestDailyQuota(common.SavepointCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestDailyQuota, cls).setUpClass()
+        cls.server = cls.env['ir.mail_server'].create({
+            'name': 'Capped',
+            'smtp_host': 'smtp.example.com',
+            'default_company': cls.env.company.id,
+            'send_daily_cap': 5,
+        })
+
+    def setUp(self):
+        super(TestDailyQuota, self).setUp()
+        # the quota is reserved in its own transaction
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
+
+    def _create_mails(self, count):
+        return self.env['mail.mail'].create([{
+            'subject': 'Quota %s' % index,
+            'body_html': '<p>Quota</p>',
+            'email_from': 'sender@example.com',
+            'email_to': 'recipient%s@example.com' % index,
+            'auto_delete': False,
+        } for index in range(count)])
+
+    def test_reserve_and_release(self):
+        IrMailServer = self.env['ir.mail_server']
+        self.assertEqual(IrMailServer._reserve_daily_quota(self.server.id, 3), 3)
+        self.assertEqual(IrMailServer._reserve_daily_quota(self.server.id, 3), 2)
+        self.assertEqual(self.server.daily_sent_count, 5)
+        IrMailServer._release_daily_quota(self.server.id, 4)
+        self.assertEqual(self.server.daily_sent_count, 1)
+        IrMailServer._release_daily_quota(self.server.id, 4)
+        self.assertEqual(self.server.daily_sent_count, 0)
+
+    def test_send_over_cap(self):
+        mails = self._create_mails(7)
+        mails.send()
+        self.assertEqual(mails.mapped('state').count('sent'), 5)
+        self.assertEqual(mails.mapped('state').count('outgoing'), 2)
+        self.assertEqual(self.server.daily_sent_count, 5)
+
+    def test_failed_sends_release_quota(self):
+        mails = self._create_mails(3)
+        IrMailServer = type(self.env['ir.mail_server'])
+        send_email = IrMailServer.send_email
+
+        def fail_second(server, message, *args, **kwargs):
+            if message['To'] == 'recipient1@example.com':
+                raise MailDeliveryException('Mail Delivery Failed', 'Rejected')
+            return send_email(server, message, *args, **kwargs)
+
+        with patch.object(IrMailServer, 'send_email', autospec=True, side_effect=fail_second):
+            mails.send()
+        self.assertEqual(mails.mapped('state'), ['sent', 'exception', 'sent'])
+        self.assertEqual(self.server.daily_sent_count, 2)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+""" Benchmark of the multi-company mail routing and sending paths.
+
+Runs offline against a database where the module is installed, from an
+Odoo shell::
+
+    $ odoo-bin shell -d <database>
+    >>> from odoo.addons.mail_by_company.tools import benchmark
+    >>> benchmark.run(env, companies=40, aliases=5, messages=2000, mails=2000)
+
+Companies, aliases, servers and messages are generated inside a savepoint
+which is rolled back at the end; outgoing emails are delivered to a local
+SMTP sink. For each scenario the report gives the throughput, the p50/p99
+latency and the number of SQL queries per message.
+"""
+import email
+import email.policy
+import logging
+import random
+import time
+from email.message import EmailMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+
+from ..models.smtp_pool import smtp_pool
+from .smtp_sink import SmtpSink
+
+_logger = logging.getLogger(__name__)
+
+ALIAS_MODEL = 'crm.lead'
+
+
+class StageTimer(object):
+    """ Latency and query count samples of one benchmark scenario. """
+
+    def __init__(self, name, cr):
+        self.name = name
+        self.cr = cr
+        self.latencies = []
+        self.queries = 0
+        self.elapsed = 0.0
+
+    def measure(self, func, *args, **kwargs):
+        queries = self.cr.sql_log_count
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            self.latencies.append(duration)
+            self.elapsed += duration
+            self.queries += self.cr.sql_log_count - queries
+
+    def report(self, count=None):
+        count = count or len(self.latencies)
+        latencies = sorted(self.latencies)
+        return {
+            'scenario': self.name,
+            'messages': count,
+            'messages_per_sec': count / self.elapsed if self.elapsed else 0.0,
+            'p50_ms': _percentile(latencies, 50) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000,
+            'queries_per_message': self.queries / count if count else 0.0,
+        }
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))]
+
+
+def _raw_message(email_from, email_to, subject, body, headers=None, report=False):
+    if report:
+        # delivery status notification, as sent back by MTAs
+        message = MIMEMultipart('report', report_type='delivery-status')
+        message.attach(MIMEText(body))
+        message.attach(MIMEText('Final-Recipient: rfc822; %s\nAction: failed\nStatus: 5.1.1\n' % email_to,
+                                'delivery-status'))
+    else:
+        message = EmailMessage(policy=email.policy.SMTP)
+        message.set_content(body)
+    message['From'] = email_from
+    message['To'] = email_to
+    message['Subject'] = subject
+    message['Date'] = formatdate()
+    message['Message-Id'] = make_msgid(domain='bench.example.com')
+    for name, value in (headers or {}).items():
+        message[name] = value
+    return message.as_bytes()
+
+
+def setup(env, companies=5, aliases=3, sink=None):
+    """ Create the benchmark companies, one outgoing server each (pointing to
+    ``sink``) and ``aliases`` aliases per company. """
+    alias_model = env['ir.model']._get(ALIAS_MODEL)
+    env['ir.config_parameter'].set_param('mail.catchall.alias', 'catchall')
+    env['ir.config_parameter'].set_param('mail.bounce.alias', 'bounce')
+    data = []
+    for index in range(companies):
+        domain = 'bench%d.example.com' % index
+        company = env['res.company'].create({'name': 'Bench Company %d' % index, 'company_domain': domain})
+        if sink is not None:
+            env['ir.mail_server'].create({
+                'name': 'Bench %s' % domain,
+                'smtp_host': sink.host,
+                'smtp_port': sink.port,
+                'smtp_user': 'noreply@%s' % domain,
+                'smtp_encryption': 'none',
+                'default_company': company.id,
+            })
+        alias_names = []
+        for alias_index in range(aliases):
+            alias = env['mail.alias'].with_company(company).create({
+                'alias_name': 'sales%d' % alias_index,
+                'alias_model_id': alias_model.id,
+            })
+            alias_names.append(alias.alias_name)
+        data.append((company, domain, alias_names))
+    return data
+
+
+def generate_messages(data, count, kind, reply_ids=None):
+    """ Generate ``count`` raw messages of ``kind``: 'new', 'reply', 'bounce'
+    or 'catchall'. """
+    rnd = random.Random(count)
+    messages = []
+    for index in range(count):
+        company, domain, alias_names = rnd.choice(data)
+        sender = 'customer%d@customer.example.org' % rnd.randint(0, max(count // 4, 1))
+        if kind == 'new':
+            messages.append(_raw_message(
+                sender, '%s@%s' % (rnd.choice(alias_names), domain),
+                'Benchmark request %d' % index, 'Hello, this is request %d.' % index))
+        elif kind == 'reply':
+            parent = rnd.choice(reply_ids)
+            messages.append(_raw_message(
+                sender, '%s@%s' % (rnd.choice(alias_names), domain),
+                'Re: Benchmark request', 'A reply.', headers={'In-Reply-To': parent, 'References': parent}))
+        elif kind == 'bounce':
+            messages.append(_raw_message(
+                'MAILER-DAEMON@%s' % domain, 'bounce+%d-%s-%d@%s' % (index + 1, ALIAS_MODEL, index + 1, domain),
+                'Undelivered Mail Returned to Sender', 'Delivery failed.', report=True))
+        elif kind == 'catchall':
+            messages.append(_raw_message(
+                sender, 'catchall@%s' % domain, 'To the catchall', 'Nobody should write here.'))
+    return messages
+
+
+def bench_routing(env, name, messages):
+    """ Route each message through ``message_route`` then
+    ``_message_route_process``, measuring them separately. """
+    MailThread = env['mail.thread']
+    route_timer = StageTimer('%s: message_route' % name, env.cr)
+    process_timer = StageTimer('%s: _message_route_process' % name, env.cr)
+    message_ids = []
+    for raw in messages:
+        message = email.message_from_bytes(raw, policy=email.policy.SMTP)
+        msg_dict = MailThread.message_parse(message)
+        routes = route_timer.measure(MailThread.message_route, message, msg_dict, ALIAS_MODEL)
+        if routes:
+            process_timer.measure(MailThread._message_route_process, message, msg_dict, routes)
+            message_ids.append(msg_dict['message_id'])
+    reports = [route_timer.report()]
+    if process_timer.latencies:
+        reports.append(process_timer.report())
+    return reports, message_ids
+
+
+def bench_batch(env, name, messages):
+    timer = StageTimer('%s: message_process_batch' % name, env.cr)
+    timer.measure(env['mail.thread'].message_process_batch, ALIAS_MODEL, messages)
+    return timer.report(count=len(messages))
+
+
+def bench_sending(env, data, count, sink):
+    """ Queue ``count`` emails on records of the benchmark companies and send
+    them through ``MailMail.send`` to the SMTP sink. """
+    rnd = random.Random(count)
+    leads = {}
+    for company, domain, alias_names in data:
+        leads[company.id] = env[ALIAS_MODEL].create({'name': 'Bench lead %s' % domain, 'company_id': company.id})
+    mails = env['mail.mail'].create([{
+        'subject': 'Benchmark email %d' % index,
+        'body_html': '<p>Benchmark email %d</p>' % index,
+        'email_from': 'bench@example.com',
+        'email_to': 'recipient%d@recipient.example.org' % index,
+        'model': ALIAS_MODEL,
+        'res_id': leads[rnd.choice(data)[0].id].id,
+        'auto_delete': False,
+    } for index in range(count)])
+    timer = StageTimer('MailMail.send', env.cr)
+    sent_before = sink.stats['messages']
+    timer.measure(mails.send)
+    report = timer.report(count=count)
+    report['delivered'] = sink.stats['messages'] - sent_before
+    report['pool'] = smtp_pool.stats()
+    return report
+
+
+def run(env, companies=5, aliases=3, messages=200, mails=200, log=True):
+    """ Run every scenario and return the list of reports. Nothing is kept in
+    the database. """
+    cr = env.cr
+    reports = []
+    with SmtpSink() as sink:
+        cr.execute('SAVEPOINT mail_by_company_benchmark')
+        try:
+            data = setup(env, companies=companies, aliases=aliases, sink=sink)
+
+            new_messages = generate_messages(data, messages, 'new')
+            stage_reports, message_ids = bench_routing(env, 'new thread', new_messages)
+            reports += stage_reports
+            if message_ids:
+                reports += bench_routing(env, 'reply', generate_messages(data, messages, 'reply', message_ids))[0]
+            reports += bench_routing(env, 'bounce', generate_messages(data, messages, 'bounce'))[0]
+            reports += bench_routing(env, 'catchall', generate_messages(data, messages, 'catchall'))[0]
+            reports.append(bench_batch(env, 'new thread', generate_messages(data, messages + 1, 'new')))
+            if mails:
+                reports.append(bench_sending(env, data, mails, sink))
+        finally:
+            cr.execute('ROLLBACK TO SAVEPOINT mail_by_company_benchmark')
+            env.clear()
+            env.registry.clear_caches()
+            smtp_pool.clear(lambda key: key[0] == cr.dbname)
+    if log:
+        for report in reports:
+            _logger.info(
+                '%-40s %6d msgs %9.1f msg/s  p50 %8.2f ms  p99 %8.2f ms  %6.1f queries/msg',
+                report['scenario'], report['messages'], report['messages_per_sec'],
+                report['p50_ms'], report['p99_ms'], report['queries_per_message'])
+    return reports
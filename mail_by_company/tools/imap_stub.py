@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import socketserver
+import threading
+
+
+class _ImapStubHandler(socketserver.StreamRequestHandler):
+    """ Minimal IMAP4rev1 dialogue on a single INBOX, enough for the fetchmail
+    commands (LOGIN, SELECT, SEARCH, FETCH, STORE) and IDLE. """
+
+    def handle(self):
+        stub = self.server.stub
+        self.write_lock = threading.Lock()
+        stub.count('connections')
+        self._send(b'* OK IMAP stub ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode('utf-8', 'replace').strip().split(' ')
+            if len(parts) < 2:
+                self._send(b'* BAD missing command')
+                continue
+            tag, command, args = parts[0], parts[1].upper(), parts[2:]
+            if command == 'UID':
+                self._send_tagged(tag, 'NO UID not supported')
+            elif command == 'CAPABILITY':
+                self._send(b'* CAPABILITY IMAP4rev1 IDLE')
+                self._send_tagged(tag, 'OK CAPABILITY completed')
+            elif command in ('LOGIN', 'NOOP', 'CLOSE', 'EXPUNGE', 'CHECK'):
+                self._send_tagged(tag, 'OK %s completed' % command)
+            elif command in ('SELECT', 'EXAMINE'):
+                self._send(b'* FLAGS (\\Seen)')
+                self._send(('* %d EXISTS' % len(stub.messages)).encode())
+                self._send(b'* 0 RECENT')
+                self._send_tagged(tag, 'OK [READ-WRITE] %s completed' % command)
+            elif command == 'SEARCH':
+                numbers = stub.search(unseen='UNSEEN' in ' '.join(args).upper())
+                self._send(('* SEARCH %s' % ' '.join(map(str, numbers))).rstrip().encode())
+                self._send_tagged(tag, 'OK SEARCH completed')
+            elif command == 'FETCH':
+                for number in self._numbers(args[0], stub):
+                    raw = stub.messages[number - 1][0]
+                    self._send(b'* %d FETCH (RFC822 {%d}\r\n' % (number, len(raw)) + raw + b')')
+                    stub.count('fetched')
+                self._send_tagged(tag, 'OK FETCH completed')
+            elif command == 'STORE':
+                seen = '\\SEEN' in ' '.join(args).upper()
+                for number in self._numbers(args[0], stub):
+                    if seen:
+                        stub.set_seen(number, args[1].startswith('+'))
+                    self._send(('* %d FETCH (FLAGS (%s))' % (
+                        number, '\\Seen' if stub.messages[number - 1][1] else '')).encode())
+                self._send_tagged(tag, 'OK STORE completed')
+            elif command == 'IDLE':
+                self._send(b'+ idling')
+                stub.add_idler(self)
+                try:
+                    done = self.rfile.readline()
+                finally:
+                    stub.remove_idler(self)
+                if not done:
+                    return
+                self._send_tagged(tag, 'OK IDLE terminated')
+            elif command == 'LOGOUT':
+                self._send(b'* BYE logging out')
+                self._send_tagged(tag, 'OK LOGOUT completed')
+                return
+            else:
+                self._send_tagged(tag, 'BAD command not implemented')
+
+    def _numbers(self, spec, stub):
+        numbers = []
+        for item in spec.split(','):
+            start, _sep, end = item.partition(':')
+            last = len(stub.messages) if end == '*' else int(end or start)
+            numbers += [number for number in range(int(start), last + 1) if 0 < number <= len(stub.messages)]
+        return numbers
+
+    def _send(self, data):
+        with self.write_lock:
+            self.wfile.write(data + b'\r\n')
+            self.wfile.flush()
+
+    def _send_tagged(self, tag, text):
+        self._send(('%s %s' % (tag, text)).encode())
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ImapStub(object):
+    """ Local IMAP server with a single in-memory INBOX, used to exercise
+    the incoming mail servers and IMAP IDLE listeners offline.
+    ``deliver(raw)`` adds a message and notifies the IDLE sessions.
+
+        with ImapStub() as imap:
+            # point a fetchmail.server (imap, no SSL) to imap.host / imap.port
+            imap.deliver(raw_message)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.messages = []
+        self.stats = {'connections': 0, 'fetched': 0}
+        self._lock = threading.Lock()
+        self._idlers = set()
+        self._server = _ThreadingTCPServer((host, port), _ImapStubHandler)
+        self._server.stub = self
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='imap-stub', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.stats[name] += value
+
+    def deliver(self, raw):
+        if isinstance(raw, str):
+            raw = raw.encode('utf-8')
+        with self._lock:
+            self.messages.append((raw, False))
+            exists = len(self.messages)
+            idlers = list(self._idlers)
+        for handler in idlers:
+            handler._send(b'* %d EXISTS' % exists)
+
+    def search(self, unseen=False):
+        with self._lock:
+            return [index + 1 for index, (raw, seen) in enumerate(self.messages) if not (unseen and seen)]
+
+    def set_seen(self, number, seen):
+        with self._lock:
+            self.messages[number - 1] = (self.messages[number - 1][0], seen)
+
+    def add_idler(self, handler):
+        with self._lock:
+            self._idlers.add(handler)
+
+    def remove_idler(self, handler):
+        with self._lock:
+            self._idlers.discard(handler)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import logging
+import socketserver
+import threading
+
+_logger = logging.getLogger(__name__)
+
+
+class _SmtpSinkHandler(socketserver.StreamRequestHandler):
+    """ Minimal SMTP dialogue: every login and message is accepted, the
+    messages are discarded. """
+
+    def handle(self):
+        sink = self.server.sink
+        sink.count('connections')
+        self._reply(220, 'localhost SMTP sink ready')
+        # state of the current mail transaction: accepted sender, recipients
+        sender, recipients = False, 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.wfile.write(b'250-localhost\r\n')
+                if sink.pipelining:
+                    self.wfile.write(b'250-PIPELINING\r\n')
+                self.wfile.write(b'250-8BITMIME\r\n250-AUTH PLAIN\r\n250 SIZE 104857600\r\n')
+            elif verb == 'HELO':
+                self._reply(250, 'localhost')
+            elif verb == 'AUTH':
+                self._reply(235, 'Authentication successful')
+            elif verb == 'MAIL':
+                reply = sink.on_mail(command)
+                sender, recipients = reply[0] == 250, 0
+                self._reply(*reply)
+            elif verb == 'RCPT':
+                if not sender:
+                    self._reply(503, '5.5.1 Error: need MAIL command')
+                    continue
+                recipients += 1
+                sink.count('recipients')
+                self._reply(250, 'OK')
+            elif verb == 'DATA':
+                if not recipients:
+                    self._reply(503, '5.5.1 Error: need RCPT command')
+                    continue
+                sender, recipients = False, 0
+                self._reply(354, 'End data with <CR><LF>.<CR><LF>')
+                size = 0
+                for data_line in iter(self.rfile.readline, b''):
+                    if data_line in (b'.\r\n', b'.\n'):
+                        break
+                    size += len(data_line)
+                sink.count('messages')
+                sink.count('bytes', size)
+                self._reply(250, 'OK queued')
+            elif verb == 'RSET':
+                sender, recipients = False, 0
+                self._reply(250, 'OK')
+            elif verb == 'NOOP':
+                self._reply(250, 'OK')
+            elif verb == 'QUIT':
+                self._reply(221, 'Bye')
+                return
+            else:
+                self._reply(502, 'Command not implemented')
+
+    def _reply(self, code, text):
+        self.wfile.write(('%d %s\r\n' % (code, text)).encode('ascii'))
+        self.wfile.flush()
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SmtpSink(object):
+    """ Local SMTP server swallowing emails, used to exercise the sending
+    path offline. ``throttle_every`` makes it answer ``451`` to one MAIL
+    command out of ``throttle_every``, like a provider enforcing quotas;
+    ``pipelining`` whether it advertises the PIPELINING extension.
+
+        with SmtpSink() as sink:
+            # point an ir.mail_server to sink.host / sink.port
+            ...
+        # the counters of the session, logged once the sink is stopped
+        sink.stats
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, throttle_every=0, pipelining=True):
+        self.throttle_every = throttle_every
+        self.pipelining = pipelining
+        self.stats = {'connections': 0, 'messages': 0, 'recipients': 0, 'bytes': 0, 'throttled': 0}
+        self._lock = threading.Lock()
+        self._mail_commands = 0
+        self._server = _ThreadingTCPServer((host, port), _SmtpSinkHandler)
+        self._server.sink = self
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='smtp-sink', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        _logger.info("SMTP sink on %s:%s stopped: %s", self.host, self.port, self.stats)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.stats[name] += value
+
+    def on_mail(self, command):
+        with self._lock:
+            self._mail_commands += 1
+            if self.throttle_every and self._mail_commands % self.throttle_every == 0:
+                self.stats['throttled'] += 1
+                return 451, '4.7.1 Too many messages, slow down'
+        return 250, 'OK'